@@ -3,13 +3,31 @@ sys.path.insert(1, './src/')
 
 
 import config
+import importlib
 from pathlib import Path
 from doit.tools import run_once
+# Stage graph of `build_main_sample`, without importing pandas
+from main_sample_stages import PARTITIONED_DATASETS, STAGE_INPUTS
 
 
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 DATA_DIR = Path(config.DATA_DIR)
 
+
+def pull_action(module, function, **kwargs):
+    """
+    Run `module.function(**kwargs)` inside the doit process.
+
+    The pull tasks run in-process rather than as `python ./src/...` so that
+    they all borrow from the same WRDS connection pool (see `wrds_tools`) and
+    log in once per doit run. The module is only imported when the task runs,
+    so loading this file stays fast.
+    """
+    def action():
+        getattr(importlib.import_module(module), function)(**kwargs)
+    return (action,)
+
+
 def task_pull_CRSP():
     """
     Pull CRSP mutual fund data from WRDS
@@ -17,17 +35,49 @@ def task_pull_CRSP():
     file_dep = [
         "./src/config.py",
         "./src/load_CRSP_fund.py",
+        "./src/parquet_tools.py",
+        "./src/wrds_tools.py",
+    ]
+    targets = [
+        Path(DATA_DIR) / "pulled" / file for file in [
+            "CRSP_fund_combined",
+            "CRSP_fund_combined/_manifest.json",
+            ]
+    ]
+
+    return {
+        "actions": [
+            "python ./src/config.py",
+            pull_action("load_CRSP_fund", "pull_and_save_CRSP_combined_file"),
+        ],
+        "file_dep": file_dep,
+        "targets": targets,
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
+def task_pull_CRSP_fund_level():
+    """
+    Pull CRSP mutual fund data aggregated to wficn from WRDS
+    """
+    file_dep = [
+        "./src/config.py",
+        "./src/load_CRSP_fund.py",
+        "./src/parquet_tools.py",
+        "./src/wrds_tools.py",
     ]
     targets = [
         Path(DATA_DIR) / "pulled" / file for file in [
-            "CRSP_fund_combined.parquet",
+            "CRSP_fund_level",
+            "CRSP_fund_level/_manifest.json",
             ]
     ]
 
     return {
         "actions": [
             "python ./src/config.py",
-            "python ./src/load_CRSP_fund.py",
+            pull_action("load_CRSP_fund", "pull_and_save_CRSP_fund_level_file"),
         ],
         "file_dep": file_dep,
         "targets": targets,
@@ -43,17 +93,48 @@ def task_pull_s12():
     file_dep = [
         "./src/config.py",
         "./src/load_s12.py",
+        "./src/parquet_tools.py",
+        "./src/wrds_tools.py",
     ]
     targets = [
         Path(DATA_DIR) / "pulled" / file for file in [
-            "s12.parquet",
+            "s12",
+            "s12/_manifest.json",
             ]
     ]
 
     return {
         "actions": [
             "python ./src/config.py",
-            "python ./src/load_s12.py",
+            pull_action("load_s12", "pull_and_save_s12"),
+        ],
+        "file_dep": file_dep,
+        "targets": targets,
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
+def task_pull_s12_fund_year():
+    """
+    Pull s12 holdings linked to wficn, one row per fund and year, from WRDS
+    """
+    file_dep = [
+        "./src/config.py",
+        "./src/load_s12.py",
+        "./src/parquet_tools.py",
+        "./src/wrds_tools.py",
+    ]
+    targets = [
+        Path(DATA_DIR) / "pulled" / file for file in [
+            "s12_fund_year.parquet",
+            ]
+    ]
+
+    return {
+        "actions": [
+            "python ./src/config.py",
+            pull_action("load_s12", "pull_and_save_s12_fund_year"),
         ],
         "file_dep": file_dep,
         "targets": targets,
@@ -69,6 +150,8 @@ def task_mflink():
     file_dep = [
         "./src/config.py",
         "./src/load_mflink.py",
+        "./src/parquet_tools.py",
+        "./src/wrds_tools.py",
     ]
     targets = [
         Path(DATA_DIR) / "pulled" / file for file in [
@@ -80,7 +163,7 @@ def task_mflink():
     return {
         "actions": [
             "python ./src/config.py",
-            "python ./src/load_mflink.py",
+            pull_action("load_mflink", "pull_and_save_mflink"),
         ],
         "file_dep": file_dep,
         "targets": targets,
@@ -90,6 +173,167 @@ def task_mflink():
 
 
 
+def dataset_manifest(name):
+    """
+    Manifest of the pulled dataset `name`, as file_dep (doit cannot depend on a directory)
+
+    The pull writes it (see `parquet_tools.write_manifest`) and lists it among
+    its targets, so doit runs the pull first on a fresh tree, and reruns the
+    tasks depending on it whenever the pull rewrites the dataset.
+    """
+    return DATA_DIR / "pulled" / name / "_manifest.json"
+
+
+def task_main_sample():
+    """
+    Build the Table 1 main sample stage by stage, without Jupyter
+
+    Each stage is cached in `data/intermediate` by `build_main_sample`, so a
+    stage whose inputs did not change is only read back. The merge stage
+    writes `main_sample.parquet`.
+    """
+    stage_file_deps = {}
+    for stage, inputs in STAGE_INPUTS.items():
+        stage_deps = inputs["reads"]
+        # A stage reruns whenever a stage it reads would, so that `main_sample.parquet` is never stale
+        file_deps = [
+            "./src/build_main_sample.py",
+            "./src/main_sample_stages.py",
+            *[f"./src/{module}" for module in inputs["modules"]],
+            *[
+                dataset_manifest(name) if name in PARTITIONED_DATASETS else DATA_DIR / "pulled" / f"{name}.parquet"
+                for name in inputs["pulled"]
+            ],
+        ]
+        for dep in stage_deps:
+            file_deps += [file for file in stage_file_deps[dep] if file not in file_deps]
+        stage_file_deps[stage] = file_deps
+        if stage == "merge":
+            action = pull_action("build_main_sample", "build_main_sample")
+            targets = [OUTPUT_DIR / "main_sample.parquet"]
+        else:
+            action = pull_action("build_main_sample", "run_stage", stage=stage)
+            targets = []
+        yield {
+            "name": stage,
+            "actions": [action],
+            "file_dep": file_deps,
+            "task_dep": [f"main_sample:{dep}" for dep in stage_deps],
+            "targets": targets,
+            "clean": True,
+            "verbosity": 2,
+        }
+
+
+# Stage outputs of `build_table2.STAGE_FILES`
+TABLE2_DIR = DATA_DIR / "intermediate" / "table2"
+TABLE2_MODULE_DEPS = [
+    "./src/config.py",
+    "./src/build_table2.py",
+    "./src/cache_tools.py",
+    "./src/dtype_tools.py",
+    "./src/factor_betas_calculation.py",
+    "./src/parquet_tools.py",
+]
+
+
+def task_monthly_fund_panel():
+    """
+    Build the monthly fund panel of the main sample
+    """
+    file_dep = [
+        *TABLE2_MODULE_DEPS,
+        "./src/load_CRSP_fund.py",
+        "./src/load_mflink.py",
+        OUTPUT_DIR / "main_sample.parquet",
+        dataset_manifest("CRSP_fund_combined"),
+        DATA_DIR / "pulled" / "mflink1.parquet",
+    ]
+    return {
+        "actions": [pull_action("build_table2", "save_monthly_fund_panel")],
+        "file_dep": file_dep,
+        "targets": [TABLE2_DIR / "monthly_fund_panel.parquet"],
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
+def task_regression_input():
+    """
+    Merge the monthly fund panel with the Fama-French factors and compute flows
+    """
+    file_dep = [
+        *TABLE2_MODULE_DEPS,
+        "./src/factor_store.py",
+        "./src/panel_tools.py",
+        TABLE2_DIR / "monthly_fund_panel.parquet",
+        DATA_DIR / "manual" / "F-F_Research_Data_5_Factors_2x3.csv",
+        DATA_DIR / "manual" / "F-F_Momentum_Factor.csv",
+    ]
+    return {
+        "actions": [pull_action("build_table2", "save_regression_input")],
+        "file_dep": file_dep,
+        "targets": [TABLE2_DIR / "regression_input.parquet"],
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
+def task_betas():
+    """
+    Estimate the rolling factor betas of every fund group of Table 2
+    """
+    return {
+        "actions": [pull_action("build_table2", "save_betas")],
+        "file_dep": [*TABLE2_MODULE_DEPS, TABLE2_DIR / "regression_input.parquet"],
+        "targets": [TABLE2_DIR / "betas.parquet"],
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
+def task_table2_panels():
+    """
+    Compute Panels A, B and C of Table 2 from the betas
+    """
+    for panel in ["A", "B", "C"]:
+        yield {
+            "name": panel,
+            "actions": [pull_action("build_table2", "save_table2_panel", panel=panel)],
+            "file_dep": [*TABLE2_MODULE_DEPS, TABLE2_DIR / "betas.parquet"],
+            "targets": [TABLE2_DIR / f"panel_{panel}.parquet"],
+            "clean": True,
+            "verbosity": 2,
+        }
+
+
+def task_latex_tables():
+    """
+    Write the LaTeX tables of Table 1 and of Panels A, B and C
+    """
+    file_dep = [
+        *TABLE2_MODULE_DEPS,
+        "./src/build_main_sample.py",
+        # Table 1 applies the filters of `build_main_sample` to the main sample
+        OUTPUT_DIR / "main_sample.parquet",
+        *[TABLE2_DIR / f"panel_{panel}.parquet" for panel in ["A", "B", "C"]],
+    ]
+    return {
+        "actions": [pull_action("build_table2", "export_latex")],
+        "file_dep": file_dep,
+        "targets": [
+            OUTPUT_DIR / file for file in [
+                "table1_complete.tex",
+                "table_panelA.tex",
+                "table_panelB.tex",
+                "table_panelC.tex",
+            ]
+        ],
+        "clean": True,
+        "verbosity": 2,
+    }
+
+
 ## Helper functions for automatic execution of Jupyter notebooks
 def jupyter_execute_notebook(notebook):
     return f"jupyter nbconvert --execute --to notebook --ClearMetadataPreprocessor.enabled=True --inplace ./src/{notebook}.ipynb"
@@ -178,6 +422,10 @@ def task_compile_latex_docs():
         "./reports/project_writeup.tex", 
         "./output/_02_raw_data_walkthrough.py",  
         "./output/_03_fama_french.py",
+        OUTPUT_DIR / "table1_complete.tex",
+        OUTPUT_DIR / "table_panelA.tex",
+        OUTPUT_DIR / "table_panelB.tex",
+        OUTPUT_DIR / "table_panelC.tex",
     ]
     file_output = [
         "./output/project_writeup.pdf", 
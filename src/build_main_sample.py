@@ -0,0 +1,508 @@
+"""
+Build the Table 1 main sample without Jupyter
+
+- Runs the sample construction of `02_raw_data_walkthrough.ipynb` as explicit
+  stages: CRSP clean (yearly returns and December TNA by wficn), S12 link
+  (holdings linked to wficn through MFLINK2), fund-year reduction (one S12
+  record per wficn and year), merge of the two, and the Table 1 filters.
+- Each stage is cached in `data_dir / "intermediate"` (see
+  `cache_tools.cached_parquet`), keyed by its own code and parameters, the
+  modules it calls, and the pulled files or the keys of the stages it reads
+  (see `stage_key`), so a rerun only rebuilds the stages whose inputs changed.
+- `STAGES` lists the stages in order, with their inputs (from
+  `main_sample_stages`, which `dodo.py` reads as well).
+- `sweep_filters` evaluates grids of filter thresholds in one call, and gives
+  the yearly counts, mean and median TNA and return of every configuration.
+- `build_main_sample` writes `OUTPUT_DIR / "main_sample.parquet"` (the merged
+  sample, before the filters, as the notebook does), which
+  `factor_betas_calculation.monthly_mutual_fund` reads.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import inspect
+import logging
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config
+from cache_tools import cache_key, cached_parquet
+from load_CRSP_fund import load_CRSP_combined_file
+from load_mflink import link_crsp_wficn, load_mflink1_index, load_mflink2_intervals, resolve_s12_wficn
+from load_s12 import load_s12_file
+from main_sample_stages import STAGE_INPUTS
+from parquet_tools import write_parquet
+from return_tools import compound_returns
+
+DATA_DIR = Path(config.DATA_DIR)
+OUTPUT_DIR = Path(config.OUTPUT_DIR)
+
+# Table 1 filters: year-end CRSP TNA (in $ millions) above MIN_TNA, CRSP over S12 TNA
+# strictly within TNA_RATIO, and either equity ratio within EQ_RATIO (inclusive)
+MIN_TNA = 1
+TNA_RATIO = (0.5, 2)
+EQ_RATIO = (0.8, 1.05)
+
+logger = logging.getLogger(__name__)
+
+
+def _pulled(data_dir: Path, name: str) -> Path:
+    """The pulled dataset `name`, or its monolithic `name.parquet` from an older pull"""
+    path = Path(data_dir) / "pulled" / name
+    return path if path.exists() else path.with_suffix(".parquet")
+
+
+def stage_key(
+    stage: str,
+    data_dir: Path = DATA_DIR,
+    params: dict = None,
+) -> tuple:
+    """
+    Inputs and parameters a stage of `STAGES` is cached under
+
+    A stage is keyed by the source of the functions of this module that build
+    it, the modules it calls, its own parameters, and either the pulled files
+    it reads or the keys of the stages it reads. Changing a filter threshold
+    thus only invalidates the filter stage, and changing a loader only the
+    stages that call it (and the ones downstream of them).
+
+    Args:
+    - stage: str, name of the stage
+    - data_dir: Path, root data directory
+    - params: dict, parameters of the stage (e.g. the filter thresholds)
+
+    Returns:
+    - inputs: list of Path, for `cache_tools.cached_parquet`, or None if a
+      pulled file of the stage or of a stage it reads does not exist yet
+    - params: dict, for `cache_tools.cached_parquet`
+    """
+    spec = STAGES[stage]
+    inputs = [_pulled(data_dir, name) for name in spec["pulled"]]
+    inputs += [Path(__file__).with_name(module) for module in spec["modules"]]
+    if not all(path.exists() for path in inputs):
+        return None, None
+
+    reads = {}
+    for upstream in spec["reads"]:
+        upstream_inputs, upstream_params = stage_key(upstream, data_dir)
+        if upstream_inputs is None:
+            return None, None
+        reads[upstream] = cache_key(upstream_inputs, upstream_params)
+    code = [inspect.getsource(func) for func in spec["code"]]
+    return inputs, {"code": code, "reads": reads, **(params or {})}
+
+
+def _cached_stage(stage, build, data_dir, use_cache, params=None):
+    inputs, params = stage_key(stage, data_dir, params)
+    if inputs is None:
+        return build()
+    return cached_parquet(
+        f"main_sample_{stage}",
+        build,
+        inputs=inputs,
+        params=params,
+        cache_dir=Path(data_dir) / "intermediate",
+        use_cache=use_cache,
+    )
+
+
+def crsp_clean(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    Yearly return and December TNA of each wficn in CRSP
+
+    Share classes are linked to wficn through MFLINK1, with the lowest wficn
+    for those it links to several (see `load_mflink.load_mflink1_index`), as in
+    `factor_betas_calculation.monthly_mutual_fund`. Monthly returns are
+    averaged across share classes (missing returns as 0) and compounded within
+    the year (see `return_tools.compound_returns`); `crsp_tna` is the December
+    TNA summed across share classes. Only fund-years with a December
+    observation are kept.
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to force a rebuild
+
+    Returns:
+    - df_crsp_clean: pd.DataFrame, with columns wficn, year, crsp_tna, yret
+    """
+    data_dir = Path(data_dir)
+    return _cached_stage("crsp_clean", lambda: _build_crsp_clean(data_dir), data_dir, use_cache)
+
+
+def _build_crsp_clean(data_dir):
+    df_crsp = load_CRSP_combined_file(
+        data_dir, columns=["crsp_fundno", "caldt", "mret", "mtna"], compact=True, dtype_backend="numpy"
+    )
+    df_crsp["wficn"], n_ambiguous = link_crsp_wficn(df_crsp["crsp_fundno"], load_mflink1_index(data_dir))
+    logger.info("Share-class months linked to several wficn in MFLINK1: %d", n_ambiguous)
+
+    df_crsp = df_crsp.sort_values(["caldt", "wficn"])
+    df_crsp = df_crsp[df_crsp['wficn'].notnull()]
+    df_crsp = df_crsp.assign(
+        year=df_crsp['caldt'].dt.year.astype('int'),
+        month=df_crsp['caldt'].dt.month.astype('int'),
+        wficn=df_crsp['wficn'].astype('int'),
+        mret=df_crsp['mret'].fillna(0),
+    )
+
+    df_ret = df_crsp.groupby(["wficn", "year", "month"])["mret"].mean().reset_index()
+    df_ret["caldt"] = pd.to_datetime(df_ret[["year", "month"]].assign(day=1))
+    df_year = compound_returns(df_ret)["year"]
+    # Fund-years without a December observation have no year-end TNA
+    df_year = df_year[df_year["last_month"] == 12]
+    df_ret = df_year.rename(columns={"ret": "yret"})
+
+    df_tna = (
+        df_crsp.query("month==12").groupby(["wficn", "year"])["mtna"].sum()
+        .reset_index().rename(columns={"mtna": "crsp_tna"})
+    )
+    return pd.merge(df_tna, df_ret)[['wficn', 'year', 'crsp_tna', 'yret']]
+
+
+def s12_link(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    S12 holdings linked to wficn
+
+    Each report date is linked to the wficn of the nearest MFLINK2 date of its
+    fundno (see `load_mflink.resolve_s12_wficn`); holdings that cannot be linked
+    are dropped. Missing `assets` are set to 0, so that `fund_year` can group on them.
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to force a rebuild
+
+    Returns:
+    - df_s12: pd.DataFrame, with columns fdate, year, wficn, assets, useq_tna_k
+    """
+    data_dir = Path(data_dir)
+    return _cached_stage("s12_link", lambda: _build_s12_link(data_dir), data_dir, use_cache)
+
+
+def _build_s12_link(data_dir):
+    df_s12 = load_s12_file(
+        data_dir, columns=["fdate", "fundno", "assets", "useq_tna_k"], compact=True, dtype_backend="numpy"
+    )
+    df_s12 = df_s12.assign(year=df_s12["fdate"].dt.year.astype("int"))
+    df_s12["wficn"], _ = resolve_s12_wficn(df_s12, load_mflink2_intervals(data_dir))
+    df_s12 = df_s12[df_s12['wficn'].notnull()]
+    df_s12 = df_s12.assign(assets=df_s12['assets'].fillna(0))
+    return df_s12[["fdate", "year", "wficn", "assets", "useq_tna_k"]]
+
+
+def fund_year(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    One S12 record per wficn and year
+
+    Holdings are summed by (fdate, wficn, assets), and the last non-missing
+    `assets` and `useq_tna_k` of each (wficn, year) are kept.
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to force a rebuild
+
+    Returns:
+    - df_eq: pd.DataFrame, with columns wficn, year, assets, useq_tna_k
+    """
+    data_dir = Path(data_dir)
+    return _cached_stage("fund_year", lambda: _build_fund_year(data_dir, use_cache), data_dir, use_cache)
+
+
+def _build_fund_year(data_dir, use_cache):
+    df_s12 = s12_link(data_dir, use_cache)
+    df_eq = df_s12.groupby(['year', 'fdate', 'wficn', 'assets'])['useq_tna_k'].sum().reset_index()
+    df_eq['assets'] = np.where(df_eq['assets'] == 0, np.nan, df_eq['assets'])
+    return df_eq.groupby(['wficn', 'year'])[['assets', 'useq_tna_k']].last().reset_index()
+
+
+def merge_sample(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    Merge the CRSP and S12 fund-years into the main sample, before the filters
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to force a rebuild
+
+    Returns:
+    - df_combo: pd.DataFrame, with columns wficn, year, crsp_tna, yret, assets, useq_tna_k, sorted by year
+    """
+    data_dir = Path(data_dir)
+    return _cached_stage("merge", lambda: _build_merge_sample(data_dir, use_cache), data_dir, use_cache)
+
+
+def _build_merge_sample(data_dir, use_cache):
+    df_crsp_clean = crsp_clean(data_dir, use_cache)
+    df_eq = fund_year(data_dir, use_cache)
+    return pd.merge(df_crsp_clean, df_eq, on=["wficn", "year"], how="inner").sort_values("year")
+
+
+def filter_sample(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+    min_tna: float = MIN_TNA,
+    tna_ratio: tuple = TNA_RATIO,
+    eq_ratio: tuple = EQ_RATIO,
+) -> pd.DataFrame:
+    """
+    Apply the Table 1 filters to the main sample
+
+    Fund-years without S12 `assets` are given a TNA ratio and an S12 equity
+    ratio of 1 (see `filter_ratios`). `sweep_filters` gives the yearly
+    statistics for grids of thresholds in one call.
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to force a rebuild
+    - min_tna: float, year-end CRSP TNA must be above it, in $ millions
+    - tna_ratio: tuple, (low, high) exclusive bounds of CRSP over S12 TNA
+    - eq_ratio: tuple, (low, high) inclusive bounds; either equity ratio (equity
+      holdings over the CRSP or over the S12 TNA) must be within them
+
+    Returns:
+    - df_combo: pd.DataFrame, the filtered sample with columns tna_ratio, eq_ratio_1 and eq_ratio_2 added
+    """
+    data_dir = Path(data_dir)
+    return _cached_stage(
+        "filters",
+        lambda: _build_filter_sample(data_dir, use_cache, min_tna, tna_ratio, eq_ratio),
+        data_dir,
+        use_cache,
+        params={"min_tna": min_tna, "tna_ratio": list(tna_ratio), "eq_ratio": list(eq_ratio)},
+    )
+
+
+def _build_filter_sample(data_dir, use_cache, min_tna, tna_ratio, eq_ratio):
+    df_combo = merge_sample(data_dir, use_cache)
+    df_combo = df_combo.assign(**filter_ratios(df_combo))
+    keep, _ = filter_masks(df_combo, [min_tna], [tna_ratio], [eq_ratio])
+    return df_combo[keep[0]]
+
+
+def filter_ratios(df_combo: pd.DataFrame) -> dict:
+    """
+    Ratios the Table 1 filters are applied to
+
+    Fund-years without S12 `assets` are given a TNA ratio and an S12 equity ratio of 1.
+
+    Args:
+    - df_combo: pd.DataFrame, from `merge_sample`
+
+    Returns:
+    - ratios: dict of np.ndarray, `tna_ratio` (CRSP over S12 TNA), `eq_ratio_1`
+      (equity holdings over CRSP TNA) and `eq_ratio_2` (over S12 TNA)
+    """
+    crsp_tna = df_combo["crsp_tna"].to_numpy(dtype="float64")
+    assets = df_combo["assets"].to_numpy(dtype="float64")
+    useq_tna_k = df_combo["useq_tna_k"].to_numpy(dtype="float64")
+    no_assets = np.isnan(assets)
+    # Zero TNA give infinite ratios, which no filter keeps
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return {
+            "tna_ratio": np.where(no_assets, 1, crsp_tna * 1e6 / assets / 1e4),
+            "eq_ratio_1": useq_tna_k * 1e3 / (crsp_tna * 1e6),
+            "eq_ratio_2": np.where(no_assets, 1, useq_tna_k * 1e3 / (assets * 1e4)),
+        }
+
+
+def filter_masks(
+    df_combo: pd.DataFrame,
+    min_tna: list = (MIN_TNA,),
+    tna_ratio: list = (TNA_RATIO,),
+    eq_ratio: list = (EQ_RATIO,),
+) -> tuple:
+    """
+    Rows of the main sample kept by every combination of filter thresholds
+
+    Each filter is evaluated once per threshold over the whole sample, and the
+    combinations are broadcast from them.
+
+    Args:
+    - df_combo: pd.DataFrame, from `merge_sample`
+    - min_tna: list of float, thresholds of year-end CRSP TNA, in $ millions
+    - tna_ratio: list of (low, high), exclusive bounds of the TNA ratio
+    - eq_ratio: list of (low, high), inclusive bounds of the equity ratios
+
+    Returns:
+    - masks: np.ndarray, bool (configurations x rows of df_combo)
+    - configs: pd.DataFrame, one row per configuration, with columns min_tna,
+      tna_ratio_low, tna_ratio_high, eq_ratio_low, eq_ratio_high
+    """
+    ratios = filter_ratios(df_combo)
+    min_tna = np.asarray(min_tna, dtype="float64").reshape(-1)
+    tna_bounds = np.asarray(tna_ratio, dtype="float64").reshape(-1, 2)
+    eq_bounds = np.asarray(eq_ratio, dtype="float64").reshape(-1, 2)
+
+    tna_mask = df_combo["crsp_tna"].to_numpy(dtype="float64") > min_tna[:, None]
+    ratio_mask = (ratios["tna_ratio"] > tna_bounds[:, :1]) & (ratios["tna_ratio"] < tna_bounds[:, 1:])
+    eq_mask = (
+        ((ratios["eq_ratio_1"] >= eq_bounds[:, :1]) & (ratios["eq_ratio_1"] <= eq_bounds[:, 1:]))
+        | ((ratios["eq_ratio_2"] >= eq_bounds[:, :1]) & (ratios["eq_ratio_2"] <= eq_bounds[:, 1:]))
+    )
+    masks = tna_mask[:, None, None] & ratio_mask[None, :, None] & eq_mask[None, None, :]
+
+    i, j, k = (idx.ravel() for idx in np.indices(masks.shape[:3]))
+    configs = pd.DataFrame({
+        "min_tna": min_tna[i],
+        "tna_ratio_low": tna_bounds[j, 0],
+        "tna_ratio_high": tna_bounds[j, 1],
+        "eq_ratio_low": eq_bounds[k, 0],
+        "eq_ratio_high": eq_bounds[k, 1],
+    })
+    return masks.reshape(len(configs), len(df_combo)), configs
+
+
+def _masked_medians(values, codes, n_groups, masks):
+    """Median of `values` by group code, for the rows of each mask (configurations x rows)"""
+    order = np.lexsort((values, codes))
+    values, codes = values[order], codes[order]
+    selected = masks[:, order] & ~np.isnan(values)
+    n_configs, n_rows = selected.shape
+
+    # Selected rows up to each row, and before the first row of each group
+    cum_count = np.cumsum(selected, axis=1, dtype="int64")
+    bounds = np.searchsorted(codes, np.arange(n_groups + 1))
+    before = np.concatenate([np.zeros((n_configs, 1), dtype="int64"), cum_count], axis=1)[:, bounds]
+    count = np.diff(before, axis=1)
+
+    # Rows are sorted by value within groups, so the k-th selected row of a group is
+    # the first row whose cumulative count reaches before + k. Offsetting each
+    # configuration keeps the flattened counts sorted for a single searchsorted.
+    offset = np.arange(n_configs)[:, None] * (n_rows + 1)
+    flat = (cum_count + offset).ravel()
+
+    def kth(k):
+        target = before[:, :-1] + np.maximum(k, 0) + 1 + offset
+        pos = np.searchsorted(flat, target.ravel()).reshape(target.shape) - np.arange(n_configs)[:, None] * n_rows
+        return values[np.clip(pos, 0, max(n_rows - 1, 0))] if n_rows else np.full(target.shape, np.nan)
+
+    median = (kth((count - 1) // 2) + kth(count // 2)) / 2
+    return np.where(count > 0, median, np.nan)
+
+
+def sweep_filters(
+    min_tna: list = (MIN_TNA,),
+    tna_ratio: list = (TNA_RATIO,),
+    eq_ratio: list = (EQ_RATIO,),
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+    df_combo: pd.DataFrame = None,
+) -> pd.DataFrame:
+    """
+    Yearly Table 1 statistics for every combination of filter thresholds
+
+    Evaluates all the combinations of the threshold grids at once over the
+    merged sample (see `filter_masks`), instead of filtering it once per
+    combination. The statistics of a configuration are those of `filter_sample`
+    with the same thresholds, grouped by year.
+
+    Args:
+    - min_tna: list of float, thresholds of year-end CRSP TNA, in $ millions
+    - tna_ratio: list of (low, high), exclusive bounds of the TNA ratio
+    - eq_ratio: list of (low, high), inclusive bounds of the equity ratios
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to rebuild the merged sample
+    - df_combo: pd.DataFrame, merged sample to filter. Read with `merge_sample` if None.
+
+    Returns:
+    - df_sweep: pd.DataFrame, one row per configuration and year (including years
+      with no fund left), with the threshold columns of `filter_masks`, year,
+      count, and the mean and median of crsp_tna and yret
+    """
+    if df_combo is None:
+        df_combo = merge_sample(data_dir, use_cache=use_cache)
+    masks, configs = filter_masks(df_combo, min_tna, tna_ratio, eq_ratio)
+    years, codes = np.unique(df_combo["year"].to_numpy(), return_inverse=True)
+    n_configs, n_years = len(configs), len(years)
+    one_hot = np.zeros((len(df_combo), n_years))
+    one_hot[np.arange(len(df_combo)), codes] = 1
+
+    df_sweep = configs.loc[np.repeat(np.arange(n_configs), n_years)].reset_index(drop=True)
+    df_sweep["year"] = np.tile(years, n_configs)
+    df_sweep["count"] = (masks.astype("float64") @ one_hot).astype("int64").ravel()
+    for col in ["crsp_tna", "yret"]:
+        values = df_combo[col].to_numpy(dtype="float64")
+        valid = masks & ~np.isnan(values)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = (valid * np.nan_to_num(values)) @ one_hot / (valid.astype("float64") @ one_hot)
+        df_sweep[f"{col}_mean"] = mean.ravel()
+        df_sweep[f"{col}_median"] = _masked_medians(values, codes, n_years, masks).ravel()
+    return df_sweep
+
+
+# Stages in build order: the function building each and the functions of this module
+# its result depends on. The modules they call and what they read (pulled datasets or
+# earlier stages) are in `main_sample_stages.STAGE_INPUTS`.
+STAGE_CODE = {
+    "crsp_clean": (crsp_clean, [_build_crsp_clean]),
+    "s12_link": (s12_link, [_build_s12_link]),
+    "fund_year": (fund_year, [_build_fund_year]),
+    "merge": (merge_sample, [_build_merge_sample]),
+    "filters": (filter_sample, [_build_filter_sample, filter_ratios, filter_masks]),
+}
+STAGES = {
+    stage: {"build": STAGE_CODE[stage][0], "code": STAGE_CODE[stage][1], **inputs}
+    for stage, inputs in STAGE_INPUTS.items()
+}
+
+
+def run_stage(
+    stage: str,
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> pd.DataFrame:
+    """
+    Build (or load from the cache) one stage of `STAGES`
+
+    Args:
+    - stage: str, name of the stage
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to rebuild the stage and the stages it reads
+
+    Returns:
+    - df: pd.DataFrame, output of the stage
+    """
+    if stage not in STAGES:
+        raise ValueError(f"Unknown stage: {stage!r} (stages: {', '.join(STAGES)})")
+    return STAGES[stage]["build"](data_dir, use_cache=use_cache)
+
+
+def build_main_sample(
+    data_dir: Path = DATA_DIR,
+    output_dir: Path = OUTPUT_DIR,
+    use_cache: bool = True,
+    save: bool = True,
+) -> pd.DataFrame:
+    """
+    Build the main sample (before the Table 1 filters) and save it as `main_sample.parquet`
+
+    Args:
+    - data_dir: Path, root data directory
+    - output_dir: Path, where `main_sample.parquet` is written
+    - use_cache: bool, set to False to rebuild every stage
+    - save: bool, write `main_sample.parquet`
+
+    Returns:
+    - df_combo: pd.DataFrame, with columns wficn, year, crsp_tna, yret, assets, useq_tna_k
+    """
+    df_combo = merge_sample(data_dir, use_cache=use_cache)
+    if save:
+        Path(output_dir).mkdir(parents=True, exist_ok=True)
+        write_parquet(df_combo, Path(output_dir) / "main_sample.parquet")
+    return df_combo
+
+
+if __name__ == "__main__":
+    build_main_sample(DATA_DIR, OUTPUT_DIR)
@@ -0,0 +1,134 @@
+"""
+Build the Table 1 and Table 2 outputs stage by stage without Jupyter
+
+- Each stage reads the file written by the stage before it and writes its own
+  result to a fixed path (`STAGE_FILES`), so `dodo.py` can give every stage
+  its exact `file_dep` and `targets`, and only rerun the stages downstream of
+  a change.
+- The stages are: the monthly fund panel (`monthly_mutual_fund`), the
+  regression input (`regression_df`, merged with the factors), the rolling
+  betas of every fund group (`group_betas`), Panels A, B and C, and the LaTeX
+  tables in `OUTPUT_DIR`.
+- The main sample they start from is built by `build_main_sample`.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+from pathlib import Path
+
+import pandas as pd
+
+import config
+from build_main_sample import filter_sample
+from factor_betas_calculation import (
+    calc_penal_A,
+    calc_penal_B,
+    calc_penal_C,
+    fama_french_factors,
+    group_betas,
+    monthly_mutual_fund,
+    regression_df,
+)
+from panel_tools import PANEL_CATEGORIES
+from parquet_tools import write_parquet
+
+DATA_DIR = Path(config.DATA_DIR)
+OUTPUT_DIR = Path(config.OUTPUT_DIR)
+
+STAGE_DIR = DATA_DIR / "intermediate" / "table2"
+STAGE_FILES = {
+    "monthly_fund_panel": STAGE_DIR / "monthly_fund_panel.parquet",
+    "regression_input": STAGE_DIR / "regression_input.parquet",
+    "betas": STAGE_DIR / "betas.parquet",
+    "panel_A": STAGE_DIR / "panel_A.parquet",
+    "panel_B": STAGE_DIR / "panel_B.parquet",
+    "panel_C": STAGE_DIR / "panel_C.parquet",
+}
+PANEL_FUNCTIONS = {"A": calc_penal_A, "B": calc_penal_B, "C": calc_penal_C}
+# LaTeX table written from each output, as in the notebooks
+LATEX_FILES = {
+    "table1": OUTPUT_DIR / "table1_complete.tex",
+    "panel_A": OUTPUT_DIR / "table_panelA.tex",
+    "panel_B": OUTPUT_DIR / "table_panelB.tex",
+    "panel_C": OUTPUT_DIR / "table_panelC.tex",
+}
+
+
+def _save(df, stage):
+    path = STAGE_FILES[stage]
+    path.parent.mkdir(parents=True, exist_ok=True)
+    write_parquet(df, path)
+
+
+def save_monthly_fund_panel() -> None:
+    """Write the monthly fund panel of the main sample (see `monthly_mutual_fund`)"""
+    _save(monthly_mutual_fund(), "monthly_fund_panel")
+
+
+def save_regression_input(start: int = 198001, end: int = 201912) -> None:
+    """
+    Write the regression panel: the monthly fund panel merged with the factors, and flows
+
+    Args:
+    - start: int, first month of the factors as YYYYMM
+    - end: int, last month of the factors as YYYYMM
+    """
+    df_crsp = pd.read_parquet(STAGE_FILES["monthly_fund_panel"])
+    df_ff = fama_french_factors(start, end, panel_dates=df_crsp["date"])
+    df_reg = regression_df(df_crsp, df_ff)
+    # Missing classes and flags are filled with 0 among strings; the fund groups
+    # match them as strings anyway, and parquet needs one type per column
+    df_reg = df_reg.astype({col: str for col in PANEL_CATEGORIES if df_reg[col].dtype == object})
+    _save(df_reg, "regression_input")
+
+
+def save_betas() -> None:
+    """Write the rolling betas of every fund group of Table 2 (see `group_betas`)"""
+    df_reg = pd.read_parquet(STAGE_FILES["regression_input"])
+    _save(group_betas(df_reg), "betas")
+
+
+def save_table2_panel(panel: str) -> None:
+    """
+    Write Panel A, B or C of Table 2 from the saved betas
+
+    Args:
+    - panel: str, "A", "B" or "C"
+    """
+    betas = pd.read_parquet(STAGE_FILES["betas"])
+    _save(PANEL_FUNCTIONS[panel](None, betas=betas), f"panel_{panel}")
+
+
+def table1_stats(df_combo: pd.DataFrame) -> pd.DataFrame:
+    """
+    Yearly mean and median TNA and return of the filtered main sample, as in Table 1
+
+    Args:
+    - df_combo: pd.DataFrame, from `build_main_sample.filter_sample`
+
+    Returns:
+    - df_complete: pd.DataFrame, rounded to two decimals
+    """
+    return df_combo.groupby("year")[["crsp_tna", "yret"]].agg(["mean", "median"]).reset_index().round(2)
+
+
+def export_latex() -> None:
+    """Write the LaTeX tables of Table 1 and of Panels A, B and C to `OUTPUT_DIR`"""
+    float_format_func = lambda x: '{:.2f}'.format(x)
+    tables = {
+        "table1": table1_stats(filter_sample()).rename(columns={'crsp_tna': '$crsp_{TNA}$'}),
+        **{f"panel_{panel}": pd.read_parquet(STAGE_FILES[f"panel_{panel}"]) for panel in PANEL_FUNCTIONS},
+    }
+    for name, df in tables.items():
+        path = LATEX_FILES[name]
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(df.to_latex(float_format=float_format_func))
+
+
+if __name__ == "__main__":
+    save_monthly_fund_panel()
+    save_regression_input()
+    save_betas()
+    for panel in PANEL_FUNCTIONS:
+        save_table2_panel(panel)
+    export_latex()
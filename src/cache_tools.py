@@ -0,0 +1,315 @@
+"""
+Functions to cache intermediate results on disk
+
+- Results are stored as parquet files (or `.npz` files for dicts of arrays)
+  in `DATA_DIR / "intermediate"`.
+- Each cache file is keyed by a hash of the contents of its input files and
+  of the parameters used to build it, so changed inputs invalidate it automatically.
+- File hashes are memoized on (size, mtime), so unchanged files are hashed only
+  once per process. Pulled datasets are hashed through their `_manifest.json`,
+  which lists the hash of each of their files, unless their files changed since.
+- `memoize_load` keeps the frames returned by the `load_*` functions in
+  memory, in a least-recently-used cache bounded by `LOAD_CACHE_MAX_MB`. An
+  entry is reused only while the contents of every file it was read from are
+  unchanged. Callers get read-only views of the cached frames, which share
+  their memory: adding or replacing columns works, in-place writes raise.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import functools
+import hashlib
+import inspect
+import json
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config
+from dtype_tools import backend_kwargs
+from parquet_tools import MANIFEST_NAME, write_parquet
+
+DATA_DIR = Path(config.DATA_DIR)
+CACHE_DIR = DATA_DIR / "intermediate"
+LOAD_CACHE_MAX_MB = config.LOAD_CACHE_MAX_MB
+
+_FILE_DIGESTS = {}
+
+_LOADED = OrderedDict()  # key -> (df, nbytes), least recently used first
+_LOADED_BYTES = 0
+_LOADED_LOCK = threading.Lock()
+
+
+def file_digest(path: Path) -> str:
+    """
+    Hash the contents of a file, or of every file under a directory
+
+    A dataset directory whose `_manifest.json` is current (see
+    `manifest_is_current`) is hashed through its manifest, which already holds
+    the hash of each file, so its files are not read again. Other directories
+    hash every file they contain.
+
+    Args:
+    - path: Path, file or directory (e.g. a partitioned parquet dataset)
+
+    Returns:
+    - digest: str, hex sha256 digest
+    """
+    path = Path(path)
+    if path.is_dir() and manifest_is_current(path):
+        return file_digest(path / MANIFEST_NAME)
+    if path.is_dir():
+        h = hashlib.sha256()
+        for file in sorted(p for p in path.rglob("*") if p.is_file()):
+            h.update(str(file.relative_to(path)).encode())
+            h.update(file_digest(file).encode())
+        return h.hexdigest()
+
+    stat = path.stat()
+    memo_key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _FILE_DIGESTS:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _FILE_DIGESTS[memo_key] = h.hexdigest()
+    return _FILE_DIGESTS[memo_key]
+
+
+def manifest_is_current(path: Path) -> bool:
+    """
+    Whether the manifest of a dataset still describes its files
+
+    Only file names and mtimes are checked: the manifest must list exactly the
+    parquet files of the dataset, none of which may be newer than it. This
+    holds for datasets written through `parquet_tools.staged_dataset`, which
+    rewrites the manifest last.
+
+    Args:
+    - path: Path, dataset directory
+
+    Returns:
+    - current: bool, False if there is no manifest
+    """
+    manifest = Path(path) / MANIFEST_NAME
+    if not manifest.exists():
+        return False
+    manifest_mtime = manifest.stat().st_mtime_ns
+    files = {file.relative_to(path).as_posix(): file for file in Path(path).rglob("*.parquet")}
+    if set(files) != set(json.loads(manifest.read_text())):
+        return False
+    return all(file.stat().st_mtime_ns <= manifest_mtime for file in files.values())
+
+
+def cache_key(inputs: list, params: dict = None) -> str:
+    """
+    Build a cache key from the parameters and the hashes of the input files
+
+    Args:
+    - inputs: list of Path, files or directories the result depends on
+    - params: dict, JSON-serializable parameters the result depends on
+
+    Returns:
+    - key: str, "<params digest>_<inputs digest>"
+    """
+    params_digest = hashlib.sha256(
+        json.dumps(params or {}, sort_keys=True, default=str).encode()
+    ).hexdigest()
+    h = hashlib.sha256()
+    for path in inputs:
+        h.update(file_digest(path).encode())
+    return f"{params_digest[:8]}_{h.hexdigest()[:16]}"
+
+
+def cached_parquet(
+    name: str,
+    build,
+    inputs: list,
+    params: dict = None,
+    cache_dir: Path = CACHE_DIR,
+    use_cache: bool = True,
+    dtype_backend: str = "numpy",
+) -> pd.DataFrame:
+    """
+    Return `build()` from a parquet cache keyed by the inputs and parameters
+
+    If any input does not exist yet (e.g. it is pulled by `build` itself), the
+    result is built without caching.
+
+    Args:
+    - name: str, prefix of the cache file name
+    - build: callable, returns the pd.DataFrame to cache
+    - inputs: list of Path, files or directories the result depends on
+    - params: dict, JSON-serializable parameters the result depends on
+    - cache_dir: Path, directory holding the cache files
+    - use_cache: bool, set to False to always rebuild (the cache is still refreshed)
+    - dtype_backend: str, dtypes the cached result is read back with. For
+      "numpy_nullable" and "pyarrow", a fresh result is also read back from the
+      cache file, so that hits and misses return the same dtypes.
+
+    Returns:
+    - df: pd.DataFrame
+    """
+    if not all(Path(path).exists() for path in inputs):
+        return build()
+
+    cache_dir = Path(cache_dir)
+    key = cache_key(inputs, params)
+    path = cache_dir / f"{name}_{key}.parquet"
+    read_kwargs = backend_kwargs(dtype_backend)
+    if use_cache and path.exists():
+        return pd.read_parquet(path, **read_kwargs)
+
+    df = build()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    # Drop results built from older versions of the inputs with the same parameters
+    params_digest = key.split("_")[0]
+    for stale in cache_dir.glob(f"{name}_{params_digest}_*.parquet"):
+        stale.unlink()
+    write_parquet(df, path)
+    if read_kwargs:
+        df = pd.read_parquet(path, **read_kwargs)
+    return df
+
+
+def cached_arrays(
+    name: str,
+    build,
+    inputs: list,
+    params: dict = None,
+    cache_dir: Path = CACHE_DIR,
+    use_cache: bool = True,
+) -> dict:
+    """
+    Return `build()` from an `.npz` cache keyed by the inputs and parameters
+
+    Same as `cached_parquet`, for results that are a dict of NumPy arrays.
+
+    Args:
+    - name: str, prefix of the cache file name
+    - build: callable, returns the dict of np.ndarray to cache
+    - inputs: list of Path, files or directories the result depends on
+    - params: dict, JSON-serializable parameters the result depends on
+    - cache_dir: Path, directory holding the cache files
+    - use_cache: bool, set to False to always rebuild (the cache is still refreshed)
+
+    Returns:
+    - arrays: dict of np.ndarray
+    """
+    if not all(Path(path).exists() for path in inputs):
+        return build()
+
+    cache_dir = Path(cache_dir)
+    key = cache_key(inputs, params)
+    path = cache_dir / f"{name}_{key}.npz"
+    if use_cache and path.exists():
+        with np.load(path) as npz:
+            return {k: npz[k] for k in npz.files}
+
+    arrays = build()
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    params_digest = key.split("_")[0]
+    for stale in cache_dir.glob(f"{name}_{params_digest}_*.npz"):
+        stale.unlink()
+    np.savez(path, **arrays)
+    return arrays
+
+
+def clear_load_cache() -> None:
+    """Drop every frame memoized by `memoize_load`"""
+    global _LOADED_BYTES
+    with _LOADED_LOCK:
+        _LOADED.clear()
+        _LOADED_BYTES = 0
+
+
+def _freeze(df):
+    # Mark the NumPy buffers of every block read-only (for extension arrays, the
+    # ones they wrap), so that in-place writes through a view raise
+    for block in df._mgr.blocks:
+        values = block.values
+        for array in [values, *(getattr(values, attr, None) for attr in ("_ndarray", "_data", "_mask", "_codes"))]:
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+
+
+def _read_only_view(df):
+    # The blocks are shared with the cached frame. Arrow buffers are immutable, but
+    # in-place writes replace the array held by their wrapper, so each view gets its own.
+    view = df.copy(deep=False)
+    for i, dtype in enumerate(df.dtypes):
+        if isinstance(dtype, pd.ArrowDtype) or getattr(dtype, "storage", None) == "pyarrow":
+            view.isetitem(i, view.iloc[:, i].array.copy())
+    return view
+
+
+def memoize_load(*pulled_names, max_mb: float = None):
+    """
+    Memoize a `load_*` function in memory, keyed by its arguments and input files
+
+    The decorated function must take a `data_dir` argument. Its result is cached
+    per set of arguments together with the hashes of the files under
+    `data_dir / "pulled"` named by `pulled_names` (see `file_digest`), so a new
+    pull with different data invalidates the entry. If none of them exist yet,
+    the function runs without caching (it may pull the data itself).
+
+    Every call returns a read-only view of the cached frame, without copying its
+    data: columns can be added, replaced or dropped, but in-place writes (e.g.
+    `df.loc[...] = ...` or `fillna(inplace=True)`) raise a ValueError, so take a
+    `.copy()` first. Frames larger than the bound are returned as loaded.
+
+    Args:
+    - pulled_names: str, file or dataset names under `data_dir / "pulled"` the function reads
+    - max_mb: float, bound on the total size of memoized frames, shared by every
+      memoized function. Defaults to `LOAD_CACHE_MAX_MB`; 0 disables memoization.
+
+    Returns:
+    - decorator
+    """
+    def decorator(load):
+        signature = inspect.signature(load)
+
+        @functools.wraps(load)
+        def wrapper(*args, **kwargs):
+            global _LOADED_BYTES
+            limit = (LOAD_CACHE_MAX_MB if max_mb is None else max_mb) * 2**20
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            pulled_dir = Path(bound.arguments["data_dir"]) / "pulled"
+            paths = [pulled_dir / name for name in pulled_names]
+            if limit <= 0 or not any(path.exists() for path in paths):
+                return load(*args, **kwargs)
+
+            key = (
+                load.__module__,
+                load.__qualname__,
+                json.dumps(bound.arguments, sort_keys=True, default=repr),
+                tuple(file_digest(path) if path.exists() else None for path in paths),
+            )
+            with _LOADED_LOCK:
+                if key in _LOADED:
+                    _LOADED.move_to_end(key)
+                    return _read_only_view(_LOADED[key][0])
+
+            df = load(*args, **kwargs)
+            nbytes = int(df.memory_usage(deep=True).sum())
+            if nbytes > limit:
+                return df
+            _freeze(df)
+            with _LOADED_LOCK:
+                # Entries of older versions of the same files can never be hit again
+                stale = [k for k in _LOADED if k[:3] == key[:3]]
+                for k in stale:
+                    _LOADED_BYTES -= _LOADED.pop(k)[1]
+                _LOADED[key] = (df, nbytes)
+                _LOADED_BYTES += nbytes
+                while _LOADED_BYTES > limit:
+                    _LOADED_BYTES -= _LOADED.popitem(last=False)[1][1]
+            return _read_only_view(df)
+
+        return wrapper
+
+    return decorator
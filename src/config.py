@@ -27,6 +27,17 @@ OUTPUT_DIR = config('OUTPUT_DIR', default=(BASE_DIR / 'output'), cast=Path)
 WRDS_USERNAME = config("WRDS_USERNAME", default="")
 START_DATE = config("START_DATE", default="1980-01-01")
 END_DATE = config("END_DATE", default="2024-12-31")
+# Months before the latest cached month to re-pull on incremental CRSP updates,
+# to pick up revisions of recent data
+CRSP_OVERLAP_MONTHS = config("CRSP_OVERLAP_MONTHS", default=3, cast=int)
+# Number of concurrent WRDS connections used by the date-sliced pulls
+PULL_WORKERS = config("PULL_WORKERS", default=4, cast=int)
+# Dtypes of loaded frames: "numpy" (pandas default), "numpy_nullable" or "pyarrow"
+DTYPE_BACKEND = config("DTYPE_BACKEND", default="numpy")
+# Memory DuckDB may use before spilling to DATA_DIR/intermediate/duckdb
+DUCKDB_MEMORY_LIMIT = config("DUCKDB_MEMORY_LIMIT", default="4GB")
+# Memory (MB) for frames the load_* functions keep between calls; 0 disables it
+LOAD_CACHE_MAX_MB = config("LOAD_CACHE_MAX_MB", default=1024, cast=float)
 
 
 if __name__ == "__main__":
@@ -35,7 +46,7 @@ if __name__ == "__main__":
     (DATA_DIR / 'pulled').mkdir(parents=True, exist_ok=True)
 
     # Sometimes, I'll create other folders to organize the data
-    # (DATA_DIR / 'intermediate').mkdir(parents=True, exist_ok=True)
+    (DATA_DIR / 'intermediate').mkdir(parents=True, exist_ok=True)
     # (DATA_DIR / 'derived').mkdir(parents=True, exist_ok=True)
 
     OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
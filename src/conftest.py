@@ -0,0 +1,225 @@
+"""
+Offline stand-ins for the WRDS tables, shared by the tests
+
+- `wrds_standin` loads a small synthetic copy of the WRDS tables the pulls
+  query into an in-memory DuckDB, and points `wrds_connection` of the loaders
+  at it, so the SQL of the pulls runs unchanged.
+- `wrds_sqlite` serves `tfn.s12` from SQLite through SQLAlchemy connections, for
+  the streamed S12 pull.
+- `pulled_tree` runs the pulls against it and saves their results under a
+  temporary `data_dir / "pulled"`, laid out as `doit` leaves it.
+- The synthetic tables include the cases the pulls and the pandas steps must
+  agree on: share classes linked to several wficn or to none, missing and
+  non-positive returns and TNA, excluded Lipper classes and objective codes,
+  style records that change over time, missing S12 assets, non-US and
+  zero-price holdings, duplicated and missing MFLINK2 links, and report dates
+  equidistant from two link dates.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+from contextlib import contextmanager
+
+import duckdb
+import numpy as np
+import pandas as pd
+import pytest
+import sqlalchemy as sa
+
+import load_CRSP_fund
+import load_mflink
+import load_s12
+from load_s12 import S12_SCHEMA
+from parquet_tools import staged_dataset, write_partitioned
+
+START_DATE = "2000-01-01"
+END_DATE = "2002-12-31"
+
+
+def wrds_tables(seed: int = 0) -> dict:
+    """Synthetic WRDS tables, keyed by their schema-qualified name"""
+    rng = np.random.default_rng(seed)
+    months = pd.date_range(START_DATE, END_DATE, freq="M")
+    quarters = pd.date_range(START_DATE, END_DATE, freq="Q")
+
+    # 12 share classes of 5 funds. Class 3 is linked to two wficn, class 11 to none.
+    n_classes = 12
+    rows = []
+    for crsp_fundno in range(1, n_classes + 1):
+        for caldt in months:
+            if rng.random() < 0.1:
+                continue
+            mret = rng.normal(0.01, 0.05) if rng.random() > 0.1 else np.nan
+            mtna = rng.choice([rng.lognormal(3, 1), np.nan, 0.0, -1.0], p=[0.8, 0.1, 0.05, 0.05])
+            rows.append((crsp_fundno, caldt, mtna, mret, 10.0))
+    monthly = pd.DataFrame(rows, columns=["crsp_fundno", "caldt", "mtna", "mret", "mnav"])
+
+    classes = ["Large-Cap Growth Funds", "Mid-Cap Value Funds", None, "International Funds", "Small-Cap Core Funds"]
+    style = []
+    for crsp_fundno in range(1, n_classes + 1):
+        obj_cd = "EDYG" if crsp_fundno != 7 else "IFCM"
+        lipper = classes[crsp_fundno % len(classes)]
+        # Class 5 changes its Lipper class at the start of 2001
+        if crsp_fundno == 5:
+            style.append((crsp_fundno, pd.Timestamp("1990-01-01"), pd.Timestamp("2000-12-31"), "EQ", lipper, obj_cd))
+            style.append((crsp_fundno, pd.Timestamp("2001-01-01"), pd.Timestamp("2030-12-31"), "EQ", classes[0], obj_cd))
+        else:
+            style.append((crsp_fundno, pd.Timestamp("1990-01-01"), pd.Timestamp("2030-12-31"), "EQ", lipper, obj_cd))
+    fund_style = pd.DataFrame(
+        style, columns=["crsp_fundno", "begdt", "enddt", "lipper_asset_cd", "lipper_class_name", "crsp_obj_cd"]
+    )
+    fund_hdr = pd.DataFrame({
+        "crsp_fundno": np.arange(1, n_classes + 1),
+        "index_fund_flag": [None, "D", None, None, "B", None, None, None, "D", None, None, None],
+    })
+
+    wficn = 100 + (np.arange(1, n_classes + 1) + 1) // 3
+    mflink1 = pd.DataFrame({"crsp_fundno": np.arange(1, n_classes + 1, dtype=float), "wficn": wficn.astype(float)})
+    mflink1.loc[mflink1["crsp_fundno"] == 11, "wficn"] = np.nan
+    mflink1 = pd.concat([mflink1, pd.DataFrame({"crsp_fundno": [3.0], "wficn": [99.0]})], ignore_index=True)
+
+    # S12: fundno 1-6, each holding a few stocks per quarter. Fundno 6 is not in MFLINK2.
+    holdings = []
+    for fundno in range(1, 7):
+        for fdate in quarters:
+            if rng.random() < 0.15:
+                continue
+            assets = rng.choice([rng.lognormal(5, 1), np.nan], p=[0.8, 0.2])
+            # Fundno 5 reports no assets in 2001
+            if fundno == 5 and fdate.year == 2001:
+                assets = np.nan
+            rdate = fdate - pd.Timedelta(days=int(rng.integers(0, 30)))
+            for _ in range(4):
+                holdings.append((
+                    fdate, float(fundno), rdate, assets, "EQ",
+                    rng.choice(["UNITED STATES", "CANADA"], p=[0.8, 0.2]),
+                    rng.choice([rng.lognormal(8, 1), 0.0], p=[0.9, 0.1]),
+                    rng.lognormal(3, 0.5),
+                ))
+    s12 = pd.DataFrame(
+        holdings, columns=["fdate", "fundno", "rdate", "assets", "stkcdesc", "country", "shares", "prc"]
+    )
+
+    # Links every other quarter, so most report dates sit between two links, and
+    # fundno 3 changes wficn at every link. Fundno 1 has links 10 days either side
+    # of 2000-06-30, fundno 2 two wficn on one date, and fundno 4 a missing wficn.
+    links = []
+    for fundno in range(1, 6):
+        for k, fdate in enumerate(quarters[::2]):
+            links.append((fdate, float(fundno), 100.0 + fundno + (10 if fundno == 3 and k % 2 else 0)))
+    links += [
+        (pd.Timestamp("2000-06-20"), 1.0, 101.0),
+        (pd.Timestamp("2000-07-10"), 1.0, 111.0),
+        (quarters[2], 2.0, 90.0),
+        (quarters[4], 4.0, np.nan),
+    ]
+    mflink2 = pd.DataFrame(links, columns=["fdate", "fundno", "wficn"])
+
+    for df, cols in [(monthly, ["caldt"]), (fund_style, ["begdt", "enddt"]), (s12, ["fdate", "rdate"]), (mflink2, ["fdate"])]:
+        df[cols] = df[cols].apply(lambda col: col.dt.date)
+    return {
+        "crsp.monthly_tna_ret_nav": monthly,
+        "crsp.fund_style": fund_style,
+        "crsp.fund_hdr": fund_hdr,
+        "mfl.mflink1": mflink1,
+        "mfl.mflink2": mflink2,
+        "tfn.s12": s12,
+    }
+
+
+class StandinConnection:
+    """The part of `wrds.Connection` the pulls use, over a DuckDB connection"""
+
+    def __init__(self, con):
+        self.con = con
+
+    def raw_sql(self, query, date_cols=None):
+        df = self.con.execute(query).df()
+        for col in date_cols or []:
+            df[col] = pd.to_datetime(df[col]).astype("datetime64[ns]")
+        return df
+
+
+@pytest.fixture
+def wrds_standin(monkeypatch):
+    con = duckdb.connect()
+    for name, df in wrds_tables().items():
+        schema, table = name.split(".")
+        con.execute(f"CREATE SCHEMA IF NOT EXISTS {schema}")
+        con.register("df", df)
+        con.execute(f"CREATE TABLE {name} AS SELECT * FROM df")
+        con.unregister("df")
+
+    @contextmanager
+    def connection(wrds_username=None):
+        # A cursor per borrowed connection, so concurrent slices can share the database
+        cursor = con.cursor()
+        try:
+            yield StandinConnection(cursor)
+        finally:
+            cursor.close()
+
+    for module in [load_CRSP_fund, load_mflink, load_s12]:
+        monkeypatch.setattr(module, "wrds_connection", connection)
+    yield con
+    con.close()
+
+
+class SQLAlchemyStandinConnection:
+    """The part of `wrds.Connection` the streamed pulls use: an autocommit SQLAlchemy connection"""
+
+    def __init__(self, engine):
+        self.connection = engine.connect()
+
+    def raw_sql(self, query, date_cols=None):
+        return pd.read_sql_query(sa.text(query), self.connection, parse_dates=date_cols)
+
+
+@pytest.fixture
+def wrds_sqlite(tmp_path, monkeypatch):
+    """
+    SQLite copy of `tfn.s12` behind SQLAlchemy connections, as `wrds.Connection` holds them
+
+    Unlike DuckDB, it runs the streamed S12 pull (`load_s12.pull_and_save_s12`)
+    unchanged. Yields the list of connections borrowed so far.
+    """
+    db_dir = tmp_path / "sqlite"
+    db_dir.mkdir()
+    # As `wrds`, the engine is in autocommit mode
+    engine = sa.create_engine(f"sqlite:///{(db_dir / 'main.db').as_posix()}", isolation_level="AUTOCOMMIT")
+
+    @sa.event.listens_for(engine, "connect")
+    def attach_schemas(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE '{(db_dir / 'tfn.db').as_posix()}' AS tfn")
+
+    with engine.connect() as conn:
+        wrds_tables()["tfn.s12"].to_sql("s12", conn, schema="tfn", index=False)
+
+    borrowed = []
+
+    @contextmanager
+    def connection(wrds_username=None):
+        db = SQLAlchemyStandinConnection(engine)
+        borrowed.append(db)
+        yield db
+
+    monkeypatch.setattr(load_s12, "wrds_connection", connection)
+    yield borrowed
+    for db in borrowed:
+        db.connection.close()
+    engine.dispose()
+
+
+@pytest.fixture
+def pulled_tree(tmp_path, wrds_standin):
+    """Root data directory with the CRSP, S12 and MFLINK pulls of the stand-in"""
+    pulled = tmp_path / "pulled"
+    pulled.mkdir()
+    load_CRSP_fund.pull_and_save_CRSP_combined_file(tmp_path, START_DATE, END_DATE)
+    load_CRSP_fund.pull_and_save_CRSP_fund_level_file(tmp_path, START_DATE, END_DATE)
+    # The streamed S12 pull needs SQLAlchemy connections (see `wrds_sqlite`), so the
+    # S12 query is saved in one go
+    with staged_dataset(pulled / "s12") as tmp_s12:
+        write_partitioned(load_s12.pull_s12(START_DATE, END_DATE), tmp_s12, "fdate", schema=S12_SCHEMA)
+    load_mflink.pull_and_save_mflink(tmp_path)
+    return tmp_path
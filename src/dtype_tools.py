@@ -0,0 +1,85 @@
+"""
+Functions to shrink the in-memory size of loaded frames
+
+- WRDS returns identifiers (`crsp_fundno`, `fundno`, `wficn`) as float64. They
+  become 32-bit integers, or nullable `Int32` where they have missing values.
+- NAVs become float32. Returns stay float64, since they are compounded and
+  averaged into the yearly returns, and so do TNA, assets and holdings values,
+  since they are summed and compared in ratios.
+- Low-cardinality codes and class names become categoricals.
+- Independently, loaders can keep the Arrow buffers they read as pandas
+  `ArrowDtype` columns (`dtype_backend="pyarrow"`, set with `DTYPE_BACKEND`),
+  so strings and nullable ints are not converted to NumPy objects.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import logging
+
+import pandas as pd
+
+import config
+
+DTYPE_BACKEND = config.DTYPE_BACKEND
+DTYPE_BACKENDS = ("numpy", "numpy_nullable", "pyarrow")
+
+logger = logging.getLogger(__name__)
+
+
+def backend_kwargs(dtype_backend: str = DTYPE_BACKEND) -> dict:
+    """
+    Keyword arguments selecting `dtype_backend` in `pd.read_parquet` / `pd.read_csv`
+
+    Args:
+    - dtype_backend: str, "numpy" for the pandas defaults, or "numpy_nullable" / "pyarrow"
+
+    Returns:
+    - kwargs: dict, empty for "numpy"
+    """
+    if dtype_backend not in DTYPE_BACKENDS:
+        raise ValueError(f"Unknown dtype_backend: {dtype_backend!r}")
+    if dtype_backend == "numpy":
+        return {}
+    return {"dtype_backend": dtype_backend}
+
+
+def compact_dtypes(
+    df: pd.DataFrame,
+    dtypes: dict,
+    name: str = "df",
+    verbose: bool = False,
+) -> pd.DataFrame:
+    """
+    Cast the columns of `df` to smaller dtypes, optionally logging the memory saved
+
+    Integer dtypes are switched to their nullable counterpart (e.g. "int32" to
+    "Int32") for columns with missing values. Casting ids that are not whole
+    numbers raises a TypeError rather than truncating them.
+
+    Args:
+    - df: pd.DataFrame, frame to cast
+    - dtypes: dict, column name to target dtype. Columns missing from `df` are skipped.
+    - name: str, label used in the memory report
+    - verbose: bool, log the memory usage before and after (at INFO). Off by
+      default, since measuring the object columns scans every string.
+
+    Returns:
+    - df: pd.DataFrame, with the columns cast
+    """
+    if verbose:
+        before = df.memory_usage(deep=True).sum()
+    df = df.copy(deep=False)
+    for col, dtype in dtypes.items():
+        if col not in df.columns:
+            continue
+        if dtype.startswith("int"):
+            # The nullable cast refuses non-integral values instead of truncating
+            df[col] = df[col].astype(dtype.capitalize())
+            if not df[col].hasnans:
+                df[col] = df[col].astype(dtype)
+        else:
+            df[col] = df[col].astype(dtype)
+    if verbose:
+        after = df.memory_usage(deep=True).sum()
+        logger.info("%s: %.1f MB -> %.1f MB", name, before / 2**20, after / 2**20)
+    return df
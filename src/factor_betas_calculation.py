@@ -1,5 +1,8 @@
+import logging
+
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 import wrds
 import config
 from pathlib import Path
@@ -10,29 +13,140 @@ START_DATE = config.START_DATE
 END_DATE = config.END_DATE
 OUTPUT_DIR = Path(config.OUTPUT_DIR)
 
-from load_CRSP_fund import load_CRSP_combined_file
-from load_mflink import load_mflink1
-from sklearn.linear_model import LinearRegression
+from cache_tools import cached_parquet
+from dtype_tools import DTYPE_BACKEND, backend_kwargs
+from factor_store import check_factor_coverage, factor_frame, load_factors
+from load_CRSP_fund import load_CRSP_combined_file, load_CRSP_fund_level_file
+from load_mflink import link_crsp_wficn, load_mflink1_index
+from panel_tools import save_panel
 
-def monthly_mutual_fund():
-    path = Path(OUTPUT_DIR) / "main_sample.parquet"
-    df_combo = pd.read_parquet(path)
+CRSP_PANEL_COLUMNS = ["crsp_fundno", "caldt", "mret", "mtna", "lipper_class_name", "index_fund_flag"]
+REGRESSION_PANEL_DIR = DATA_DIR / "intermediate" / "regression_panel"
+# Modules the monthly fund panel is built with, part of its cache key
+MONTHLY_PANEL_MODULES = [
+    "factor_betas_calculation.py", "cache_tools.py", "config.py", "dtype_tools.py", "parquet_tools.py",
+    "load_CRSP_fund.py", "load_mflink.py",
+]
 
-    df_crsp = load_CRSP_combined_file()
-    df_mflink1 = load_mflink1()
-    
-    df_crsp = df_crsp.merge(df_mflink1, how="inner", on="crsp_fundno").reset_index(drop=True)
+logger = logging.getLogger(__name__)
 
-    df_crsp = df_crsp.sort_values(["caldt", "wficn"])
-    df_crsp['mret'] = df_crsp['mret'].fillna(0)
-    df_crsp['lipper_class_name'] = df_crsp['lipper_class_name'].fillna('None')
+def share_class_aggregate(codes, mret, mtna, weighting="equal"):
+    """
+    Aggregate share-class returns and TNA to the fund level in one grouped pass.
 
-    df_crsp = df_crsp[~df_crsp['lipper_class_name'].astype(str).str.contains('International|Fixed Income|Precious Metal', case=False, regex=True)]
-    ret = df_crsp.groupby(["caldt", "wficn", 'lipper_class_name'])["mret"].mean().reset_index().rename(columns={"mret": "crsp_ret"})
-    tna = df_crsp.groupby(["caldt", "wficn", 'lipper_class_name'])["mtna"].sum().reset_index().rename(columns={"mtna": "crsp_tna"})
-    df_crsp = pd.merge(pd.merge(ret, tna, on=["caldt", "wficn", 'lipper_class_name'], how="inner"), 
-                       df_crsp[["caldt", "wficn", 'lipper_class_name', 'index_fund_flag']], on=["caldt", "wficn", 'lipper_class_name'], how="inner").sort_values(["caldt", "wficn"])
-    df_crsp = df_crsp.drop_duplicates()
+    The groups are given as integer codes (e.g. from `GroupBy.ngroup`), so every
+    statistic is a single `np.bincount` over the codes. With `weighting="tna"`,
+    returns are weighted by `mtna` (footnote 4 of the paper); groups in which no
+    share class reports a positive `mtna` fall back to the equal-weighted mean.
+
+    Args:
+    - codes: np.ndarray, integer group code of each share-class row, in [0, n_groups)
+    - mret: np.ndarray, monthly share-class return (missing values already filled)
+    - mtna: np.ndarray, monthly share-class TNA, may contain NaN
+    - weighting: str, "equal" or "tna"
+
+    Returns:
+    - ret: np.ndarray, fund-level return per group
+    - tna: np.ndarray, summed TNA per group (missing TNA counts as zero)
+    """
+    if weighting not in ("equal", "tna"):
+        raise ValueError(f"Unknown weighting: {weighting!r}")
+    codes = np.asarray(codes, dtype=np.intp)
+    mret = np.asarray(mret, dtype=np.float64)
+    mtna = np.asarray(mtna, dtype=np.float64)
+    n_groups = codes.max() + 1 if len(codes) else 0
+
+    count = np.bincount(codes, minlength=n_groups)
+    ret = np.bincount(codes, weights=mret, minlength=n_groups) / count
+    tna = np.bincount(codes, weights=np.nan_to_num(mtna, nan=0.0), minlength=n_groups)
+
+    if weighting == "tna":
+        w = np.where(mtna > 0, mtna, 0.0)
+        w_sum = np.bincount(codes, weights=w, minlength=n_groups)
+        wret_sum = np.bincount(codes, weights=w * mret, minlength=n_groups)
+        has_weight = w_sum > 0
+        ret = np.where(has_weight, wret_sum / np.where(has_weight, w_sum, 1.0), ret)
+    return ret, tna
+
+
+def monthly_mutual_fund(
+    weighting="equal", start_date=None, end_date=None, use_cache=True, fund_level=False, dtype_backend=DTYPE_BACKEND,
+    link_policy="lowest",
+):
+    """
+    Build the monthly fund-level (wficn) panel of the main sample.
+
+    The result is cached in `DATA_DIR / "intermediate"`, keyed by the contents of
+    the CRSP, mflink1 and main sample files, this module, and the parameters.
+    With `fund_level=True` the share classes are read already aggregated from the
+    `CRSP_fund_level` pull (see `load_CRSP_fund.pull_CRSP_fund_level_file`), which
+    gives the same panel from about a third of the rows.
+
+    Share classes are linked to wficn with `load_mflink1_index`, so a crsp_fundno
+    that MFLINK1 links to several wficn is counted in one fund only (see
+    `link_policy`), instead of in each of them.
+
+    Args:
+    - weighting: str, "equal" for the simple mean of share-class returns, or "tna"
+      for `mtna`-weighted returns with an equal-weight fallback where `mtna` is missing
+    - start_date: str, first month to include in "YYYY-MM-DD" format, or None
+    - end_date: str, last month to include in "YYYY-MM-DD" format, or None
+    - use_cache: bool, set to False to force a rebuild
+    - fund_level: bool, use the server-side aggregated CRSP pull
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" dtypes for the loaded data and the result
+    - link_policy: str, for crsp_fundno linked to several wficn: "lowest" keeps the
+      lowest wficn, "drop" drops them. The fund-level pull links with "lowest".
+
+    Returns:
+    - df_crsp: pd.DataFrame, monthly crsp_ret and crsp_tna by wficn
+    """
+    if fund_level and link_policy != "lowest":
+        raise ValueError("The fund-level CRSP pull links share classes with link_policy='lowest'")
+    if fund_level:
+        crsp_inputs = [DATA_DIR / "pulled" / "CRSP_fund_level"]
+    else:
+        crsp_inputs = [DATA_DIR / "pulled" / "CRSP_fund_combined", DATA_DIR / "pulled" / "mflink1.parquet"]
+    inputs = [
+        Path(OUTPUT_DIR) / "main_sample.parquet",
+        *crsp_inputs,
+        *[Path(__file__).with_name(module) for module in MONTHLY_PANEL_MODULES],
+    ]
+    params = {"weighting": weighting, "start_date": start_date, "end_date": end_date}
+    if fund_level:
+        params["fund_level"] = True
+    if dtype_backend != "numpy":
+        params["dtype_backend"] = dtype_backend
+    if link_policy != "lowest":
+        params["link_policy"] = link_policy
+    return cached_parquet(
+        "monthly_mutual_fund",
+        lambda: _build_monthly_mutual_fund(
+            weighting=weighting, start_date=start_date, end_date=end_date, fund_level=fund_level,
+            dtype_backend=dtype_backend, link_policy=link_policy,
+        ),
+        inputs=inputs,
+        params=params,
+        use_cache=use_cache,
+        dtype_backend=dtype_backend,
+    )
+
+
+def _build_monthly_mutual_fund(
+    weighting="equal", start_date=None, end_date=None, fund_level=False, dtype_backend=DTYPE_BACKEND,
+    link_policy="lowest",
+):
+    path = Path(OUTPUT_DIR) / "main_sample.parquet"
+    df_combo = pd.read_parquet(path, columns=['year', 'wficn'], **backend_kwargs(dtype_backend))
+
+    if fund_level:
+        df_crsp = _load_fund_level_panel(
+            weighting=weighting, start_date=start_date, end_date=end_date, dtype_backend=dtype_backend
+        )
+    else:
+        df_crsp = _aggregate_share_classes(
+            weighting=weighting, start_date=start_date, end_date=end_date, dtype_backend=dtype_backend,
+            link_policy=link_policy,
+        )
     df_crsp = df_crsp.rename(columns={"caldt": "date"})
 
     df_crsp['year'] = df_crsp['date'].dt.year.astype('int')
@@ -42,81 +156,370 @@ def monthly_mutual_fund():
     return df_crsp
 
 
-def fama_french_factors():
-    df_ff = pd.read_csv(Path(config.DATA_DIR)/'manual'/'F-F_Research_Data_5_Factors_2x3.csv').drop(['RF'], axis=1)
-    df_mom = pd.read_csv(Path(config.DATA_DIR)/'manual'/'F-F_Momentum_Factor.csv')
-    df_ff = df_ff.merge(df_mom, how='inner', on=['date'])
-    df_ff = df_ff[(df_ff['date'] >= 198001) & (df_ff['date'] <= 201912)]
-    return df_ff
+def _load_fund_level_panel(
+    weighting="equal", start_date=None, end_date=None, dtype_backend=DTYPE_BACKEND, data_dir=DATA_DIR
+):
+    if weighting not in ("equal", "tna"):
+        raise ValueError(f"Unknown weighting: {weighting!r}")
+    ret_col = "mret" if weighting == "equal" else "mret_tna"
+    df_crsp = load_CRSP_fund_level_file(
+        data_dir,
+        start_date=start_date,
+        end_date=end_date,
+        columns=["caldt", "wficn", "lipper_class_name", ret_col, "mtna", "index_fund_flag"],
+        dtype_backend=dtype_backend,
+    )
+    df_crsp = df_crsp.rename(columns={ret_col: "crsp_ret", "mtna": "crsp_tna"})
+    return df_crsp.sort_values(["caldt", "wficn", "lipper_class_name"], kind="stable").reset_index(drop=True)
 
 
-def regression_df(df_crsp, df_ff):
+def _aggregate_share_classes(
+    weighting="equal", start_date=None, end_date=None, dtype_backend=DTYPE_BACKEND, link_policy="lowest",
+    data_dir=DATA_DIR,
+):
+    df_crsp = load_CRSP_combined_file(
+        data_dir, start_date=start_date, end_date=end_date, columns=CRSP_PANEL_COLUMNS, dtype_backend=dtype_backend
+    )
+    link_index = load_mflink1_index(data_dir, policy=link_policy)
+
+    df_crsp['wficn'], n_ambiguous = link_crsp_wficn(df_crsp['crsp_fundno'], link_index)
+    logger.info(
+        "Share-class months linked to several wficn in MFLINK1: %d (link_policy=%r)", n_ambiguous, link_policy
+    )
+    df_crsp = df_crsp[df_crsp['wficn'].notnull()]
+    df_crsp = df_crsp.sort_values(["caldt", "wficn"], kind="stable")
+    df_crsp['mret'] = df_crsp['mret'].fillna(0)
+    df_crsp['lipper_class_name'] = df_crsp['lipper_class_name'].fillna('None')
+
+    df_crsp = df_crsp[~df_crsp['lipper_class_name'].astype(str).str.contains('International|Fixed Income|Precious Metal', case=False, regex=True)]
+    keys = ["caldt", "wficn", 'lipper_class_name']
+    grouped = df_crsp.groupby(keys, sort=True)
+    crsp_ret, crsp_tna = share_class_aggregate(
+        grouped.ngroup().to_numpy(),
+        df_crsp['mret'].to_numpy(dtype="float64", na_value=np.nan),
+        df_crsp['mtna'].to_numpy(dtype="float64", na_value=np.nan),
+        weighting=weighting,
+    )
+    df_fund = grouped.size().index.to_frame(index=False)
+    df_fund['crsp_ret'] = crsp_ret
+    df_fund['crsp_tna'] = crsp_tna
+    df_crsp = pd.merge(df_fund, df_crsp[keys + ['index_fund_flag']].drop_duplicates(), on=keys, how="inner").sort_values(["caldt", "wficn"])
+    return df_crsp
+
+
+def fama_french_factors(start=198001, end=201912, dtype_backend=DTYPE_BACKEND, panel_dates=None):
+    """
+    Fama-French five factors and momentum between two months
+
+    The CSVs are parsed once and cached (see `factor_store.load_factors`).
+
+    Args:
+    - start: int, first month as YYYYMM, or None for the first available
+    - end: int, last month as YYYYMM, or None for the last available
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" dtypes of the result
+    - panel_dates: array-like, YYYYMM months of the fund panel (e.g. `df_crsp['date']`).
+      If given, raise a ValueError if any of them between `start` and `end` has no factors.
+
+    Returns:
+    - df_ff: pd.DataFrame, with columns date, Mkt-RF, SMB, HML, RMW, CMA, MOM
+    """
+    factors = load_factors(DATA_DIR)
+    if panel_dates is not None:
+        check_factor_coverage(panel_dates, factors, start, end)
+    return factor_frame(factors, start, end, dtype_backend=dtype_backend)
+
+
+def regression_df(df_crsp, df_ff, panel_dir=None):
+    """
+    Merge the fund panel with the factors and compute flows
+
+    Args:
+    - df_crsp: pd.DataFrame, from `monthly_mutual_fund`
+    - df_ff: pd.DataFrame, from `fama_french_factors`
+    - panel_dir: Path, also save the result as memory-mapped columns there (see
+      `panel_tools.save_panel`, e.g. `REGRESSION_PANEL_DIR`), for worker
+      processes to open with `panel_tools.load_panel`. Not saved if None.
+
+    Returns:
+    - df_reg: pd.DataFrame, sorted by (wficn, date)
+    """
     df_reg = pd.merge(df_crsp[df_crsp['date'] <= 201912], df_ff, on=['date'], how="outer").sort_values(["date"])
+    # The regression inputs are NumPy floats whatever the dtype backend: Arrow floats keep
+    # NaN (e.g. from 0/0 flows) apart from missing values, and fillna would skip them
+    df_reg = df_reg.astype({
+        col: "float64" for col, dtype in df_reg.dtypes.items() if pd.api.types.is_float_dtype(dtype)
+    })
     flow = df_reg.groupby('wficn').apply(lambda d: d['crsp_tna']/(d['crsp_tna'].shift(1)) - (1+d['crsp_ret'])).reset_index().rename(columns={'level_1': 'index', 0: "flow"})
     flow.set_index('index', inplace=True)
     df_reg = pd.merge(df_reg, flow[['flow']], left_index=True, right_index=True).sort_values(['wficn', 'date'])
     df_reg[['crsp_ret', 'flow']] *= 100
     df_reg.replace([np.inf, -np.inf], np.nan, inplace=True)
-    df_reg= df_reg.fillna(0)
+    # String columns of the nullable and Arrow backends only accept strings
+    df_reg = df_reg.fillna({
+        col: "0" if dtype != object and pd.api.types.is_string_dtype(dtype) else 0
+        for col, dtype in df_reg.dtypes.items()
+    })
+    if panel_dir is not None:
+        save_panel(df_reg, panel_dir)
     return df_reg
 
 
-def regression(df):
-    beta = pd.DataFrame(columns = ['Mkt-RF', 'SMB', 'HML', 'MOM', 'CMA', 'RMW', 'flow'])
+# Factor models of the beta regressions, by name. "<name>_flow" adds the fund flow
+# to the regressors of "<name>"; "ff5_mom_flow" is the specification of Table 2.
+FACTOR_MODELS = {
+    "capm": ["Mkt-RF"],
+    "ff3": ["Mkt-RF", "SMB", "HML"],
+    "ff5": ["Mkt-RF", "SMB", "HML", "CMA", "RMW"],
+    "ff5_mom": ["Mkt-RF", "SMB", "HML", "MOM", "CMA", "RMW"],
+}
+DEFAULT_FACTOR_MODEL = "ff5_mom_flow"
+BETA_WINDOW = 24
+BETA_SAMPLE = 60
+
+
+def register_factor_model(name, columns):
+    """
+    Add (or replace) a factor model of `FACTOR_MODELS`, so it can be estimated by name
+
+    Args:
+    - name: str, model name, must not end in "_flow"
+    - columns: list of str, regressors of the model, in the order of the betas
+    """
+    if name.endswith("_flow"):
+        raise ValueError("The flow variant of a model is derived from its name; register the model without '_flow'")
+    FACTOR_MODELS[name] = list(columns)
+
 
-    for fund, data in df.groupby('wficn'):
-        if len(data) >= 60: 
-            for month in range(len(data)-59):
-                sample = data.iloc[month:month+60, :]
-                for rw in range(len(sample)-23):
-                    rolling_window = sample.iloc[rw:rw+24, :]
-                    X = rolling_window[['Mkt-RF', 'SMB', 'HML', 'MOM', 'CMA', 'RMW', 'flow']]
-                    y = rolling_window[['crsp_ret']]
-                    model = LinearRegression().fit(X, y)
-                    coef = pd.DataFrame((model.coef_).reshape(-1, 7), columns = ['Mkt-RF', 'SMB', 'HML', 'MOM', 'CMA', 'RMW', 'flow'])
-                    beta = pd.concat([beta, coef], axis=0)
-    return beta
+def factor_model_columns(model):
+    """
+    Regressors of a factor model
 
+    Args:
+    - model: str, a name of `FACTOR_MODELS`, optionally with a "_flow" suffix, or
+      a list of column names for a custom model
 
-def calc_penal_A(df_reg):
-    all_funds = regression(df_reg)
-    panelA = all_funds.describe().loc[['mean', 'std']].append(all_funds.quantile(0.05)).append(all_funds.describe().loc[['25%', '50%', '75%']]).append(all_funds.quantile(0.95))
-    panelA = panelA.rename(index={0.05: 'P5', '25%': 'P25', '50%': 'P50', '75%': 'P75', 0.95: 'P95'})
+    Returns:
+    - columns: list of str
+    """
+    if not isinstance(model, str):
+        return list(model)
+    if model in FACTOR_MODELS:
+        return list(FACTOR_MODELS[model])
+    if model.endswith("_flow") and model[:-len("_flow")] in FACTOR_MODELS:
+        return FACTOR_MODELS[model[:-len("_flow")]] + ["flow"]
+    raise ValueError(f"Unknown factor model: {model!r} (known: {', '.join(sorted(FACTOR_MODELS))}, and their '_flow' variants)")
+
+
+def window_cross_products(Z, window=BETA_WINDOW):
+    """
+    Centered cross-product tables of every rolling window of a fund
+
+    Args:
+    - Z: np.ndarray, (months x variables), regressors and the return of one fund
+    - window: int, number of months per window
+
+    Returns:
+    - C: np.ndarray, (windows x variables x variables), C[w] = Zc'Zc for the rows
+      w:w+window of Z, demeaned within the window
+    """
+    W = sliding_window_view(Z, window, axis=0)
+    W = W - W.mean(axis=2, keepdims=True)
+    return np.einsum("wit,wjt->wij", W, W)
+
+
+def _solve_windows(C, idx, y_idx):
+    """OLS slopes of every window from the centered tables, minimum-norm if X is rank deficient (as sklearn)"""
+    Cxx = C[:, idx[:, None], idx]
+    Cxy = C[:, idx, y_idx]
+    return np.einsum("wij,wj->wi", np.linalg.pinv(Cxx), Cxy)
+
+
+def rolling_betas(df, models=(DEFAULT_FACTOR_MODEL,), window=BETA_WINDOW, sample=BETA_SAMPLE):
+    """
+    Rolling factor betas of each fund, for several factor models in one pass
+
+    For each fund with at least `sample` months and each `sample`-month sample,
+    the return is regressed (with intercept) on the model's regressors over every
+    `window`-month window of the sample, as in Table 2. The centered cross-product
+    tables of each window are computed once per fund for the union of the models'
+    regressors, and each model is solved from its block of them. A window shared
+    by several samples is solved once and repeated, so the rows are the same as
+    fitting every (sample, window) pair.
+
+    Args:
+    - df: pd.DataFrame, from `regression_df`, sorted by (wficn, date)
+    - models: list of models, names of `FACTOR_MODELS` (see `factor_model_columns`)
+      or lists of columns
+    - window: int, months per regression window
+    - sample: int, months per sample
+
+    Returns:
+    - betas: dict, model -> pd.DataFrame with one column per regressor and one row
+      per (fund, sample, window). Custom models are keyed by the tuple of their columns.
+    """
+    specs = {
+        (model if isinstance(model, str) else tuple(model)): factor_model_columns(model)
+        for model in models
+    }
+    columns = list(dict.fromkeys(col for spec in specs.values() for col in spec))
+    idx = {model: np.array([columns.index(col) for col in spec]) for model, spec in specs.items()}
+    y_idx = len(columns)
+    # Each sample of n_windows consecutive windows, for every sample of the fund
+    n_windows = sample - window + 1
+
+    betas = {model: [] for model in specs}
+    for _, data in df.groupby('wficn'):
+        n = len(data)
+        if n < sample:
+            continue
+        Z = data[columns + ['crsp_ret']].to_numpy(dtype="float64")
+        C = window_cross_products(Z, window)
+        starts = (np.arange(n - sample + 1)[:, None] + np.arange(n_windows)[None, :]).ravel()
+        for model in specs:
+            betas[model].append(_solve_windows(C, idx[model], y_idx)[starts])
+
+    return {
+        model: pd.DataFrame(
+            np.concatenate(betas[model]) if betas[model] else np.empty((0, len(spec))),
+            columns=spec,
+        )
+        for model, spec in specs.items()
+    }
+
+
+def regression(df, model=DEFAULT_FACTOR_MODEL):
+    """
+    Rolling factor betas of each fund (see `rolling_betas`)
+
+    Args:
+    - df: pd.DataFrame, from `regression_df`
+    - model: str or list of str, factor model (see `factor_model_columns`)
+
+    Returns:
+    - beta: pd.DataFrame, one column per regressor
+    """
+    return next(iter(rolling_betas(df, [model]).values()))
+
+
+# Fund groups of Table 2, as (column of df_reg, regex, negate). Panel B groups funds
+# by Lipper class, Panel C by index fund flag (B: index-based, D: pure, E: enhanced)
+FUND_GROUPS = {
+    "all": None,
+    "growth": ("lipper_class_name", "Growth", False),
+    "value": ("lipper_class_name", "Value", False),
+    "large_cap": ("lipper_class_name", "Large-Cap", False),
+    "mid_cap": ("lipper_class_name", "Mid-Cap", False),
+    "small_cap": ("lipper_class_name", "Small-Cap", False),
+    "index": ("index_fund_flag", "D|B|E", False),
+    "enhanced_index": ("index_fund_flag", "E", False),
+    "base_index": ("index_fund_flag", "B", False),
+    "pure_index": ("index_fund_flag", "D", False),
+    "non_index": ("index_fund_flag", "D|B|E", True),
+}
+# Rows of Panels B and C, and the fund group of each
+PANEL_B_GROUPS = {
+    "All": "all", "Growth": "growth", "Value": "value",
+    "Large cap": "large_cap", "Medium cap": "mid_cap", "Small cap": "small_cap",
+}
+PANEL_C_GROUPS = {
+    "All index funds": "index", "Enhanced": "enhanced_index", "Base": "base_index",
+    "Pure": "pure_index", "All non-index funds": "non_index",
+}
+
+
+def fund_group(df_reg, group):
+    """
+    Rows of the regression panel in one of `FUND_GROUPS`
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`
+    - group: str, name of `FUND_GROUPS`
+
+    Returns:
+    - df: pd.DataFrame
+    """
+    if group not in FUND_GROUPS:
+        raise ValueError(f"Unknown fund group: {group!r}")
+    if FUND_GROUPS[group] is None:
+        return df_reg
+    col, pattern, negate = FUND_GROUPS[group]
+    match = df_reg[col].astype(str).str.contains(pattern, case=False, regex=True)
+    return df_reg[~match if negate else match]
+
+
+def group_betas(df_reg, groups=tuple(FUND_GROUPS), model=DEFAULT_FACTOR_MODEL):
+    """
+    Rolling factor betas (see `regression`) of each fund group
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`
+    - groups: list of str, names of `FUND_GROUPS`
+    - model: str or list of str, factor model (see `factor_model_columns`)
+
+    Returns:
+    - betas: pd.DataFrame, a `group` column and one column per regressor
+    """
+    frames = [regression(fund_group(df_reg, group), model).assign(group=group) for group in groups]
+    betas = pd.concat(frames, ignore_index=True)
+    return betas[["group"] + [col for col in betas.columns if col != "group"]]
+
+
+def _betas_of(df_reg, betas, group):
+    """Betas of one fund group, from `group_betas` if given, else estimated"""
+    if betas is None:
+        return regression(fund_group(df_reg, group))
+    return betas[betas["group"] == group].drop(columns="group").reset_index(drop=True)
+
+
+def calc_penal_A(df_reg, betas=None):
+    """
+    Panel A of Table 2: distribution of the factor betas across all funds
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`
+    - betas: pd.DataFrame, from `group_betas`, including the "all" group. Estimated if None.
+
+    Returns:
+    - panelA: pd.DataFrame, rows mean, std, P5, P25, P50, P75, P95 and one column per regressor
+    """
+    all_funds = _betas_of(df_reg, betas, "all")
+    panelA = pd.concat([
+        all_funds.describe().loc[['mean', 'std']],
+        all_funds.quantile(0.05).to_frame().T,
+        all_funds.describe().loc[['25%', '50%', '75%']],
+        all_funds.quantile(0.95).to_frame().T,
+    ])
+    panelA.index = ['mean', 'std', 'P5', 'P25', 'P50', 'P75', 'P95']
     return panelA
 
 
-def calc_penal_B(df_reg):
-    df_growth = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Growth', case=False, regex=True)]
-    df_value = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Value', case=False, regex=True)]
-    df_base = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Base', case=False, regex=True)]
-    df_large_cap = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Large-Cap', case=False, regex=True)]
-    df_mid_cap = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Mid-Cap', case=False, regex=True)]
-    df_small_cap = df_reg[df_reg['lipper_class_name'].astype(str).str.contains('Small-Cap', case=False, regex=True)]
-    
-    growth = regression(df_growth)
-    value = regression(df_value)
-    base = regression(df_base)
-    large_cap = regression(df_large_cap)
-    mid_cap = regression(df_mid_cap)
-    small_cap = regression(df_small_cap)
-    panelB = pd.DataFrame({'All': all_funds.mean(), 'Growth': growth.mean(), 'Value': value.mean(), 
-                  'Large cap': large_cap.mean(), 'Medium cap': mid_cap.mean(), 'Small cap': small_cap.mean()}).T
-    return panelB
-
-
-def calc_penal_C(df_reg):
-    df_index = df_reg[df_reg['index_fund_flag'].astype(str).str.contains('D|B|E', case=False, regex=True)]
-    df_enhanced = df_reg[df_reg['index_fund_flag'].astype(str).str.contains('E', case=False, regex=True)]
-    df_base = df_reg[df_reg['index_fund_flag'].astype(str).str.contains('B', case=False, regex=True)]
-    df_pure = df_reg[df_reg['index_fund_flag'].astype(str).str.contains('D', case=False, regex=True)]
-    df_non_index = df_reg[~df_reg['index_fund_flag'].astype(str).str.contains('D|B|E', case=False, regex=True)]
-
-    index = regression(df_index)
-    enhanced = regression(df_enhanced)
-    base = regression(df_base)
-    pure = regression(df_pure)
-    non_index = regression(df_non_index)
-    panelC = pd.DataFrame({'All index funds': index.mean(), 'Enhanced': enhanced.mean(), 'Base': base.mean(), 
-                  'Pure': pure.mean(), 'All non-index funds': non_index.mean()}).T
-    return panelC
+def calc_penal_B(df_reg, betas=None):
+    """
+    Panel B of Table 2: mean factor betas by Lipper class (`PANEL_B_GROUPS`)
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`
+    - betas: pd.DataFrame, from `group_betas`, including the groups of Panel B. Estimated if None.
+
+    Returns:
+    - panelB: pd.DataFrame, one row per class and one column per regressor
+    """
+    return pd.DataFrame({
+        name: _betas_of(df_reg, betas, group).mean() for name, group in PANEL_B_GROUPS.items()
+    }).T
+
+
+def calc_penal_C(df_reg, betas=None):
+    """
+    Panel C of Table 2: mean factor betas by index fund status (`PANEL_C_GROUPS`)
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`
+    - betas: pd.DataFrame, from `group_betas`, including the groups of Panel C. Estimated if None.
 
+    Returns:
+    - panelC: pd.DataFrame, one row per status and one column per regressor
+    """
+    return pd.DataFrame({
+        name: _betas_of(df_reg, betas, group).mean() for name, group in PANEL_C_GROUPS.items()
+    }).T
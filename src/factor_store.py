@@ -0,0 +1,154 @@
+"""
+Functions to load the Fama-French factors from a binary cache
+
+- The 5-factor and momentum CSVs in `data/manual` are parsed and merged once,
+  and saved as an `.npz` in `data/intermediate`, keyed by the hash of the CSVs.
+- The factors are a (months x factors) float64 matrix with a sorted YYYYMM
+  `dates` array, so any date range is a view found by binary search.
+- `check_factor_coverage` lists the months of a fund panel that have no factors,
+  which would otherwise be filled with zeros in the regressions.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import config
+from cache_tools import cached_arrays
+from dtype_tools import DTYPE_BACKEND, backend_kwargs
+
+DATA_DIR = Path(config.DATA_DIR)
+
+FF_FACTORS_FILE = "F-F_Research_Data_5_Factors_2x3.csv"
+FF_MOMENTUM_FILE = "F-F_Momentum_Factor.csv"
+
+
+def build_factors(
+    data_dir: Path = DATA_DIR,
+) -> dict:
+    """
+    Parse the factor CSVs in `data_dir / "manual"` into arrays
+
+    The risk-free rate is dropped, and only the months with both the five
+    factors and momentum are kept.
+
+    Args:
+    - data_dir: Path, root data directory
+
+    Returns:
+    - factors: dict of np.ndarray: `dates` (int64 YYYYMM, sorted), `values`
+      (float64, one row per month and one column per factor) and `columns` (factor names)
+    """
+    manual_dir = Path(data_dir) / "manual"
+    df_ff = pd.read_csv(manual_dir / FF_FACTORS_FILE).drop(["RF"], axis=1)
+    df_mom = pd.read_csv(manual_dir / FF_MOMENTUM_FILE)
+    df_ff = df_ff.merge(df_mom, how="inner", on=["date"]).sort_values("date")
+    columns = [col for col in df_ff.columns if col != "date"]
+    return {
+        "dates": df_ff["date"].to_numpy(dtype="int64"),
+        "values": np.ascontiguousarray(df_ff[columns].to_numpy(dtype="float64")),
+        "columns": np.array(columns),
+    }
+
+
+def load_factors(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> dict:
+    """
+    Load the arrays of `build_factors`, from `data_dir / "intermediate"` unless the CSVs changed
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to parse the CSVs again
+
+    Returns:
+    - factors: dict of np.ndarray
+    """
+    data_dir = Path(data_dir)
+    return cached_arrays(
+        "ff_factors",
+        lambda: build_factors(data_dir),
+        inputs=[data_dir / "manual" / FF_FACTORS_FILE, data_dir / "manual" / FF_MOMENTUM_FILE],
+        cache_dir=data_dir / "intermediate",
+        use_cache=use_cache,
+    )
+
+
+def factor_slice(
+    factors: dict,
+    start: int = None,
+    end: int = None,
+) -> dict:
+    """
+    Restrict the factors to the months `start <= date <= end` (views, no copy)
+
+    Args:
+    - factors: dict of np.ndarray, from `load_factors`
+    - start: int, first month as YYYYMM. No lower bound if None.
+    - end: int, last month as YYYYMM. No upper bound if None.
+
+    Returns:
+    - factors: dict of np.ndarray, with the same keys
+    """
+    dates = factors["dates"]
+    lo = 0 if start is None else np.searchsorted(dates, start, side="left")
+    hi = len(dates) if end is None else np.searchsorted(dates, end, side="right")
+    return {"dates": dates[lo:hi], "values": factors["values"][lo:hi], "columns": factors["columns"]}
+
+
+def factor_frame(
+    factors: dict,
+    start: int = None,
+    end: int = None,
+    dtype_backend: str = DTYPE_BACKEND,
+) -> pd.DataFrame:
+    """
+    The factors between `start` and `end` as a DataFrame with a `date` column (YYYYMM)
+
+    Args:
+    - factors: dict of np.ndarray, from `load_factors`
+    - start: int, first month as YYYYMM, or None
+    - end: int, last month as YYYYMM, or None
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
+
+    Returns:
+    - df_ff: pd.DataFrame
+    """
+    factors = factor_slice(factors, start, end)
+    df_ff = pd.DataFrame(factors["values"], columns=factors["columns"].tolist())
+    df_ff.insert(0, "date", factors["dates"])
+    if backend_kwargs(dtype_backend):
+        df_ff = df_ff.convert_dtypes(dtype_backend=dtype_backend)
+    return df_ff
+
+
+def check_factor_coverage(
+    dates,
+    factors: dict,
+    start: int = None,
+    end: int = None,
+) -> None:
+    """
+    Raise if months of a fund panel between `start` and `end` have no factors
+
+    Args:
+    - dates: array-like, YYYYMM month of each panel row (e.g. `df_crsp["date"]`)
+    - factors: dict of np.ndarray, from `load_factors`
+    - start: int, first month checked as YYYYMM, or None
+    - end: int, last month checked as YYYYMM, or None
+    """
+    months = np.unique(pd.Series(dates).dropna().to_numpy(dtype="int64"))
+    if start is not None:
+        months = months[months >= start]
+    if end is not None:
+        months = months[months <= end]
+    missing = months[~np.isin(months, factors["dates"])]
+    if len(missing):
+        raise ValueError(
+            f"No Fama-French factors for {len(missing)} months of the fund panel: "
+            f"{', '.join(map(str, missing[:12]))}{' ...' if len(missing) > 12 else ''}"
+        )
@@ -5,23 +5,89 @@ Functions to pull and load CRSP mutual fund data
 - List of all tables: https://wrds-www.wharton.upenn.edu/data-dictionary/crsp_q_mutualfunds/
 - We use `monthly_tna_ret_nav` to pull TNA and monthly returns.
 - We use `fund_style` table to identify US Equity funds.
+- The combined file is stored as a dataset partitioned by year of `caldt`,
+  so date-restricted loads only read the overlapping years.
+- `pull_and_save_CRSP_combined_file` splits the full pull into yearly slices
+  that run concurrently on `PULL_WORKERS` connections.
+- Connections are borrowed from the pool in `wrds_tools`, so the pulls of one
+  process share a login.
+- `update_CRSP_combined_file` refreshes the dataset incrementally. Run
+  `python load_CRSP_fund.py --incremental` for a quarterly refresh.
+- `pull_CRSP_fund_level_file` is an optional variant that links share classes
+  to `wficn`, drops excluded Lipper classes and aggregates to the fund level on
+  the server, stored as `CRSP_fund_level` (run `python load_CRSP_fund.py --fund-level`).
 
 Author: Jonathan Cai [mcai@uchicago.edu]
 """
 
+import sys
 from datetime import datetime
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import wrds
+import pyarrow as pa
 
 import config
+from cache_tools import memoize_load
+from dtype_tools import DTYPE_BACKEND, backend_kwargs, compact_dtypes
+from parquet_tools import (
+    latest_date,
+    link_partitions,
+    read_partitioned,
+    staged_dataset,
+    write_parquet,
+    write_partitioned,
+)
+from wrds_tools import PULL_WORKERS, run_sliced, wrds_connection, year_slices
 
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 START_DATE = config.START_DATE
 END_DATE = config.END_DATE
+CRSP_OVERLAP_MONTHS = config.CRSP_OVERLAP_MONTHS
+
+# Columns of `a.*` (crsp.monthly_tna_ret_nav) followed by the joined style columns.
+# A fixed schema keeps yearly slices consistent when a column is empty in a year.
+CRSP_COMBINED_SCHEMA = pa.schema([
+    ("caldt", pa.timestamp("ns")),
+    ("crsp_fundno", pa.float64()),
+    ("mtna", pa.float64()),
+    ("mret", pa.float64()),
+    ("mnav", pa.float64()),
+    ("lipper_asset_cd", pa.string()),
+    ("lipper_class_name", pa.string()),
+    ("crsp_obj_cd", pa.string()),
+    ("index_fund_flag", pa.string()),
+])
+
+# Smaller dtypes applied by the loaders with `compact=True` (see `dtype_tools`)
+CRSP_COMPACT_DTYPES = {
+    "crsp_fundno": "int32",
+    "wficn": "int32",
+    "mnav": "float32",
+    "lipper_asset_cd": "category",
+    "lipper_class_name": "category",
+    "crsp_obj_cd": "category",
+    "index_fund_flag": "category",
+}
+
+# Row order of the stored files (entity, then date), see `parquet_tools`
+CRSP_SORT_COLUMNS = ["crsp_fundno", "caldt"]
+CRSP_FUND_LEVEL_SORT_COLUMNS = ["wficn", "caldt", "lipper_class_name", "index_fund_flag"]
+
+# Lipper classes outside the sample (matched case-insensitively)
+EXCLUDED_LIPPER_CLASSES = "International|Fixed Income|Precious Metal"
+
+CRSP_FUND_LEVEL_SCHEMA = pa.schema([
+    ("caldt", pa.timestamp("ns")),
+    ("wficn", pa.float64()),
+    ("lipper_class_name", pa.string()),
+    ("index_fund_flag", pa.string()),
+    ("mret", pa.float64()),
+    ("mret_tna", pa.float64()),
+    ("mtna", pa.float64()),
+])
 
 
 def pull_CRSP_combined_file(
@@ -59,30 +125,332 @@ def pull_CRSP_combined_file(
         SUBSTRING(b.crsp_obj_cd, 1, 2) = 'ED' AND
         a.caldt BETWEEN b.begdt AND b.enddt;
     """
-    with wrds.Connection(wrds_username=wrds_username) as db:
+    with wrds_connection(wrds_username) as db:
         df = db.raw_sql(query, date_cols=["caldt"])
 
     return df
 
 
+def pull_and_save_CRSP_combined_file(
+    data_dir: Path = DATA_DIR,
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+    max_workers: int = PULL_WORKERS,
+) -> int:
+    """
+    Pull CRSP mutual fund TNA and style data from WRDS into the year-partitioned dataset
+
+    The pull is split into yearly `caldt` slices that run concurrently on up to
+    `max_workers` connections, and each slice writes its own year partition.
+    Together the slices return exactly the rows of `pull_CRSP_combined_file`.
+    The existing dataset is only replaced once every slice has succeeded.
+
+    Args:
+    - data_dir: Path, root data directory.
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+    - max_workers: int, maximum number of concurrent slices (and connections)
+
+    Returns:
+    - n_rows: int, number of rows written
+    """
+    path = data_dir / "pulled" / "CRSP_fund_combined"
+    with staged_dataset(path) as tmp_path:
+
+        def pull_slice(start, end):
+            df = pull_CRSP_combined_file(start_date=start, end_date=end, wrds_username=wrds_username)
+            write_partitioned(
+                df, tmp_path, date_col="caldt", schema=CRSP_COMBINED_SCHEMA, sort_by=CRSP_SORT_COLUMNS
+            )
+            return len(df)
+
+        n_rows = run_sliced(pull_slice, year_slices(start_date, end_date), max_workers=max_workers)
+    return sum(n_rows)
+
+
+@memoize_load("CRSP_fund_combined", "CRSP_fund_combined.parquet")
 def load_CRSP_combined_file(
     data_dir: Path = DATA_DIR,
+    start_date: str = None,
+    end_date: str = None,
+    columns: list = None,
+    filters: list = None,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load CRSP mutual fund TNA and style data from WRDS
 
+    Only the year partitions overlapping [start_date, end_date] are read.
+    `columns` and `filters` are passed through to the pyarrow reader, so only
+    the requested columns are read and row groups that cannot match the filters
+    are skipped. A monolithic `CRSP_fund_combined.parquet` from an older pull is
+    still read if the partitioned dataset does not exist.
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
+
     Args:
     - data_dir: Path, root data directory.
+    - start_date: str, first `caldt` to load in "YYYY-MM-DD" format. No lower bound if None.
+    - end_date: str, last `caldt` to load in "YYYY-MM-DD" format. No upper bound if None.
+    - columns: list of str, columns to load. Loads every column if None.
+    - filters: list of tuples (or list of lists of tuples for OR), pyarrow row filters, e.g.
+      `[("crsp_obj_cd", "not in", ["EDYI"])]`
+    - compact: bool, cast to the smaller dtypes of `CRSP_COMPACT_DTYPES` (see `dtype_tools.compact_dtypes`)
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
 
     Returns:
     - df: pd.DataFrame, CRSP mutual fund TNA and style data
     """
-    path = data_dir / "pulled" / "CRSP_fund_combined.parquet"
-    if path.exists():
-        df = pd.read_parquet(path)
-    else:
-        df = pull_CRSP_combined_file()
-        df.to_parquet(path)
+    path = data_dir / "pulled" / "CRSP_fund_combined"
+    legacy_path = data_dir / "pulled" / "CRSP_fund_combined.parquet"
+    if not path.exists() and legacy_path.exists():
+        path = legacy_path
+    elif not path.exists():
+        pull_and_save_CRSP_combined_file(data_dir)
+    df = read_partitioned(
+        path, "caldt", start_date, end_date, columns=columns, filters=filters, dtype_backend=dtype_backend
+    )
+    if compact:
+        df = compact_dtypes(df, CRSP_COMPACT_DTYPES, name="CRSP_fund_combined")
+    return df
+
+
+def update_CRSP_combined_file(
+    data_dir: Path = DATA_DIR,
+    end_date: str = END_DATE,
+    overlap_months: int = CRSP_OVERLAP_MONTHS,
+    wrds_username: str = WRDS_USERNAME,
+    max_workers: int = PULL_WORKERS,
+) -> pd.DataFrame:
+    """
+    Incrementally refresh the local CRSP mutual fund dataset
+
+    Reads the latest `caldt` already stored, pulls only the months from
+    `overlap_months` before it through `end_date` (the overlap picks up
+    revisions to recent data), and replaces those months in the dataset.
+    The refreshed years are pulled in concurrent yearly slices, as by
+    `pull_and_save_CRSP_combined_file`, and the dataset is staged in the same
+    way: the other years are carried over (see `parquet_tools.link_partitions`),
+    and the existing dataset is only replaced once every slice has succeeded.
+    Falls back to a full pull if nothing is stored yet.
+
+    Args:
+    - data_dir: Path, root data directory.
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - overlap_months: int, number of already stored months to pull again
+    - wrds_username: str, WRDS username
+    - max_workers: int, maximum number of concurrent slices (and connections)
+
+    Returns:
+    - df: pd.DataFrame, the newly pulled rows
+    """
+    path = data_dir / "pulled" / "CRSP_fund_combined"
+    last_caldt = latest_date(path, "caldt") if path.exists() else None
+    if last_caldt is None:
+        pull_and_save_CRSP_combined_file(
+            data_dir, end_date=end_date, wrds_username=wrds_username, max_workers=max_workers
+        )
+        return load_CRSP_combined_file(data_dir)
+
+    start = (last_caldt - pd.DateOffset(months=overlap_months)).replace(day=1)
+    end = pd.Timestamp(end_date)
+    slices = year_slices(start.strftime("%Y-%m-%d"), end_date)
+    years = {pd.Timestamp(slice_start).year for slice_start, _ in slices}
+
+    # Partitions are replaced whole, so carry over the stored rows of the
+    # refreshed years that fall outside the pulled window
+    df_kept = read_partitioned(
+        path, "caldt", start_date=f"{start.year}-01-01", end_date=f"{end.year}-12-31", dtype_backend="numpy"
+    )
+    df_kept = df_kept[(df_kept["caldt"] < start) | (df_kept["caldt"] > end)]
+
+    with staged_dataset(path) as tmp_path:
+        link_partitions(path, tmp_path, skip_years=years)
+
+        def pull_slice(slice_start, slice_end):
+            df = pull_CRSP_combined_file(start_date=slice_start, end_date=slice_end, wrds_username=wrds_username)
+            year = pd.Timestamp(slice_start).year
+            write_partitioned(
+                pd.concat([df_kept[df_kept["caldt"].dt.year == year], df], ignore_index=True),
+                tmp_path,
+                date_col="caldt",
+                schema=CRSP_COMBINED_SCHEMA,
+                sort_by=CRSP_SORT_COLUMNS,
+            )
+            return df
+
+        dfs = run_sliced(pull_slice, slices, max_workers=max_workers)
+    return pd.concat(dfs, ignore_index=True)
+
+
+def pull_CRSP_fund_level_file(
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+) -> pd.DataFrame:
+    """
+    Pull CRSP mutual fund returns and TNA aggregated to the fund (wficn) level from WRDS
+
+    Applies the share-class steps of `factor_betas_calculation.monthly_mutual_fund`
+    in the query, on the same rows as `pull_CRSP_combined_file`:
+    - share classes are linked to `wficn` through `mfl.mflink1`, unlinked ones dropped.
+      A share class linked to several wficn goes to the lowest (as
+      `load_mflink.build_mflink1_index` with policy "lowest").
+    - missing `mret` counts as 0 and missing `lipper_class_name` as 'None'
+    - International, Fixed Income and Precious Metal classes are dropped
+    - share classes are collapsed by (caldt, wficn, lipper_class_name) into the mean
+      return `mret`, the `mtna`-weighted return `mret_tna` (the mean where no share
+      class has a positive `mtna`), and the summed TNA `mtna` (missing as 0)
+    - each fund-month is repeated for every distinct `index_fund_flag` of its share classes
+
+    Args:
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+
+    Returns:
+    - df: pd.DataFrame, fund-level monthly returns and TNA
+    """
+    # Case-insensitive substring matches, as `str.contains(..., case=False)`
+    excluded_classes = " OR ".join(
+        f"COALESCE(b.lipper_class_name, 'None') ILIKE '%{name}%'" for name in EXCLUDED_LIPPER_CLASSES.split("|")
+    )
+    query = f"""
+    WITH share_classes AS (
+        SELECT
+            a.caldt, l.wficn, COALESCE(b.lipper_class_name, 'None') AS lipper_class_name,
+            c.index_fund_flag, COALESCE(a.mret, 0) AS mret, a.mtna
+        FROM
+            crsp.monthly_tna_ret_nav a
+        JOIN
+            crsp.fund_style b
+        ON
+            a.crsp_fundno = b.crsp_fundno
+        JOIN (
+            SELECT crsp_fundno, MIN(wficn) AS wficn FROM mfl.mflink1 GROUP BY crsp_fundno
+        ) l
+        ON
+            a.crsp_fundno = l.crsp_fundno
+        LEFT JOIN
+            crsp.fund_hdr c
+        ON
+            a.crsp_fundno = c.crsp_fundno
+        WHERE
+            a.caldt BETWEEN '{start_date}' AND '{end_date}' AND
+            SUBSTRING(b.crsp_obj_cd, 1, 2) = 'ED' AND
+            a.caldt BETWEEN b.begdt AND b.enddt AND
+            l.wficn IS NOT NULL AND
+            NOT ({excluded_classes})
+    ),
+    funds AS (
+        SELECT
+            caldt, wficn, lipper_class_name,
+            AVG(mret) AS mret,
+            COALESCE(
+                SUM(CASE WHEN mtna > 0 THEN mtna * mret END)
+                / SUM(CASE WHEN mtna > 0 THEN mtna END),
+                AVG(mret)
+            ) AS mret_tna,
+            COALESCE(SUM(mtna), 0) AS mtna
+        FROM
+            share_classes
+        GROUP BY
+            caldt, wficn, lipper_class_name
+    ),
+    flags AS (
+        SELECT DISTINCT
+            caldt, wficn, lipper_class_name, index_fund_flag
+        FROM
+            share_classes
+    )
+    SELECT
+        f.caldt, f.wficn, f.lipper_class_name, g.index_fund_flag, f.mret, f.mret_tna, f.mtna
+    FROM
+        funds f
+    JOIN
+        flags g
+    ON
+        f.caldt = g.caldt AND f.wficn = g.wficn AND f.lipper_class_name = g.lipper_class_name;
+    """
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query, date_cols=["caldt"])
+
+    return df
+
+
+def pull_and_save_CRSP_fund_level_file(
+    data_dir: Path = DATA_DIR,
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+    max_workers: int = PULL_WORKERS,
+) -> int:
+    """
+    Pull fund-level CRSP mutual fund data from WRDS into the year-partitioned dataset
+
+    Runs as concurrent yearly slices, like `pull_and_save_CRSP_combined_file`.
+
+    Args:
+    - data_dir: Path, root data directory.
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+    - max_workers: int, maximum number of concurrent slices (and connections)
+
+    Returns:
+    - n_rows: int, number of rows written
+    """
+    path = data_dir / "pulled" / "CRSP_fund_level"
+    with staged_dataset(path) as tmp_path:
+
+        def pull_slice(start, end):
+            df = pull_CRSP_fund_level_file(start_date=start, end_date=end, wrds_username=wrds_username)
+            write_partitioned(
+                df, tmp_path, date_col="caldt", schema=CRSP_FUND_LEVEL_SCHEMA, sort_by=CRSP_FUND_LEVEL_SORT_COLUMNS
+            )
+            return len(df)
+
+        n_rows = run_sliced(pull_slice, year_slices(start_date, end_date), max_workers=max_workers)
+    return sum(n_rows)
+
+
+@memoize_load("CRSP_fund_level")
+def load_CRSP_fund_level_file(
+    data_dir: Path = DATA_DIR,
+    start_date: str = None,
+    end_date: str = None,
+    columns: list = None,
+    filters: list = None,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
+) -> pd.DataFrame:
+    """
+    Load fund-level CRSP mutual fund data, pulling it if needed
+
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
+
+    Args:
+    - data_dir: Path, root data directory.
+    - start_date: str, first `caldt` to load in "YYYY-MM-DD" format. No lower bound if None.
+    - end_date: str, last `caldt` to load in "YYYY-MM-DD" format. No upper bound if None.
+    - columns: list of str, columns to load. Loads every column if None.
+    - filters: list of tuples (or list of lists of tuples for OR), pyarrow row filters
+    - compact: bool, cast to the smaller dtypes of `CRSP_COMPACT_DTYPES` (see `dtype_tools.compact_dtypes`)
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
+
+    Returns:
+    - df: pd.DataFrame, fund-level monthly returns and TNA
+    """
+    path = data_dir / "pulled" / "CRSP_fund_level"
+    if not path.exists():
+        pull_and_save_CRSP_fund_level_file(data_dir)
+    df = read_partitioned(
+        path, "caldt", start_date, end_date, columns=columns, filters=filters, dtype_backend=dtype_backend
+    )
+    if compact:
+        df = compact_dtypes(df, CRSP_COMPACT_DTYPES, name="CRSP_fund_level")
     return df
 
 
@@ -106,17 +474,14 @@ def pull_CRSP_TNA_file(
     Returns:
     - df: pd.DataFrame, CRSP mutual fund TNA and return data
     """
-    # Connect to WRDS
-    db = wrds.Connection(wrds_username=wrds_username)
     query = f"""
     SELECT * 
     FROM crsp.monthly_tna_ret_nav
     WHERE 
         caldt BETWEEN '{start_date}' AND '{end_date}'
     """
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=["caldt"])
-    db.close()
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query, date_cols=["caldt"])
 
     return df
 
@@ -137,8 +502,6 @@ def pull_CRSP_fund_style_file(
     Returns:
     - df: pd.DataFrame, CRSP mutual fund style data
     """
-    # Connect to WRDS
-    db = wrds.Connection(wrds_username=wrds_username)
     query = f"""
     SELECT 
         crsp_fundno, begdt, enddt, lipper_asset_cd, lipper_class_name, policy
@@ -146,52 +509,53 @@ def pull_CRSP_fund_style_file(
     WHERE 
         enddt >= '{start_date}'
     """
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=["begdt", "enddt"])
-    db.close()
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query, date_cols=["begdt", "enddt"])
 
     return df
 
 
 def load_CRSP_TNA_file(
     data_dir: Path = DATA_DIR,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load CRSP mutual fund TNA and return data from WRDS
 
     Args:
     - data_dir: Path, root data directory.
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
 
     Returns:
     - df: pd.DataFrame, CRSP mutual fund TNA and return data
     """
     path = data_dir / "pulled" / "CRSP_fund_tna.parquet"
-    if path.exists():
-        df = pd.read_parquet(path)
-    else:
+    if not path.exists():
         df = pull_CRSP_TNA_file()
-        df.to_parquet(path)
+        write_parquet(df, path, sort_by=CRSP_SORT_COLUMNS)
+    df = pd.read_parquet(path, **backend_kwargs(dtype_backend))
     return df
 
 
 def load_CRSP_fund_style_file(
     data_dir: Path = DATA_DIR,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load CRSP mutual fund style data from WRDS
 
     Args:
     - data_dir: Path, root data directory.
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
 
     Returns:
     - df: pd.DataFrame, CRSP mutual fund style data
     """
     path = data_dir / "pulled" / "CRSP_fund_style.parquet"
-    if path.exists():
-        df = pd.read_parquet(path)
-    else:
+    if not path.exists():
         df = pull_CRSP_fund_style_file()
-        df.to_parquet(path)
+        write_parquet(df, path, sort_by=["crsp_fundno", "begdt"])
+    df = pd.read_parquet(path, **backend_kwargs(dtype_backend))
     return df
 
 if __name__ == "__main__":
@@ -204,6 +568,9 @@ if __name__ == "__main__":
     # path = Path(DATA_DIR) / "pulled" / "CRSP_fund_style.parquet"
     # df_style.to_parquet(path)
 
-    df_combined = pull_CRSP_combined_file(start_date=START_DATE, end_date=END_DATE)
-    path = Path(DATA_DIR) / "pulled" / "CRSP_fund_combined.parquet"
-    df_combined.to_parquet(path)
+    if "--incremental" in sys.argv[1:]:
+        update_CRSP_combined_file(end_date=END_DATE)
+    elif "--fund-level" in sys.argv[1:]:
+        pull_and_save_CRSP_fund_level_file(DATA_DIR, start_date=START_DATE, end_date=END_DATE)
+    else:
+        pull_and_save_CRSP_combined_file(DATA_DIR, start_date=START_DATE, end_date=END_DATE)
@@ -1,10 +1,75 @@
+"""
+Functions to load macro series from FRED
+
+- Series are cached in `data/pulled/fred.parquet`, together with the date range
+  each series has been fetched for (`fred_coverage.json`).
+- Loading from the cache only fetches the parts of [start, end] that a series
+  does not cover yet, and adds them to the cache.
+- Data comes from a source function, `fred_source` (FRED through
+  pandas_datareader) by default. `frame_source` turns a local DataFrame into a
+  source, so that tests run offline.
+"""
+
+import json
+from datetime import date
+
 import pandas as pd
 import pandas_datareader
 import config
 from pathlib import Path
 
+from dtype_tools import DTYPE_BACKEND, backend_kwargs
+from parquet_tools import write_parquet
+
 DATA_DIR = Path(config.DATA_DIR)
 
+FRED_SERIES = ["CPIAUCNS", "GDP", "GDPC1"]
+
+
+def fred_source(series, start, end):
+    """
+    Fetch `series` between `start` and `end` from FRED
+
+    Returns:
+    - df: pd.DataFrame, one column per series, indexed by DATE
+    """
+    return pandas_datareader.get_data_fred(series, start=start, end=end)
+
+
+def frame_source(df_source):
+    """
+    Build a source serving `series` between `start` and `end` from a local DataFrame
+
+    Args:
+    - df_source: pd.DataFrame, one column per series, indexed by date
+
+    Returns:
+    - source: callable with the signature of `fred_source`
+    """
+    def source(series, start, end):
+        return df_source.loc[pd.Timestamp(start):pd.Timestamp(end), list(series)]
+
+    return source
+
+
+def _missing_ranges(coverage, start, end):
+    """
+    Ranges to fetch so that the covered (first, last) range includes [start, end]
+
+    The ranges adjoin the covered one, so that the coverage stays a single range.
+    """
+    if end < start:
+        return []
+    if coverage is None:
+        return [(start, end)]
+    first, last = (pd.Timestamp(d) for d in coverage)
+    ranges = []
+    if start < first:
+        ranges.append((start, first - pd.Timedelta(days=1)))
+    if end > last:
+        ranges.append((last + pd.Timedelta(days=1), end))
+    return ranges
+
 
 def load_fred(
     data_dir=DATA_DIR,
@@ -12,29 +77,73 @@ def load_fred(
     save_cache=False,
     start="1913-01-01",
     end="2023-10-01",
+    dtype_backend=DTYPE_BACKEND,
+    series=FRED_SERIES,
+    source=fred_source,
 ):
     """
-    Must first run pull_and_save_fred_data. If loading from cache, then start
-    and dates are ignored
+    Load FRED series between `start` and `end`
+
+    With `from_cache=True` the cache must exist (run this module first, or
+    `from_cache=False, save_cache=True`); only the ranges it does not cover are
+    fetched from `source`, and saved to it. With `from_cache=False` the whole
+    range is fetched, and replaces the cache if `save_cache`. Data is covered
+    up to at most today, so later releases are fetched when they are requested.
+
+    Args:
+    - data_dir: Path, root data directory
+    - from_cache: bool, read `pulled/fred.parquet` and fetch only what it is missing
+    - save_cache: bool, with `from_cache=False`, overwrite the cache with the result
+    - start: str, first date in "YYYY-MM-DD" format
+    - end: str, last date in "YYYY-MM-DD" format
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
+    - series: list of str, FRED series ids
+    - source: callable(series, start, end) returning a DataFrame indexed by date,
+      e.g. `fred_source` or `frame_source(df)`
+
+    Returns:
+    - df: pd.DataFrame, one column per series, indexed by DATE
     """
+    file_dir = Path(data_dir) / "pulled"
+    file_path = file_dir / "fred.parquet"
+    coverage_path = file_dir / "fred_coverage.json"
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    series = list(series)
+
     if from_cache:
-        file_path = Path(data_dir) / "pulled" / "fred.parquet"
-        # df = pd.read_csv(file_path, parse_dates=["DATE"])
         df = pd.read_parquet(file_path)
-        # df = df.set_index("DATE")
+        # Caches saved before coverage was tracked cover the dates they hold
+        coverage = json.loads(coverage_path.read_text()) if coverage_path.exists() else {
+            col: [str(df.index.min().date()), str(df.index.max().date())] for col in df.columns
+        }
     else:
-        # Load CPI, nominal GDP, and real GDP data from FRED, seasonally adjusted
-        df = pandas_datareader.get_data_fred(
-            ["CPIAUCNS", "GDP", "GDPC1"], start=start, end=end
-        )
-        if save_cache:
-            file_dir = Path(data_dir) / "pulled"
-            file_dir.mkdir(parents=True, exist_ok=True)
-            # df.to_csv(file_dir / "fred_cpi.csv")
-            df.to_parquet(file_dir / 'fred.parquet')
-
-    # df.info()
-    # df = pd.read_parquet(file_path)
+        df = pd.DataFrame(index=pd.DatetimeIndex([], name="DATE"))
+        coverage = {}
+
+    # Fetch each missing range once, for every series missing it
+    today = pd.Timestamp(date.today())
+    fetches = {}
+    for col in series:
+        for rng in _missing_ranges(coverage.get(col), start, min(end, today)):
+            fetches.setdefault(rng, []).append(col)
+    for (fetch_start, fetch_end), cols in fetches.items():
+        df_new = source(cols, fetch_start, fetch_end)
+        df = df_new.combine_first(df) if len(df) else df_new
+        for col in cols:
+            first, last = coverage.get(col, (fetch_start, fetch_end))
+            coverage[col] = [
+                str(min(pd.Timestamp(first), fetch_start).date()),
+                str(max(pd.Timestamp(last), fetch_end).date()),
+            ]
+
+    if fetches and (from_cache or save_cache):
+        file_dir.mkdir(parents=True, exist_ok=True)
+        write_parquet(df.sort_index(), file_path)
+        coverage_path.write_text(json.dumps(coverage, indent=1, sort_keys=True))
+
+    df = df.sort_index().loc[start:end].reindex(columns=series)
+    if backend_kwargs(dtype_backend):
+        df = df.convert_dtypes(dtype_backend=dtype_backend)
     return df
 
 
@@ -44,5 +153,5 @@ def demo():
 
 if __name__ == "__main__":
     # Pull and save cache of fred data
-    _ = load_fred(start="1913-01-01", end="2023-10-01", 
+    _ = load_fred(start="1913-01-01", end="2023-10-01",
         data_dir=DATA_DIR, from_cache=False, save_cache=True)
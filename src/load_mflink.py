@@ -1,6 +1,16 @@
 """
 Functions to pull MFLink data
 
+- Both link tables are pulled on one pooled connection (see `wrds_tools`).
+- `load_mflink1_index` compiles MFLINK1 into a dense array indexed by
+  crsp_fundno, so linking CRSP rows to wficn is a single gather instead of a
+  merge. A crsp_fundno linked to several wficn gets one of them (or none), so
+  rows are never duplicated.
+- MFLINK2 links S12 fundno to wficn at given dates. `load_mflink2_intervals`
+  turns it into the interval each link date is the nearest for, cached in
+  `data/intermediate`, and `resolve_s12_wficn` links holdings to wficn with one
+  binary search per row, without sorting or merging the holdings.
+
 Author: Jonathan Cai [mcai@uchicago.edu]
 """
 
@@ -9,13 +19,32 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import wrds
 
 import config
+from cache_tools import cached_arrays, memoize_load
+from dtype_tools import DTYPE_BACKEND, backend_kwargs, compact_dtypes
+from parquet_tools import write_parquet
+from wrds_tools import wrds_connection
 
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 
+# Smaller dtypes applied by the loaders with `compact=True` (see `dtype_tools`)
+MFLINK_COMPACT_DTYPES = {
+    "crsp_fundno": "int32",
+    "fundno": "int32",
+    "wficn": "int32",
+}
+
+# How a crsp_fundno linked to several wficn in MFLINK1 is resolved:
+# "lowest" keeps the lowest wficn, "drop" leaves the crsp_fundno unlinked
+MFLINK1_POLICIES = ("lowest", "drop")
+
+# Interval keys pack (fundno, day) into one int64: fundno in the high 32 bits, days
+# since 1970 shifted to be non-negative in the low 32 bits
+_DAY_OFFSET = 2**31
+_LAST_DAY = 2**31 - 1  # upper bound of the last interval of each fundno
+
 
 def pull_mflink1(
     wrds_username: str = WRDS_USERNAME,
@@ -25,20 +54,28 @@ def pull_mflink1(
     """
     # Connect to WRDS
     query = "SELECT * from mfl.mflink1"
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query)
-    db.close()
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query)
     return df
 
 
+@memoize_load("mflink1.parquet")
 def load_mflink1(
     data_dir: Path = DATA_DIR,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load crsp_fundno to wficn mapping
+
+    With `compact=True` the ids are cast to 32-bit integers and the memory saved is reported.
+    `dtype_backend` selects NumPy ("numpy", "numpy_nullable") or Arrow ("pyarrow") dtypes.
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
     """
     path = data_dir / "pulled" / "mflink1.parquet"
-    df = pd.read_parquet(path)
+    df = pd.read_parquet(path, **backend_kwargs(dtype_backend))
+    if compact:
+        df = compact_dtypes(df, MFLINK_COMPACT_DTYPES, name="mflink1")
     return df
 
 
@@ -50,28 +87,262 @@ def pull_mflink2(
     """
     # Connect to WRDS
     query = "SELECT * from mfl.mflink2"
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=['fdate'])
-    db.close()
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query, date_cols=['fdate'])
     return df
 
 
+@memoize_load("mflink2.parquet")
 def load_mflink2(
     data_dir: Path = DATA_DIR,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load s12 fundno to wficn mapping
+
+    With `compact=True` the ids are cast to 32-bit integers and the memory saved is reported.
+    `dtype_backend` selects NumPy ("numpy", "numpy_nullable") or Arrow ("pyarrow") dtypes.
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
     """
     path = data_dir / "pulled" / "mflink2.parquet"
-    df = pd.read_parquet(path)
+    df = pd.read_parquet(path, **backend_kwargs(dtype_backend))
+    if compact:
+        df = compact_dtypes(df, MFLINK_COMPACT_DTYPES, name="mflink2")
     return df
 
 
-if __name__ == "__main__":
-    df_link1 = pull_mflink1()
-    path = Path(DATA_DIR) / "pulled" / "mflink1.parquet"
-    df_link1.to_parquet(path)
+def build_mflink1_index(
+    df_mflink1: pd.DataFrame,
+    policy: str = "lowest",
+) -> dict:
+    """
+    Compile MFLINK1 into a dense crsp_fundno -> wficn array
+
+    Args:
+    - df_mflink1: pd.DataFrame, with columns crsp_fundno and wficn
+    - policy: str, for crsp_fundno linked to several wficn: "lowest" keeps the
+      lowest wficn, "drop" leaves them unlinked
+
+    Returns:
+    - index: dict of np.ndarray: `wficn` (float64, position crsp_fundno holds its
+      wficn, NaN if unlinked) and `ambiguous` (the crsp_fundno linked to several wficn)
+    """
+    if policy not in MFLINK1_POLICIES:
+        raise ValueError(f"Unknown policy: {policy!r}")
+    df = df_mflink1[df_mflink1["crsp_fundno"].notnull() & df_mflink1["wficn"].notnull()]
+    crsp_fundno = df["crsp_fundno"].to_numpy(dtype="int64")
+    wficn = df["wficn"].to_numpy(dtype="float64")
+
+    # Distinct (crsp_fundno, wficn) pairs, lowest wficn first
+    order = np.lexsort((wficn, crsp_fundno))
+    crsp_fundno, wficn = crsp_fundno[order], wficn[order]
+    distinct = np.ones(len(crsp_fundno), dtype=bool)
+    distinct[1:] = (crsp_fundno[1:] != crsp_fundno[:-1]) | (wficn[1:] != wficn[:-1])
+    crsp_fundno, wficn = crsp_fundno[distinct], wficn[distinct]
+    first = np.ones(len(crsp_fundno), dtype=bool)
+    first[1:] = crsp_fundno[1:] != crsp_fundno[:-1]
+    n_links = np.diff(np.r_[np.flatnonzero(first), len(crsp_fundno)])
+    ambiguous = crsp_fundno[first][n_links > 1]
+
+    index = np.full(crsp_fundno.max() + 1 if len(crsp_fundno) else 0, np.nan)
+    index[crsp_fundno[first]] = wficn[first]
+    if policy == "drop":
+        index[ambiguous] = np.nan
+    return {"wficn": index, "ambiguous": ambiguous}
+
+
+def load_mflink1_index(
+    data_dir: Path = DATA_DIR,
+    policy: str = "lowest",
+    use_cache: bool = True,
+) -> dict:
+    """
+    Load the MFLINK1 index of `build_mflink1_index`
+
+    The index is saved in `data_dir / "intermediate"` and rebuilt whenever
+    `mflink1.parquet` changes.
+
+    Args:
+    - data_dir: Path, root data directory
+    - policy: str, "lowest" or "drop" (see `build_mflink1_index`)
+    - use_cache: bool, set to False to rebuild the index
+
+    Returns:
+    - index: dict of np.ndarray
+    """
+    data_dir = Path(data_dir)
+    return cached_arrays(
+        "mflink1_index",
+        lambda: build_mflink1_index(load_mflink1(data_dir, dtype_backend="numpy"), policy=policy),
+        inputs=[data_dir / "pulled" / "mflink1.parquet"],
+        params={"policy": policy},
+        cache_dir=data_dir / "intermediate",
+        use_cache=use_cache,
+    )
+
+
+def link_crsp_wficn(
+    crsp_fundno,
+    index: dict,
+) -> tuple:
+    """
+    Look up the wficn of each crsp_fundno in an MFLINK1 index
+
+    Args:
+    - crsp_fundno: array-like, crsp_fundno of each row, may contain NaN
+    - index: dict of np.ndarray, from `load_mflink1_index`
+
+    Returns:
+    - wficn: np.ndarray, float64 aligned with `crsp_fundno`, NaN where unlinked
+    - n_ambiguous: int, number of rows whose crsp_fundno MFLINK1 links to several
+      wficn (linked to one of them, or left unlinked, by the policy of the index)
+    """
+    crsp_fundno = pd.Series(crsp_fundno).to_numpy(dtype="float64", na_value=np.nan)
+    wficn = index["wficn"]
+    known = (crsp_fundno >= 0) & (crsp_fundno < len(wficn))
+    pos = np.where(known, crsp_fundno, 0).astype(np.intp)
+    n_ambiguous = int(np.isin(crsp_fundno, index["ambiguous"]).sum())
+    return np.where(known, wficn[pos] if len(wficn) else np.nan, np.nan), n_ambiguous
+
+
+def _interval_keys(
+    fundno: np.ndarray,
+    days: np.ndarray,
+) -> np.ndarray:
+    """Sortable int64 keys of (fundno, days since 1970)"""
+    return (fundno.astype("int64") << 32) | (days.astype("int64") + _DAY_OFFSET)
+
+
+def build_mflink2_intervals(
+    df_mflink2: pd.DataFrame,
+) -> dict:
+    """
+    Turn MFLINK2 into the date intervals over which each link date is the nearest
+
+    For a fundno with link dates d_1 < ... < d_n, link i covers the dates after
+    the midpoint of (d_{i-1}, d_i) up to and including the midpoint of
+    (d_i, d_{i+1}), so equidistant dates go to the earlier link, as in
+    `pd.merge_asof(direction="nearest")`. The first and last links extend
+    without bound. If a (fundno, fdate) has several wficn, the lowest is used.
 
-    df_link2 = pull_mflink2()
-    path = Path(DATA_DIR) / "pulled" / "mflink2.parquet"
-    df_link2.to_parquet(path)
+    Args:
+    - df_mflink2: pd.DataFrame, with columns fundno, fdate, wficn
+
+    Returns:
+    - intervals: dict of np.ndarray, one entry per (fundno, link date) sorted by `keys`:
+      `keys` (fundno and last day of the interval, see `_interval_keys`), `fundno`,
+      `link_days` and `upper_days` (days since 1970), `wficn` (float64, NaN if missing)
+    """
+    df = df_mflink2[df_mflink2["fundno"].notnull() & df_mflink2["fdate"].notnull()]
+    fundno = df["fundno"].to_numpy(dtype="int64")
+    days = df["fdate"].to_numpy(dtype="datetime64[D]").astype("int64")
+    wficn = df["wficn"].to_numpy(dtype="float64", na_value=np.nan)
+
+    # Lowest wficn of each (fundno, fdate): NaN sorts last
+    order = np.lexsort((wficn, days, fundno))
+    fundno, days, wficn = fundno[order], days[order], wficn[order]
+    first = np.ones(len(fundno), dtype=bool)
+    first[1:] = (fundno[1:] != fundno[:-1]) | (days[1:] != days[:-1])
+    fundno, days, wficn = fundno[first], days[first], wficn[first]
+
+    upper = np.full(len(days), _LAST_DAY, dtype="int64")
+    same_fund = fundno[1:] == fundno[:-1]
+    upper[:-1][same_fund] = (days[:-1][same_fund] + days[1:][same_fund]) // 2
+    return {
+        "keys": _interval_keys(fundno, upper),
+        "fundno": fundno,
+        "link_days": days,
+        "upper_days": upper,
+        "wficn": wficn,
+    }
+
+
+def load_mflink2_intervals(
+    data_dir: Path = DATA_DIR,
+    use_cache: bool = True,
+) -> dict:
+    """
+    Load the MFLINK2 link intervals of `build_mflink2_intervals`
+
+    The intervals are saved in `data_dir / "intermediate"` and rebuilt whenever
+    `mflink2.parquet` changes.
+
+    Args:
+    - data_dir: Path, root data directory
+    - use_cache: bool, set to False to rebuild the intervals
+
+    Returns:
+    - intervals: dict of np.ndarray
+    """
+    data_dir = Path(data_dir)
+    return cached_arrays(
+        "mflink2_intervals",
+        lambda: build_mflink2_intervals(load_mflink2(data_dir, dtype_backend="numpy")),
+        inputs=[data_dir / "pulled" / "mflink2.parquet"],
+        cache_dir=data_dir / "intermediate",
+        use_cache=use_cache,
+    )
+
+
+def resolve_s12_wficn(
+    df_s12: pd.DataFrame,
+    intervals: dict,
+    tolerance_days: int = None,
+) -> tuple:
+    """
+    Link S12 holdings to the wficn of the nearest MFLINK2 date of their fundno
+
+    Gives the same wficn as `pd.merge_asof(df_s12, df_mflink2, by="fundno",
+    on="fdate", direction="nearest")` (with the lowest wficn for duplicated
+    link dates), aligned with `df_s12` as it is: no sort and no merge.
+
+    Args:
+    - df_s12: pd.DataFrame, with columns fundno and fdate
+    - intervals: dict of np.ndarray, from `load_mflink2_intervals`
+    - tolerance_days: int, leave rows whose nearest link date is further away
+      unlinked. No limit if None.
+
+    Returns:
+    - wficn: pd.Series, float64 with the index of `df_s12`, NaN where unlinked
+    - n_outside: int, number of rows outside every link interval (fundno not in
+      MFLINK2, or beyond `tolerance_days`)
+    """
+    fundno = df_s12["fundno"].to_numpy(dtype="float64", na_value=np.nan)
+    fdate = df_s12["fdate"].to_numpy(dtype="datetime64[D]")
+    valid = ~np.isnan(fundno) & ~np.isnat(fdate)
+    days = fdate.astype("int64")
+
+    if len(intervals["keys"]) == 0:
+        return pd.Series(np.nan, index=df_s12.index, name="wficn"), len(df_s12)
+
+    keys = _interval_keys(np.where(valid, fundno, 0), np.where(valid, days, 0))
+    # First interval ending on or after fdate; it belongs to the same fundno unless
+    # the fundno has no links
+    pos = np.minimum(np.searchsorted(intervals["keys"], keys, side="left"), len(intervals["keys"]) - 1)
+    matched = valid & (intervals["fundno"][pos] == fundno)
+    if tolerance_days is not None:
+        matched &= np.abs(days - intervals["link_days"][pos]) <= tolerance_days
+
+    wficn = np.where(matched, intervals["wficn"][pos], np.nan)
+    return pd.Series(wficn, index=df_s12.index, name="wficn"), int((~matched).sum())
+
+
+def pull_and_save_mflink(
+    data_dir: Path = DATA_DIR,
+    wrds_username: str = WRDS_USERNAME,
+) -> None:
+    """
+    Pull both link tables and save them to `data_dir / "pulled"`
+    """
+    df_link1 = pull_mflink1(wrds_username=wrds_username)
+    path = Path(data_dir) / "pulled" / "mflink1.parquet"
+    write_parquet(df_link1, path, sort_by=["crsp_fundno", "wficn"])
+
+    df_link2 = pull_mflink2(wrds_username=wrds_username)
+    path = Path(data_dir) / "pulled" / "mflink2.parquet"
+    write_parquet(df_link2, path, sort_by=["fundno", "fdate"])
+
+
+if __name__ == "__main__":
+    pull_and_save_mflink(DATA_DIR, WRDS_USERNAME)
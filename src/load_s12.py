@@ -2,6 +2,15 @@
 Functions to pull and load CRSP mutual fund data
 
 - Link to table: https://wrds-www.wharton.upenn.edu/data-dictionary/tr_mutualfunds/s12/
+- The pulled data is stored as a dataset partitioned by year of `fdate`,
+  so date-restricted loads only read the overlapping years.
+- `pull_and_save_s12` splits the pull into yearly slices that run concurrently
+  on `PULL_WORKERS` connections. Each slice streams through a server-side cursor
+  in chunks of `S12_CHUNKSIZE` rows, so the full result is never held in memory.
+- Connections are borrowed from the pool in `wrds_tools`.
+- `pull_s12_fund_year` is a much smaller variant that links S12 to `wficn`
+  and reduces it to one row per (wficn, year) on the server, reproducing the
+  S12 steps of `02_raw_data_walkthrough.ipynb`.
 
 Author: Jonathan Cai [mcai@uchicago.edu]
 """
@@ -11,35 +20,44 @@ from pathlib import Path
 
 import numpy as np
 import pandas as pd
-import wrds
+import pyarrow as pa
+import sqlalchemy as sa
 
 import config
+from cache_tools import memoize_load
+from dtype_tools import DTYPE_BACKEND, backend_kwargs, compact_dtypes
+from parquet_tools import read_partitioned, staged_dataset, write_parquet, write_partitioned_chunks
+from wrds_tools import PULL_WORKERS, run_sliced, wrds_connection, year_slices
 
 DATA_DIR = Path(config.DATA_DIR)
 WRDS_USERNAME = config.WRDS_USERNAME
 START_DATE = config.START_DATE
 END_DATE = config.END_DATE
 
-def pull_s12(
-    start_date: str = START_DATE,
-    end_date: str = END_DATE,
-    wrds_username: str = WRDS_USERNAME,
-) -> pd.DataFrame:
-    """
-    Pull S12 data from WRDS.
+S12_CHUNKSIZE = 500_000
+S12_SCHEMA = pa.schema([
+    ("fdate", pa.timestamp("ns")),
+    ("fundno", pa.float64()),
+    ("rdate", pa.timestamp("ns")),
+    ("assets", pa.float64()),
+    ("stkcdesc", pa.string()),
+    ("us", pa.int64()),
+    ("useq_tna_k", pa.float64()),
+])
 
-    Args:
-    - start_date: str, start date in "YYYY-MM-DD" format
-    - end_date: str, end date in "YYYY-MM-DD" format
-    - wrds_username: str, WRDS username
+# Smaller dtypes applied by the loaders with `compact=True` (see `dtype_tools`)
+S12_COMPACT_DTYPES = {
+    "fundno": "int32",
+    "wficn": "int32",
+    "year": "int16",
+    "us": "int8",
+    "stkcdesc": "category",
+}
 
-    Returns:
-    - df: pd.DataFrame, S12 data
-    """
-    # Connect to WRDS
-    db = wrds.Connection(wrds_username=wrds_username)
-    
-    query = f"""
+
+def _s12_query(start_date: str, end_date: str) -> str:
+    """SQL for the S12 holdings aggregated to (fdate, fundno, rdate, assets, stkcdesc, us)"""
+    return f"""
     SELECT
     fdate,
     fundno,
@@ -60,31 +78,337 @@ def pull_s12(
     assets,
     stkcdesc,
     us
+    ORDER BY
+    fundno,
+    fdate,
+    rdate,
+    assets,
+    stkcdesc,
+    us
+    """
+
+
+def pull_s12(
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+) -> pd.DataFrame:
     """
+    Pull S12 data from WRDS.
+
+    Args:
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
 
-    db = wrds.Connection(wrds_username=wrds_username)
-    df = db.raw_sql(query, date_cols=["fdate", "rdate"])
-    db.close()
+    Returns:
+    - df: pd.DataFrame, S12 data
+    """
+    query = _s12_query(start_date, end_date)
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query, date_cols=["fdate", "rdate"])
     return df
 
+def _stream_s12_slice(
+    path: Path,
+    start_date: str,
+    end_date: str,
+    wrds_username: str,
+    chunksize: int,
+) -> int:
+    """Stream one date slice of the S12 query into the dataset at `path`"""
+    query = _s12_query(start_date, end_date)
+    with wrds_connection(wrds_username) as db:
+        # Server-side (named) cursors only live inside a transaction, so the
+        # pooled connection leaves the autocommit mode used by `wrds` for the
+        # duration of the slice (for the dialect's default level, READ COMMITTED
+        # on Postgres), and is put back into it afterwards
+        conn = db.connection.execution_options(
+            isolation_level=db.connection.default_isolation_level, stream_results=True, max_row_buffer=chunksize
+        )
+        try:
+            with conn.begin():
+                chunks = pd.read_sql_query(
+                    sa.text(query), conn, parse_dates=["fdate", "rdate"], chunksize=chunksize
+                )
+                n_rows = write_partitioned_chunks(chunks, path, "fdate", S12_SCHEMA)
+        finally:
+            db.connection.execution_options(isolation_level="AUTOCOMMIT")
+    return n_rows
+
+
+def pull_and_save_s12(
+    data_dir: Path = DATA_DIR,
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+    chunksize: int = S12_CHUNKSIZE,
+    max_workers: int = PULL_WORKERS,
+) -> int:
+    """
+    Pull S12 data from WRDS and stream it into the year-partitioned dataset.
+
+    The pull is split into yearly `fdate` slices that run concurrently on up
+    to `max_workers` connections. Since `fdate` is a grouping key of the query,
+    the slices together return exactly the rows of `pull_s12`. Each slice runs
+    through a server-side cursor and is fetched `chunksize` rows at a time, and
+    each chunk is appended to the slice's year partition as a parquet row group.
+    The existing dataset is only replaced once every slice has succeeded.
+
+    Args:
+    - data_dir: Path, path to data directory
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+    - chunksize: int, number of rows fetched and written at a time per slice
+    - max_workers: int, maximum number of concurrent slices (and connections)
+
+    Returns:
+    - n_rows: int, number of rows written
+    """
+    path = data_dir / "pulled" / "s12"
+    with staged_dataset(path) as tmp_path:
+        n_rows = run_sliced(
+            lambda start, end: _stream_s12_slice(tmp_path, start, end, wrds_username, chunksize),
+            year_slices(start_date, end_date),
+            max_workers=max_workers,
+        )
+    return sum(n_rows)
+
+
+def _s12_fund_year_query(start_date: str, end_date: str) -> str:
+    """SQL for S12 linked to wficn and reduced to the last report of each (wficn, year)"""
+    return f"""
+    WITH holdings AS (
+        SELECT
+        fdate,
+        fundno,
+        COALESCE(assets, 0) AS assets,
+        SUM(shares * prc / 1000.0) AS useq_tna_k
+        FROM
+        tfn.s12
+        WHERE
+            fdate >= '{start_date}' and fdate <= '{end_date}' AND
+            prc > 0 AND shares > 0
+        GROUP BY
+        fdate,
+        fundno,
+        COALESCE(assets, 0)
+    ),
+    link_dates AS (
+        SELECT
+        fundno,
+        fdate,
+        MIN(wficn) AS wficn
+        FROM
+        mfl.mflink2
+        GROUP BY
+        fundno,
+        fdate
+    ),
+    events AS (
+        SELECT DISTINCT fundno, fdate, CAST(NULL AS DATE) AS link_fdate FROM holdings
+        UNION ALL
+        SELECT fundno, fdate, fdate AS link_fdate FROM link_dates
+    ),
+    neighbours AS (
+        SELECT
+        fundno,
+        fdate,
+        link_fdate,
+        MAX(link_fdate) OVER (
+            PARTITION BY fundno ORDER BY fdate
+            RANGE BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+        ) AS prev_fdate,
+        MIN(link_fdate) OVER (
+            PARTITION BY fundno ORDER BY fdate
+            RANGE BETWEEN CURRENT ROW AND UNBOUNDED FOLLOWING
+        ) AS next_fdate
+        FROM
+        events
+    ),
+    links AS (
+        SELECT
+        n.fdate,
+        n.fundno,
+        d.wficn
+        FROM
+        neighbours n
+        JOIN
+        link_dates d
+        ON
+            d.fundno = n.fundno AND
+            d.fdate = CASE
+                WHEN n.next_fdate IS NULL THEN n.prev_fdate
+                WHEN n.prev_fdate IS NULL THEN n.next_fdate
+                WHEN n.fdate - n.prev_fdate <= n.next_fdate - n.fdate THEN n.prev_fdate
+                ELSE n.next_fdate
+            END
+        WHERE
+            n.link_fdate IS NULL AND
+            d.wficn IS NOT NULL
+    ),
+    fund_dates AS (
+        SELECT
+        l.wficn,
+        h.fdate,
+        h.assets,
+        SUM(h.useq_tna_k) AS useq_tna_k
+        FROM
+        holdings h
+        JOIN
+        links l
+        ON
+            h.fdate = l.fdate AND h.fundno = l.fundno
+        GROUP BY
+        l.wficn,
+        h.fdate,
+        h.assets
+    )
+    SELECT
+    wficn,
+    CAST(EXTRACT(YEAR FROM fdate) AS INTEGER) AS year,
+    (ARRAY_AGG(assets ORDER BY fdate DESC, assets DESC) FILTER (WHERE assets <> 0))[1] AS assets,
+    (ARRAY_AGG(useq_tna_k ORDER BY fdate DESC, assets DESC))[1] AS useq_tna_k
+    FROM
+    fund_dates
+    GROUP BY
+    wficn,
+    CAST(EXTRACT(YEAR FROM fdate) AS INTEGER)
+    """
+
+
+def pull_s12_fund_year(
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+) -> pd.DataFrame:
+    """
+    Pull S12 equity holdings per fund and year from WRDS, linked to `wficn`
+
+    Runs the S12 steps of `02_raw_data_walkthrough.ipynb` on the server:
+    1. Sum holdings value by (fdate, fundno, assets), with missing `assets` as 0.
+    2. Link each `fundno` to the `wficn` of its nearest `fdate` in MFLINK2
+       (ties go to the earlier date, as in `pd.merge_asof(direction="nearest")`),
+       and drop unlinked funds. The nearest dates come from running max/min
+       window functions over the sorted report and link dates, so the join
+       does not rely on an index on MFLINK2. If MFLINK2 has several `wficn`
+       for one (fundno, fdate), the lowest is used.
+    3. Sum by (wficn, fdate, assets).
+    4. Keep the last non-missing value of each column per (wficn, year), with
+       rows ordered by (fdate, assets) and `assets` of 0 treated as missing,
+       as `groupby(["wficn", "year"]).last()` does.
+
+    Only one row per (wficn, year) is transferred, instead of one row per
+    holding group.
+
+    Args:
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+
+    Returns:
+    - df: pd.DataFrame, with columns wficn, year, assets, useq_tna_k
+    """
+    query = _s12_fund_year_query(start_date, end_date)
+    with wrds_connection(wrds_username) as db:
+        df = db.raw_sql(query)
+    df["year"] = df["year"].astype("int")
+    df = df.sort_values(["wficn", "year"]).reset_index(drop=True)
+    return df
+
+
+def pull_and_save_s12_fund_year(
+    data_dir: Path = DATA_DIR,
+    start_date: str = START_DATE,
+    end_date: str = END_DATE,
+    wrds_username: str = WRDS_USERNAME,
+) -> int:
+    """
+    Pull S12 equity holdings per fund and year and save them to `s12_fund_year.parquet`
+
+    Args:
+    - data_dir: Path, path to data directory
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+    - wrds_username: str, WRDS username
+
+    Returns:
+    - n_rows: int, number of rows written
+    """
+    df = pull_s12_fund_year(start_date, end_date, wrds_username)
+    write_parquet(df, data_dir / "pulled" / "s12_fund_year.parquet", sort_by=["wficn", "year"])
+    return len(df)
+
+
+@memoize_load("s12_fund_year.parquet")
+def load_s12_fund_year(
+    data_dir: Path = DATA_DIR,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
+) -> pd.DataFrame:
+    """
+    Load S12 equity holdings per fund and year, pulling them if needed
+
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
+
+    Args:
+    - data_dir: Path, path to data directory
+    - compact: bool, cast to the smaller dtypes of `S12_COMPACT_DTYPES` (see `dtype_tools.compact_dtypes`)
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
+
+    Returns:
+    - df: pd.DataFrame, with columns wficn, year, assets, useq_tna_k
+    """
+    path = data_dir / "pulled" / "s12_fund_year.parquet"
+    if not path.exists():
+        pull_and_save_s12_fund_year(data_dir)
+    df = pd.read_parquet(path, **backend_kwargs(dtype_backend))
+    if compact:
+        df = compact_dtypes(df, S12_COMPACT_DTYPES, name="s12_fund_year")
+    return df
+
+
+@memoize_load("s12", "s12.parquet")
 def load_s12_file(
     data_dir: Path = DATA_DIR,
+    start_date: str = None,
+    end_date: str = None,
+    columns: list = None,
+    filters: list = None,
+    compact: bool = False,
+    dtype_backend: str = DTYPE_BACKEND,
 ) -> pd.DataFrame:
     """
     Load S12 data from WRDS.
 
+    Only the year partitions overlapping [start_date, end_date] are read.
+    A monolithic `s12.parquet` from an older pull is still read if the
+    partitioned dataset does not exist.
+    Memoized in memory up to `LOAD_CACHE_MAX_MB`, as a read-only view (see `cache_tools.memoize_load`).
+
     Args:
     - data_dir: Path, path to data directory
+    - start_date: str, first `fdate` to load in "YYYY-MM-DD" format. No lower bound if None.
+    - end_date: str, last `fdate` to load in "YYYY-MM-DD" format. No upper bound if None.
+    - columns: list of str, columns to load. Loads every column if None.
+    - filters: list of tuples (or list of lists of tuples for OR), pyarrow row filters
+    - compact: bool, cast to the smaller dtypes of `S12_COMPACT_DTYPES` (see `dtype_tools.compact_dtypes`)
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
 
     Returns:
     - df: pd.DataFrame, S12 data
     """
-    path = data_dir / "pulled" / "s12.parquet"
-    df = pd.read_parquet(path)
+    path = data_dir / "pulled" / "s12"
+    if not path.exists():
+        path = data_dir / "pulled" / "s12.parquet"
+    df = read_partitioned(
+        path, "fdate", start_date, end_date, columns=columns, filters=filters, dtype_backend=dtype_backend
+    )
+    if compact:
+        df = compact_dtypes(df, S12_COMPACT_DTYPES, name="s12")
     return df
 
 
 if __name__ == "__main__":
-    df_s12 = pull_s12(START_DATE, END_DATE, WRDS_USERNAME)
-    path = Path(DATA_DIR) / "pulled" / "s12.parquet"
-    df_s12.to_parquet(path)
+    pull_and_save_s12(DATA_DIR, START_DATE, END_DATE, WRDS_USERNAME)
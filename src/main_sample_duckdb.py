@@ -0,0 +1,289 @@
+"""
+Build the Table 1 main sample with DuckDB
+
+- Runs the sample construction of `02_raw_data_walkthrough.ipynb` (CRSP yearly
+  returns and December TNA, S12 linked to wficn through MFLINK2, and the merge
+  of the two) as one SQL query over the parquet files in `data/pulled`.
+- DuckDB executes the query multi-threaded and only reads the columns it uses.
+  With `memory_limit` set, joins and aggregations that do not fit spill to
+  `temp_directory` instead of failing.
+- The result is written to `OUTPUT_DIR / "main_sample.parquet"`, sorted by year,
+  with the columns and dtypes of `build_main_sample.merge_sample`. Values agree
+  with it up to floating-point rounding (`test_main_sample_duckdb.py`).
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+from pathlib import Path
+
+import duckdb
+import pandas as pd
+
+import config
+from parquet_tools import write_parquet
+
+DATA_DIR = Path(config.DATA_DIR)
+OUTPUT_DIR = Path(config.OUTPUT_DIR)
+DUCKDB_MEMORY_LIMIT = config.DUCKDB_MEMORY_LIMIT
+
+# Sums use Kahan summation (`fsum`), as pandas' groupby sum and mean do, over the rows
+# in file order, and the yearly return multiplies the monthly gross returns in month
+# order, so rounding differences with the pandas stages stay in the last bits.
+MAIN_SAMPLE_QUERY = """
+WITH crsp_link AS (
+    -- One wficn per crsp_fundno, the lowest, as `load_mflink.load_mflink1_index`
+    SELECT
+        crsp_fundno,
+        MIN(wficn) AS wficn
+    FROM
+        mflink1
+    WHERE
+        wficn IS NOT NULL
+    GROUP BY
+        crsp_fundno
+),
+crsp AS (
+    SELECT
+        CAST(l.wficn AS BIGINT) AS wficn,
+        CAST(year(c.caldt) AS BIGINT) AS year,
+        month(c.caldt) AS month,
+        COALESCE(c.mret, 0) AS mret,
+        c.mtna,
+        c.filename,
+        c.file_row_number
+    FROM
+        crsp_fund_combined c
+    JOIN
+        crsp_link l
+    ON
+        c.crsp_fundno = l.crsp_fundno
+),
+crsp_monthly AS (
+    SELECT
+        wficn, year, month,
+        fsum(mret ORDER BY filename, file_row_number) / COUNT(*) AS mret
+    FROM
+        crsp
+    GROUP BY
+        wficn, year, month
+),
+crsp_ret AS (
+    SELECT
+        wficn, year,
+        list_product(list(1 + mret ORDER BY month)) - 1 AS yret
+    FROM
+        crsp_monthly
+    GROUP BY
+        wficn, year
+    HAVING
+        MAX(month) = 12
+),
+crsp_tna AS (
+    SELECT
+        wficn, year,
+        COALESCE(fsum(mtna ORDER BY filename, file_row_number), 0) AS crsp_tna
+    FROM
+        crsp
+    WHERE
+        month = 12
+    GROUP BY
+        wficn, year
+),
+holdings AS (
+    SELECT
+        fdate,
+        CAST(fundno AS BIGINT) AS fundno,
+        CAST(year(fdate) AS BIGINT) AS year,
+        COALESCE(assets, 0) AS assets,
+        useq_tna_k,
+        filename,
+        file_row_number
+    FROM
+        s12
+),
+link_dates AS (
+    SELECT
+        CAST(fundno AS BIGINT) AS fundno,
+        fdate,
+        MIN(wficn) AS wficn
+    FROM
+        mflink2
+    GROUP BY
+        fundno, fdate
+),
+report_dates AS (
+    SELECT DISTINCT fundno, fdate FROM holdings
+),
+link_before AS (
+    SELECT
+        r.fundno, r.fdate, l.fdate AS link_fdate, l.wficn
+    FROM
+        report_dates r
+    ASOF LEFT JOIN
+        link_dates l
+    ON
+        r.fundno = l.fundno AND r.fdate >= l.fdate
+),
+link_after AS (
+    SELECT
+        r.fundno, r.fdate, l.fdate AS link_fdate, l.wficn
+    FROM
+        report_dates r
+    ASOF LEFT JOIN
+        link_dates l
+    ON
+        r.fundno = l.fundno AND r.fdate <= l.fdate
+),
+links AS (
+    SELECT
+        b.fundno, b.fdate,
+        CASE
+            WHEN a.link_fdate IS NULL THEN b.wficn
+            WHEN b.link_fdate IS NULL THEN a.wficn
+            WHEN CAST(b.fdate AS DATE) - CAST(b.link_fdate AS DATE)
+                <= CAST(a.link_fdate AS DATE) - CAST(b.fdate AS DATE) THEN b.wficn
+            ELSE a.wficn
+        END AS wficn
+    FROM
+        link_before b
+    JOIN
+        link_after a
+    ON
+        b.fundno = a.fundno AND b.fdate = a.fdate
+),
+fund_dates AS (
+    SELECT
+        h.year, h.fdate, l.wficn, h.assets,
+        fsum(h.useq_tna_k ORDER BY h.fundno, h.filename, h.file_row_number) AS useq_tna_k
+    FROM
+        holdings h
+    JOIN
+        links l
+    ON
+        h.fundno = l.fundno AND h.fdate = l.fdate
+    WHERE
+        l.wficn IS NOT NULL
+    GROUP BY
+        h.year, h.fdate, l.wficn, h.assets
+),
+s12_fund_year AS (
+    SELECT
+        wficn, year,
+        last(assets ORDER BY fdate, assets) FILTER (WHERE assets <> 0) AS assets,
+        last(useq_tna_k ORDER BY fdate, assets) AS useq_tna_k
+    FROM
+        fund_dates
+    GROUP BY
+        wficn, year
+)
+SELECT
+    t.wficn, t.year, t.crsp_tna, r.yret, s.assets, s.useq_tna_k
+FROM
+    crsp_tna t
+JOIN
+    crsp_ret r
+ON
+    t.wficn = r.wficn AND t.year = r.year
+JOIN
+    s12_fund_year s
+ON
+    t.wficn = s.wficn AND t.year = s.year
+ORDER BY
+    t.wficn, t.year
+"""
+
+
+def _parquet_files(data_dir: Path, name: str) -> list:
+    """Files of the pulled dataset `name`, or of its monolithic `name.parquet` from an older pull"""
+    path = data_dir / "pulled" / name
+    if path.is_dir():
+        return [str(file) for file in sorted(path.rglob("*.parquet"))]
+    return [str(path.with_suffix(".parquet"))]
+
+
+def connect(
+    memory_limit: str = DUCKDB_MEMORY_LIMIT,
+    temp_directory: Path = None,
+    threads: int = None,
+) -> duckdb.DuckDBPyConnection:
+    """
+    Open an in-memory DuckDB connection that spills to disk beyond `memory_limit`
+
+    Args:
+    - memory_limit: str, e.g. "4GB"
+    - temp_directory: Path, where larger-than-memory operators spill.
+      Defaults to `DATA_DIR / "intermediate" / "duckdb"`.
+    - threads: int, number of worker threads. Uses every core if None.
+
+    Returns:
+    - con: duckdb.DuckDBPyConnection
+    """
+    if temp_directory is None:
+        temp_directory = DATA_DIR / "intermediate" / "duckdb"
+    Path(temp_directory).mkdir(parents=True, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = '{memory_limit}'")
+    con.execute(f"SET temp_directory = '{Path(temp_directory).as_posix()}'")
+    if threads is not None:
+        con.execute(f"SET threads = {int(threads)}")
+    return con
+
+
+def build_main_sample_duckdb(
+    data_dir: Path = DATA_DIR,
+    output_dir: Path = OUTPUT_DIR,
+    memory_limit: str = DUCKDB_MEMORY_LIMIT,
+    threads: int = None,
+    save: bool = True,
+) -> pd.DataFrame:
+    """
+    Build the main sample (before the Table 1 filters) from the pulled parquet files
+
+    Follows `02_raw_data_walkthrough.ipynb` step by step:
+    - CRSP share classes are linked to wficn through MFLINK1. Monthly returns are
+      averaged across share classes (missing returns as 0) and compounded within
+      the year, for fund-years with a December observation. `crsp_tna` is the
+      December TNA summed across share classes.
+    - S12 report dates are linked to the wficn of the nearest MFLINK2 date (ties go
+      to the earlier date, as in `pd.merge_asof(direction="nearest")`). Holdings are
+      summed by (fdate, wficn, assets), and the last non-missing `assets` and
+      `useq_tna_k` of each (wficn, year) are kept.
+    - The two are inner-merged on (wficn, year) and sorted by year as in the notebook.
+
+    If MFLINK2 maps one (fundno, fdate) to several wficn, the lowest is used.
+
+    Args:
+    - data_dir: Path, root data directory
+    - output_dir: Path, where `main_sample.parquet` is written
+    - memory_limit: str, DuckDB memory limit before spilling to disk, e.g. "4GB"
+    - threads: int, number of DuckDB threads. Uses every core if None.
+    - save: bool, write `main_sample.parquet`
+
+    Returns:
+    - df_combo: pd.DataFrame, with columns wficn, year, crsp_tna, yret, assets, useq_tna_k
+    """
+    data_dir = Path(data_dir)
+    con = connect(memory_limit=memory_limit, temp_directory=data_dir / "intermediate" / "duckdb", threads=threads)
+    try:
+        for view, name in [
+            ("crsp_fund_combined", "CRSP_fund_combined"),
+            ("s12", "s12"),
+            ("mflink1", "mflink1"),
+            ("mflink2", "mflink2"),
+        ]:
+            con.read_parquet(
+                _parquet_files(data_dir, name), hive_partitioning=False, filename=True, file_row_number=True
+            ).create_view(view)
+        df_combo = con.execute(MAIN_SAMPLE_QUERY).df()
+    finally:
+        con.close()
+
+    # Same sort as the notebook
+    df_combo = df_combo.sort_values("year")
+    if save:
+        write_parquet(df_combo, Path(output_dir) / "main_sample.parquet")
+    return df_combo
+
+
+if __name__ == "__main__":
+    build_main_sample_duckdb(DATA_DIR, OUTPUT_DIR)
@@ -0,0 +1,45 @@
+"""
+Inputs of each stage of the Table 1 main sample
+
+- `STAGE_INPUTS` lists the stages of `build_main_sample.STAGES` in build order,
+  with the modules each calls, the pulled datasets it reads, and the stages it
+  reads. `build_main_sample` keys its stage caches on it (see `stage_key`), and
+  `dodo.py` builds the `file_dep` of each `main_sample` task from it.
+- Only the standard library is imported, so `dodo.py` can load it without
+  pandas or WRDS.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+LOADER_MODULES = ["cache_tools.py", "config.py", "dtype_tools.py", "parquet_tools.py"]
+# Pulled datasets saved as partitioned directories (with a `_manifest.json`), the
+# others being single parquet files
+PARTITIONED_DATASETS = ["CRSP_fund_combined", "s12"]
+
+STAGE_INPUTS = {
+    "crsp_clean": {
+        "modules": [*LOADER_MODULES, "load_CRSP_fund.py", "load_mflink.py", "return_tools.py"],
+        "pulled": ["CRSP_fund_combined", "mflink1"],
+        "reads": [],
+    },
+    "s12_link": {
+        "modules": [*LOADER_MODULES, "load_s12.py", "load_mflink.py"],
+        "pulled": ["s12", "mflink2"],
+        "reads": [],
+    },
+    "fund_year": {
+        "modules": [],
+        "pulled": [],
+        "reads": ["s12_link"],
+    },
+    "merge": {
+        "modules": [],
+        "pulled": [],
+        "reads": ["crsp_clean", "fund_year"],
+    },
+    "filters": {
+        "modules": [],
+        "pulled": [],
+        "reads": ["merge"],
+    },
+}
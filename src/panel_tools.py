@@ -0,0 +1,86 @@
+"""
+Functions to store the regression panel as memory-mapped NumPy columns
+
+- `save_panel` writes each column of the fund x month panel of
+  `factor_betas_calculation.regression_df` as its own `.npy` file, the factors
+  as one (rows x factors) matrix, and the offsets of each fund's rows.
+- `load_panel` opens the files with `np.load(mmap_mode="r")`: nothing is read
+  until it is used, and processes opening the same panel share the pages
+  through the OS page cache instead of each holding a copy.
+- The rows of fund i are `offsets[i]:offsets[i + 1]`, sorted by date, so a
+  worker can slice one fund out of every column without a copy.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from parquet_tools import staged_dataset
+
+PANEL_COLUMNS = ["date", "wficn", "crsp_ret", "crsp_tna", "flow"]
+PANEL_FACTORS = ["Mkt-RF", "SMB", "HML", "MOM", "CMA", "RMW"]
+PANEL_CATEGORIES = ["lipper_class_name", "index_fund_flag"]
+
+
+def save_panel(
+    df_reg: pd.DataFrame,
+    path: Path,
+    factors: list = PANEL_FACTORS,
+) -> None:
+    """
+    Write the regression panel as a directory of `.npy` files
+
+    The directory is replaced as a whole, and only once every file is written.
+
+    Args:
+    - df_reg: pd.DataFrame, from `regression_df`, sorted by (wficn, date)
+    - path: Path, panel directory
+    - factors: list of str, columns stacked into `factors.npy`, in this order
+    """
+    wficn = df_reg["wficn"].to_numpy(dtype="float64")
+    if np.any(np.diff(wficn) < 0):
+        raise ValueError("df_reg must be sorted by wficn")
+    starts = np.flatnonzero(np.r_[True, wficn[1:] != wficn[:-1]]) if len(wficn) else np.array([], dtype="int64")
+    offsets = np.r_[starts, len(wficn)].astype("int64")
+
+    categories = {}
+    with staged_dataset(path) as tmp_path:
+        for col in PANEL_COLUMNS:
+            dtype = "int64" if col == "date" else "float64"
+            np.save(tmp_path / f"{col}.npy", df_reg[col].to_numpy(dtype=dtype))
+        np.save(tmp_path / "factors.npy", np.ascontiguousarray(df_reg[factors].to_numpy(dtype="float64")))
+        np.save(tmp_path / "offsets.npy", offsets)
+        for col in PANEL_CATEGORIES:
+            values = pd.Categorical(df_reg[col].astype(str))
+            np.save(tmp_path / f"{col}.npy", values.codes.astype("int32"))
+            categories[col] = values.categories.tolist()
+        meta = {"n_rows": len(df_reg), "factors": list(factors), "categories": categories}
+        (tmp_path / "meta.json").write_text(json.dumps(meta, indent=1))
+
+
+def load_panel(
+    path: Path,
+    mmap_mode: str = "r",
+) -> dict:
+    """
+    Open a panel written by `save_panel`
+
+    Args:
+    - path: Path, panel directory
+    - mmap_mode: str, passed to `np.load`. "r" maps the files read-only; None reads them into memory.
+
+    Returns:
+    - panel: dict, the arrays of `PANEL_COLUMNS`, `factors`, `offsets` and the
+      category codes of `PANEL_CATEGORIES`, plus `meta` (row count, factor names
+      and the categories of each code column)
+    """
+    path = Path(path)
+    meta = json.loads((path / "meta.json").read_text())
+    names = PANEL_COLUMNS + ["factors", "offsets"] + list(meta["categories"])
+    panel = {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in names}
+    panel["meta"] = meta
+    return panel
@@ -0,0 +1,359 @@
+"""
+Functions to write and read the parquet files under `data/pulled`
+
+- Large pulls (CRSP, S12) are stored as hive-partitioned datasets by year,
+  e.g. `pulled/s12/year=2020/part-0.parquet`.
+- Reads restricted to a date range only open the partitions of the years
+  that overlap the range, and filter rows within them.
+- Pulls can be streamed chunk by chunk into a dataset, so that only one
+  chunk is held in memory at a time.
+- Every file is written with the same layout (`PARQUET_WRITE_OPTIONS`): zstd
+  compression, row groups of at most `ROW_GROUP_SIZE` rows, and column
+  statistics and page indexes. Pulled data is sorted by entity and date, so the
+  min/max statistics let filtered reads skip the row groups of other funds and dates.
+- Every pulled dataset has a `_manifest.json` listing its files and their
+  hashes (see `write_manifest`), rewritten whenever the dataset is. It gives
+  `dodo.py` one file to depend on, and readers skip it like any `_` file.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import hashlib
+import json
+import os
+import shutil
+from contextlib import contextmanager
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from dtype_tools import DTYPE_BACKEND, backend_kwargs
+
+PARTITION_COL = "year"
+PARTITIONING = ds.partitioning(pa.schema([(PARTITION_COL, pa.int32())]), flavor="hive")
+
+MANIFEST_NAME = "_manifest.json"
+
+ROW_GROUP_SIZE = 64 * 1024
+PARQUET_WRITE_OPTIONS = {
+    "compression": "zstd",
+    "write_statistics": True,
+    "write_page_index": True,
+}
+
+
+def write_parquet(
+    df: pd.DataFrame,
+    path: Path,
+    sort_by: list = None,
+    row_group_size: int = ROW_GROUP_SIZE,
+) -> None:
+    """
+    Write a DataFrame to a single parquet file with the shared layout
+
+    The index is stored as by `df.to_parquet`, so the file reads back the same frame.
+
+    Args:
+    - df: pd.DataFrame, data to write
+    - path: Path, parquet file
+    - sort_by: list of str, columns to (stably) sort the rows by, e.g. entity and
+      date, with the index reset. The row order is kept if None.
+    - row_group_size: int, maximum number of rows per row group
+    """
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind="stable", ignore_index=True)
+    table = pa.Table.from_pandas(df)
+    pq.write_table(table, path, row_group_size=row_group_size, **PARQUET_WRITE_OPTIONS)
+
+
+def write_partitioned(
+    df: pd.DataFrame,
+    path: Path,
+    date_col: str,
+    schema: pa.Schema = None,
+    sort_by: list = None,
+) -> None:
+    """
+    Write a DataFrame as a parquet dataset partitioned by the year of `date_col`
+
+    Partitions for the years present in `df` are replaced; partitions of
+    other years already in `path` are left untouched.
+
+    Args:
+    - df: pd.DataFrame, data to write
+    - path: Path, dataset directory
+    - date_col: str, datetime column used to derive the partition year
+    - schema: pa.Schema, schema of the written files (without the partition column).
+      Inferred from `df` if None.
+    - sort_by: list of str, columns to (stably) sort the rows by within each
+      partition, e.g. entity and date. The row order is kept if None.
+    """
+    if sort_by is not None:
+        df = df.sort_values(sort_by, kind="stable")
+    df = df.assign(**{PARTITION_COL: df[date_col].dt.year.astype("int32")})
+    if schema is not None:
+        schema = schema.append(pa.field(PARTITION_COL, pa.int32()))
+    table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+    ds.write_dataset(
+        table,
+        path,
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template="part-{i}.parquet",
+        existing_data_behavior="delete_matching",
+        file_options=ds.ParquetFileFormat().make_write_options(**PARQUET_WRITE_OPTIONS),
+        max_rows_per_group=ROW_GROUP_SIZE,
+        # Threads may interleave batches and lose the sort order
+        use_threads=False,
+    )
+
+
+def write_manifest(path: Path) -> Path:
+    """
+    Write the manifest of a dataset: the sha256 of each of its parquet files
+
+    The manifest only changes when the files of the dataset do, so a task that
+    depends on it reruns exactly when the dataset was rewritten with new data.
+
+    Args:
+    - path: Path, dataset directory
+
+    Returns:
+    - manifest: Path, `path / MANIFEST_NAME`
+    """
+    path = Path(path)
+    files = {}
+    for file in sorted(path.rglob("*.parquet")):
+        h = hashlib.sha256()
+        with open(file, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        files[file.relative_to(path).as_posix()] = h.hexdigest()
+    manifest = path / MANIFEST_NAME
+    manifest.write_text(json.dumps(files, indent=1))
+    return manifest
+
+
+@contextmanager
+def staged_dataset(path: Path):
+    """
+    Build a dataset in a temporary directory that replaces `path` on success
+
+    If the block raises, the temporary directory is removed and `path` is
+    left untouched. On success the manifest of the new dataset is written
+    (see `write_manifest`).
+
+    Args:
+    - path: Path, dataset directory
+
+    Yields:
+    - tmp_path: Path, directory to write the new dataset into
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + ".tmp")
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    tmp_path.mkdir(parents=True)
+    try:
+        yield tmp_path
+    except BaseException:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+    write_manifest(tmp_path)
+    shutil.rmtree(path, ignore_errors=True)
+    tmp_path.rename(path)
+
+
+def link_partitions(
+    path: Path,
+    tmp_path: Path,
+    skip_years: set = (),
+) -> None:
+    """
+    Carry the year partitions of a dataset over into a staged copy of it
+
+    Files are hard-linked rather than copied where the file system allows, so
+    a refresh staged with `staged_dataset` does not rewrite the years it keeps.
+
+    Args:
+    - path: Path, dataset directory
+    - tmp_path: Path, staged dataset directory, e.g. from `staged_dataset`
+    - skip_years: set of int, years not carried over (e.g. the ones rewritten)
+    """
+    for partition in Path(path).glob(f"{PARTITION_COL}=*"):
+        if int(partition.name.split("=")[1]) in skip_years:
+            continue
+        (Path(tmp_path) / partition.name).mkdir(parents=True, exist_ok=True)
+        for file in partition.glob("*.parquet"):
+            try:
+                os.link(file, Path(tmp_path) / partition.name / file.name)
+            except OSError:
+                shutil.copy2(file, Path(tmp_path) / partition.name / file.name)
+
+
+def write_partitioned_chunks(
+    chunks,
+    path: Path,
+    date_col: str,
+    schema: pa.Schema,
+    part_name: str = "part-0",
+) -> int:
+    """
+    Stream DataFrame chunks into a dataset partitioned by the year of `date_col`
+
+    Each year partition is written by its own `pq.ParquetWriter`, and every
+    chunk is appended as new row groups, so memory use is bounded by the chunk
+    size regardless of the date range. Rows keep the order of the chunks, so
+    sort them in the query (e.g. by entity and date). Use inside `staged_dataset` so that a
+    failed pull does not leave a partial dataset behind.
+
+    Args:
+    - chunks: iterable of pd.DataFrame, e.g. from `pd.read_sql_query(..., chunksize=...)`
+    - path: Path, dataset directory
+    - date_col: str, datetime column used to derive the partition year
+    - schema: pa.Schema, schema of the written files (without the partition column)
+    - part_name: str, file name (without suffix) within each partition
+
+    Returns:
+    - n_rows: int, number of rows written
+    """
+    writers = {}
+    n_rows = 0
+    try:
+        for chunk in chunks:
+            for year, part in chunk.groupby(chunk[date_col].dt.year):
+                if year not in writers:
+                    partition_dir = Path(path) / f"{PARTITION_COL}={year}"
+                    partition_dir.mkdir(parents=True, exist_ok=True)
+                    writers[year] = pq.ParquetWriter(
+                        partition_dir / f"{part_name}.parquet", schema, **PARQUET_WRITE_OPTIONS
+                    )
+                table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+                writers[year].write_table(table, row_group_size=ROW_GROUP_SIZE)
+            n_rows += len(chunk)
+    finally:
+        for writer in writers.values():
+            writer.close()
+    return n_rows
+
+
+def latest_date(
+    path: Path,
+    date_col: str,
+) -> pd.Timestamp:
+    """
+    Find the latest value of `date_col` in a year-partitioned dataset
+
+    Only the `date_col` column of the most recent year partition is read.
+
+    Args:
+    - path: Path, dataset directory
+    - date_col: str, datetime column
+
+    Returns:
+    - latest: pd.Timestamp, or None if the dataset is empty
+    """
+    partitions = sorted(
+        Path(path).glob(f"{PARTITION_COL}=*"),
+        key=lambda p: int(p.name.split("=")[1]),
+    )
+    if not partitions:
+        return None
+    df = pd.read_parquet(partitions[-1], columns=[date_col])
+    return df[date_col].max()
+
+
+def date_filters(
+    date_col: str,
+    start_date: str = None,
+    end_date: str = None,
+    partitioned: bool = True,
+) -> list:
+    """
+    Build pyarrow filters selecting `start_date <= date_col <= end_date`
+
+    For partitioned datasets the filters include the partition year, so that
+    non-overlapping partitions are never opened.
+
+    Args:
+    - date_col: str, datetime column to filter on
+    - start_date: str, start date in "YYYY-MM-DD" format, or None for no lower bound
+    - end_date: str, end date in "YYYY-MM-DD" format, or None for no upper bound
+    - partitioned: bool, whether the data is partitioned by year
+
+    Returns:
+    - filters: list of tuples
+    """
+    filters = []
+    if start_date is not None:
+        start = pd.Timestamp(start_date)
+        if partitioned:
+            filters.append((PARTITION_COL, ">=", start.year))
+        filters.append((date_col, ">=", start))
+    if end_date is not None:
+        end = pd.Timestamp(end_date)
+        if partitioned:
+            filters.append((PARTITION_COL, "<=", end.year))
+        filters.append((date_col, "<=", end))
+    return filters
+
+
+def read_partitioned(
+    path: Path,
+    date_col: str,
+    start_date: str = None,
+    end_date: str = None,
+    columns: list = None,
+    filters: list = None,
+    dtype_backend: str = DTYPE_BACKEND,
+) -> pd.DataFrame:
+    """
+    Read a year-partitioned dataset (or a single parquet file) within a date range
+
+    Args:
+    - path: Path, dataset directory, or a monolithic parquet file
+    - date_col: str, datetime column to restrict to the date range
+    - start_date: str, start date in "YYYY-MM-DD" format, or None
+    - end_date: str, end date in "YYYY-MM-DD" format, or None
+    - columns: list of str, columns to load. Loads every column if None.
+    - filters: list of tuples (or list of lists of tuples for OR), additional pyarrow row filters
+    - dtype_backend: str, "numpy", "numpy_nullable" or "pyarrow" (see `dtype_tools.backend_kwargs`)
+
+    Returns:
+    - df: pd.DataFrame
+    """
+    path = Path(path)
+    partitioned = path.is_dir()
+    range_filters = date_filters(date_col, start_date, end_date, partitioned=partitioned)
+    if filters and isinstance(filters[0], list):
+        filters = [conjunction + range_filters for conjunction in filters]
+    else:
+        filters = (filters or []) + range_filters
+
+    kwargs = backend_kwargs(dtype_backend)
+    if partitioned and range_filters:
+        # Dataset discovery otherwise reads the schema from the first file of the
+        # dataset, which is outside the range
+        schema = _partition_schema(path, start_date, end_date)
+        if schema is not None:
+            kwargs["schema"] = schema
+    df = pd.read_parquet(path, columns=columns, filters=filters or None, **kwargs)
+    if partitioned and PARTITION_COL in df.columns and (columns is None or PARTITION_COL not in columns):
+        df = df.drop(columns=PARTITION_COL)
+    return df
+
+
+def _partition_schema(path, start_date=None, end_date=None):
+    # Schema of the dataset, with the partition column, from the first file of the
+    # first year partition within [start_date, end_date], or None if there is none
+    first = pd.Timestamp(start_date).year if start_date is not None else None
+    last = pd.Timestamp(end_date).year if end_date is not None else None
+    for partition in sorted(path.glob(f"{PARTITION_COL}=*"), key=lambda p: int(p.name.split("=")[1])):
+        year = int(partition.name.split("=")[1])
+        if (first is not None and year < first) or (last is not None and year > last):
+            continue
+        for file in sorted(partition.glob("*.parquet")):
+            return pq.read_schema(file).append(pa.field(PARTITION_COL, pa.int32()))
+    return None
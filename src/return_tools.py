@@ -0,0 +1,110 @@
+"""
+Functions to compound monthly returns over several horizons
+
+- Monthly returns are turned into per-fund prefix sums of `log1p(ret)`, so the
+  return over any run of months of a fund is `expm1` of the difference of two
+  prefix sums.
+- `compound_returns` gives calendar-year, quarterly and rolling 12-month returns
+  from the same prefix sums, in one vectorized pass over the panel.
+- Each return comes with its coverage: the number of months observed in the
+  period (and the last month observed), so that incomplete periods are kept and
+  can be filtered explicitly, instead of disappearing.
+- A return of -100% or less makes the return of every period that contains it
+  -100%, and a missing return makes it missing.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def _run_bounds(keys: np.ndarray) -> tuple:
+    """First and last row of each run of equal consecutive rows of `keys` (2-D, one row per record)"""
+    if len(keys) == 0:
+        empty = np.array([], dtype="int64")
+        return empty, empty
+    change = np.any(keys[1:] != keys[:-1], axis=1)
+    first = np.flatnonzero(np.r_[True, change])
+    last = np.r_[first[1:] - 1, len(keys) - 1]
+    return first, last
+
+
+def compound_returns(
+    df: pd.DataFrame,
+    id_col: str = "wficn",
+    date_col: str = "caldt",
+    ret_col: str = "mret",
+) -> dict:
+    """
+    Compound monthly returns to calendar years, quarters and rolling 12 months
+
+    Months are taken from `date_col`, and missing months are not filled: a
+    period return compounds the months observed in it, and its `n_months`
+    counts them. Missing returns propagate to every period containing them.
+
+    Args:
+    - df: pd.DataFrame, one row per fund and month
+    - id_col: str, fund identifier
+    - date_col: str, datetime column of the month
+    - ret_col: str, monthly return, as a decimal
+
+    Returns:
+    - returns: dict of pd.DataFrame, sorted by fund and date:
+      - "year": id_col, year, ret, n_months, last_month
+      - "quarter": id_col, year, quarter, ret, n_months, last_month
+      - "rolling_12": id_col, date_col, ret (over the 12 months ending in the
+        row's month), n_months (months observed in that window)
+    """
+    dates = pd.DatetimeIndex(df[date_col])
+    month_index = (dates.year.to_numpy(dtype="int64") * 12 + dates.month.to_numpy(dtype="int64") - 1)
+    ids = df[id_col].to_numpy()
+    order = np.lexsort((month_index, ids))
+    ids, month_index = ids[order], month_index[order]
+    ret = df[ret_col].to_numpy(dtype="float64", na_value=np.nan)[order]
+
+    fund = np.r_[0, np.cumsum(ids[1:] != ids[:-1])] if len(ids) else np.array([], dtype="int64")
+    if np.any((fund[1:] == fund[:-1]) & (month_index[1:] == month_index[:-1])):
+        raise ValueError(f"df has several rows for the same {id_col} and month")
+
+    # Per-fund prefix sums; total losses and missing returns are counted apart,
+    # since log1p(-1) is -inf and the cumulative sum would skip NaN
+    loss = ret <= -1
+    missing = np.isnan(ret)
+    logs = np.log1p(np.where(loss | missing, 0.0, ret))
+    log_sum = pd.Series(logs).groupby(fund, sort=False).cumsum().to_numpy()
+    loss_sum = pd.Series(loss.astype("int64")).groupby(fund, sort=False).cumsum().to_numpy()
+    missing_sum = pd.Series(missing.astype("int64")).groupby(fund, sort=False).cumsum().to_numpy()
+
+    def window_return(first, last):
+        # Rows first..last of one fund: P[last] - P[first] + log[first]
+        total = log_sum[last] - log_sum[first] + logs[first]
+        losses = loss_sum[last] - loss_sum[first] + loss[first]
+        missings = missing_sum[last] - missing_sum[first] + missing[first]
+        return np.where(missings > 0, np.nan, np.where(losses > 0, -1.0, np.expm1(total)))
+
+    year = month_index // 12
+    month = month_index % 12 + 1
+    quarter = (month - 1) // 3 + 1
+    returns = {}
+    for horizon, keys in [("year", [year]), ("quarter", [year, quarter])]:
+        first, last = _run_bounds(np.column_stack([fund] + keys))
+        df_period = pd.DataFrame({id_col: ids[first], "year": year[first]})
+        if horizon == "quarter":
+            df_period["quarter"] = quarter[first]
+        df_period["ret"] = window_return(first, last)
+        df_period["n_months"] = last - first + 1
+        df_period["last_month"] = month[last]
+        returns[horizon] = df_period
+
+    # First row of each 12-month window: the first month of the fund >= month - 11
+    fund_month = fund * (month_index.max(initial=0) + 12) + month_index
+    last = np.arange(len(fund_month))
+    first = np.searchsorted(fund_month, fund_month - 11, side="left")
+    returns["rolling_12"] = pd.DataFrame({
+        id_col: ids,
+        date_col: df[date_col].to_numpy()[order],
+        "ret": window_return(first, last),
+        "n_months": last - first + 1,
+    })
+    return returns
@@ -0,0 +1,84 @@
+import numpy as np
+import pandas as pd
+
+import build_main_sample
+from cache_tools import cache_key
+
+
+def notebook_filters(df_combo, min_tna, tna_ratio, eq_ratio):
+    """The filter cells of `02_raw_data_walkthrough.ipynb`, one after the other"""
+    df_combo = df_combo.query(f"crsp_tna > {min_tna}").copy()
+    df_combo["tna_ratio"] = np.where(
+        df_combo["assets"].isnull(), 1, df_combo["crsp_tna"] * 1e6 / df_combo["assets"] / 1e4
+    )
+    df_combo = df_combo.query(f"tna_ratio > {tna_ratio[0]} and tna_ratio < {tna_ratio[1]}").copy()
+    df_combo["eq_ratio_1"] = df_combo["useq_tna_k"] * 1e3 / (df_combo["crsp_tna"] * 1e6)
+    df_combo["eq_ratio_2"] = np.where(
+        df_combo["assets"].isnull(), 1, df_combo["useq_tna_k"] * 1e3 / (df_combo["assets"] * 1e4)
+    )
+    return df_combo[
+        (df_combo["eq_ratio_1"].between(*eq_ratio)) | (df_combo["eq_ratio_2"].between(*eq_ratio))
+    ]
+
+
+def test_sweep_filters_matches_notebook_filters():
+    # Includes fund-years without S12 assets, with a missing yearly return, with zero
+    # TNA, and a year (2002) that every configuration filters out
+    df_combo = pd.DataFrame({
+        'wficn': [1, 2, 3, 4, 1, 2, 3, 4, 1],
+        'year': [2000, 2000, 2000, 2000, 2001, 2001, 2001, 2001, 2002],
+        'crsp_tna': [0.5, 2.0, 10.0, 6.0, 3.0, 4.0, 0.0, 5.0, 0.2],
+        'yret': [0.1, 0.2, 0.3, np.nan, -0.1, np.nan, 0.0, 0.02, 0.1],
+        'assets': [np.nan, 2.0e2, 1.5e3, 5.0e2, 3.0e2, np.nan, 1.0e2, 4.0e2, 1.0e2],
+        'useq_tna_k': [4.5e2, 1.9e3, 6.0e3, 5.5e3, 2.9e3, 3.0e3, 1.0e3, 4.9e3, 2.0e2],
+    })
+    grid = {"min_tna": [0, 1], "tna_ratio": [(0.5, 2)], "eq_ratio": [(0.8, 1.05), (0.5, 1.05)]}
+    df_sweep = build_main_sample.sweep_filters(**grid, df_combo=df_combo)
+    assert len(df_sweep) == 4 * 3
+
+    stats = ['count', 'crsp_tna_mean', 'crsp_tna_median', 'yret_mean', 'yret_median']
+    for min_tna in grid["min_tna"]:
+        for tna_ratio in grid["tna_ratio"]:
+            for eq_ratio in grid["eq_ratio"]:
+                df_filtered = notebook_filters(df_combo, min_tna, tna_ratio, eq_ratio)
+                expected = df_filtered.groupby('year').agg(
+                    count=('yret', 'size'),
+                    crsp_tna_mean=('crsp_tna', 'mean'),
+                    crsp_tna_median=('crsp_tna', 'median'),
+                    yret_mean=('yret', 'mean'),
+                    yret_median=('yret', 'median'),
+                ).reindex([2000, 2001, 2002]).fillna({'count': 0})
+
+                config = (
+                    (df_sweep['min_tna'] == min_tna)
+                    & (df_sweep['tna_ratio_low'] == tna_ratio[0]) & (df_sweep['tna_ratio_high'] == tna_ratio[1])
+                    & (df_sweep['eq_ratio_low'] == eq_ratio[0]) & (df_sweep['eq_ratio_high'] == eq_ratio[1])
+                )
+                got = df_sweep[config].set_index('year')[stats]
+                assert np.allclose(got, expected[stats], equal_nan=True)
+
+
+def test_stage_keys(tmp_path):
+    # Stage keys only hash the files they list, so empty files stand in for the pulled data
+    pulled = tmp_path / "pulled"
+    pulled.mkdir()
+    for name in ["CRSP_fund_combined", "mflink1", "s12", "mflink2"]:
+        (pulled / f"{name}.parquet").write_bytes(name.encode())
+
+    def keys(**params):
+        return {
+            stage: cache_key(*build_main_sample.stage_key(stage, tmp_path, params if stage == "filters" else None))
+            for stage in build_main_sample.STAGES
+        }
+
+    base = keys(min_tna=1)
+    assert "load_CRSP_fund.py" in [p.name for p in build_main_sample.stage_key("crsp_clean", tmp_path)[0]]
+
+    # A filter threshold only changes the filter stage
+    changed = keys(min_tna=2)
+    assert [stage for stage in base if base[stage] != changed[stage]] == ["filters"]
+
+    # A new MFLINK1 changes CRSP clean and the stages downstream of it, not the S12 stages
+    (pulled / "mflink1.parquet").write_bytes(b"new")
+    changed = keys(min_tna=1)
+    assert [stage for stage in base if base[stage] != changed[stage]] == ["crsp_clean", "merge", "filters"]
@@ -0,0 +1,75 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import cache_tools
+from cache_tools import clear_load_cache, file_digest, manifest_is_current, memoize_load
+from dtype_tools import backend_kwargs
+from parquet_tools import MANIFEST_NAME, staged_dataset, write_partitioned
+
+
+@pytest.mark.parametrize("dtype_backend", ["numpy", "numpy_nullable", "pyarrow"])
+def test_memoize_load(tmp_path, dtype_backend):
+    (tmp_path / "pulled").mkdir()
+    path = tmp_path / "pulled" / "links.parquet"
+    links = pd.DataFrame({'fundno': [1.0, 2.0], 'wficn': [10.0, 20.0], 'name': ['a', 'b']})
+    links.to_parquet(path)
+    calls = []
+
+    @memoize_load("links.parquet", max_mb=16)
+    def load_links(data_dir):
+        calls.append(data_dir)
+        return pd.read_parquet(data_dir / "pulled" / "links.parquet", **backend_kwargs(dtype_backend))
+
+    clear_load_cache()
+    df = load_links(tmp_path)
+    df['x'] = 1
+    df['fundno'] = df['fundno'] * 2
+    if dtype_backend == "pyarrow":
+        # Arrow columns are immutable: the write replaces the column of the view only
+        df.loc[0, 'wficn'] = -1.0
+        df.loc[0, 'name'] = 'c'
+    else:
+        with pytest.raises(ValueError, match="read-only"):
+            df.loc[0, 'wficn'] = -1.0
+        with pytest.raises(ValueError, match="read-only"):
+            df.loc[0, 'name'] = 'c'
+    df_again = load_links(tmp_path)
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(df_again, links.astype(df_again.dtypes))
+    if dtype_backend == "numpy":
+        assert np.shares_memory(df_again['wficn'].to_numpy(), load_links(tmp_path)['wficn'].to_numpy())
+
+    # Entries are keyed on the contents of the files, not their mtime
+    os.utime(path, ns=(0, 0))
+    load_links(tmp_path)
+    assert len(calls) == 1
+    pd.DataFrame({'fundno': [1.0], 'wficn': [30.0], 'name': ['c']}).to_parquet(path)
+    os.utime(path, ns=(0, 0))
+    assert load_links(tmp_path)['wficn'].tolist() == [30.0]
+    assert len(calls) == 2
+    clear_load_cache()
+
+
+def test_file_digest_of_dataset_uses_manifest(tmp_path):
+    path = tmp_path / "funds"
+    df = pd.DataFrame({'caldt': pd.to_datetime(['2000-01-31', '2001-01-31']), 'mret': [0.01, 0.02]})
+    with staged_dataset(path) as tmp:
+        write_partitioned(df, tmp, 'caldt')
+    digest = file_digest(path)
+    assert digest == file_digest(path / MANIFEST_NAME)
+
+    # A new process does not read the files again while the manifest is current
+    cache_tools._FILE_DIGESTS.clear()
+    part = next(path.glob("year=2000/*.parquet"))
+    stat = part.stat()
+    part.write_bytes(b"x" * stat.st_size)
+    os.utime(part, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert file_digest(path) == digest
+
+    # Files written after the manifest are hashed
+    write_partitioned(df.assign(mret=0.03), path, 'caldt')
+    assert not manifest_is_current(path)
+    assert file_digest(path) != digest
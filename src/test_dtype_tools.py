@@ -0,0 +1,27 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from dtype_tools import compact_dtypes
+
+
+def test_compact_dtypes():
+    df = pd.DataFrame({
+        'crsp_fundno': [1.0, 2.0, 3.0],
+        'wficn': [100.0, np.nan, 101.0],
+        'mret': [0.01, -0.02, 0.03],
+        'lipper_class_name': ['Growth', 'Value', 'Growth'],
+    })
+    dtypes = {'crsp_fundno': 'int32', 'wficn': 'int32', 'mret': 'float32',
+              'lipper_class_name': 'category', 'fundno': 'int32'}
+    out = compact_dtypes(df, dtypes, verbose=False)
+
+    assert out['crsp_fundno'].dtype == 'int32'
+    assert out['wficn'].dtype == 'Int32'
+    assert out['mret'].dtype == 'float32'
+    assert out['lipper_class_name'].dtype == 'category'
+    assert out['wficn'].isna().tolist() == [False, True, False]
+    assert df['crsp_fundno'].dtype == 'float64'
+
+    with pytest.raises(TypeError):
+        compact_dtypes(pd.DataFrame({'fundno': [1.5]}), dtypes, verbose=False)
@@ -0,0 +1,103 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import factor_betas_calculation
+
+
+def test_share_class_aggregate_matches_groupby():
+    df = pd.DataFrame({
+        'g': [0, 0, 1, 1, 1, 2],
+        'mret': [0.01, 0.03, -0.02, 0.04, 0.00, 0.05],
+        'mtna': [100.0, 300.0, np.nan, 50.0, 150.0, np.nan],
+    })
+    ret, tna = factor_betas_calculation.share_class_aggregate(df['g'], df['mret'], df['mtna'])
+
+    assert np.allclose(ret, df.groupby('g')['mret'].mean())
+    assert np.allclose(tna, df.groupby('g')['mtna'].sum())
+
+
+def test_share_class_aggregate_tna_weighting_with_fallback():
+    codes = np.array([0, 0, 1, 1, 2])
+    mret = np.array([0.01, 0.03, -0.02, 0.04, 0.05])
+    mtna = np.array([100.0, 300.0, np.nan, np.nan, 0.0])
+    ret, tna = factor_betas_calculation.share_class_aggregate(codes, mret, mtna, weighting="tna")
+
+    # Group 0 is TNA weighted, groups 1 and 2 have no usable TNA and fall back to the mean
+    assert np.allclose(ret, [0.025, 0.01, 0.05])
+    assert np.allclose(tna, [400.0, 0.0, 0.0])
+
+    with pytest.raises(ValueError):
+        factor_betas_calculation.share_class_aggregate(codes, mret, mtna, weighting="value")
+
+
+def test_rolling_betas_match_window_regressions():
+    from sklearn.linear_model import LinearRegression
+
+    rng = np.random.default_rng(0)
+    n = 62
+    columns = factor_betas_calculation.factor_model_columns("ff5_mom_flow")
+    df = pd.DataFrame(rng.normal(size=(n, len(columns) + 1)), columns=columns + ['crsp_ret'])
+    df['wficn'] = 1.0
+    # A fund's first flow is 0 (no lagged TNA), and funds shorter than 60 months are skipped
+    df.loc[:30, 'flow'] = 0.0
+    df = pd.concat([df, df.iloc[:59].assign(wficn=2.0)], ignore_index=True)
+
+    betas = factor_betas_calculation.rolling_betas(df, ["ff3", "ff5_mom_flow"])
+    assert betas["ff5_mom_flow"].shape == ((n - 59) * 37, 7)
+
+    for model, beta in betas.items():
+        X = df[factor_betas_calculation.factor_model_columns(model)].to_numpy()
+        y = df['crsp_ret'].to_numpy()
+        expected = [
+            LinearRegression().fit(X[start:start + 24], y[start:start + 24]).coef_
+            for month in range(n - 59) for start in range(month, month + 37)
+        ]
+        assert np.allclose(beta.to_numpy(), expected)
+
+    with pytest.raises(ValueError):
+        factor_betas_calculation.factor_model_columns("ff4")
+
+
+def test_table2_panels():
+    rng = np.random.default_rng(1)
+    columns = factor_betas_calculation.factor_model_columns("ff5_mom_flow")
+    df_reg = pd.DataFrame(rng.normal(size=(120, len(columns) + 1)), columns=columns + ['crsp_ret'])
+    df_reg['wficn'] = np.repeat([1.0, 2.0], 60)
+    df_reg['lipper_class_name'] = np.repeat(['Large-Cap Growth Funds', 'Small-Cap Value Funds'], 60)
+    df_reg['index_fund_flag'] = np.repeat(['D', 0], 60)
+
+    betas = factor_betas_calculation.group_betas(df_reg)
+    panelA = factor_betas_calculation.calc_penal_A(df_reg)
+    panelB = factor_betas_calculation.calc_penal_B(df_reg)
+    panelC = factor_betas_calculation.calc_penal_C(df_reg, betas=betas)
+
+    assert panelA.index.tolist() == ['mean', 'std', 'P5', 'P25', 'P50', 'P75', 'P95']
+    assert np.allclose(panelA.loc['mean'], factor_betas_calculation.regression(df_reg).mean())
+    assert np.allclose(panelB, factor_betas_calculation.calc_penal_B(df_reg, betas=betas), equal_nan=True)
+    assert np.allclose(panelB.loc['Growth'], panelC.loc['Pure'])
+    assert panelC.loc['Enhanced'].isna().all()
+
+
+@pytest.mark.parametrize("weighting", ["equal", "tna"])
+def test_fund_level_panel_matches_share_classes(pulled_tree, weighting, caplog):
+    # The server-side linking, exclusions and aggregation against the pandas path
+    keys = ["caldt", "wficn", "lipper_class_name", "index_fund_flag"]
+    with caplog.at_level("INFO", logger="factor_betas_calculation"):
+        expected = factor_betas_calculation._aggregate_share_classes(weighting=weighting, data_dir=pulled_tree)
+    assert "linked to several wficn" in caplog.text
+    df_fund = factor_betas_calculation._load_fund_level_panel(weighting=weighting, data_dir=pulled_tree)
+    assert len(df_fund) > 0
+
+    expected, df_fund = [df.sort_values(keys).reset_index(drop=True)[expected.columns] for df in [expected, df_fund]]
+    pd.testing.assert_frame_equal(df_fund, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize("dtype_backend", ["numpy_nullable", "pyarrow"])
+def test_share_class_panel_backends_agree(pulled_tree, dtype_backend):
+    expected = factor_betas_calculation._aggregate_share_classes(data_dir=pulled_tree, dtype_backend="numpy")
+    df_crsp = factor_betas_calculation._aggregate_share_classes(data_dir=pulled_tree, dtype_backend=dtype_backend)
+
+    assert len(expected) > 0
+    df_crsp = df_crsp.astype(expected.dtypes.to_dict())
+    pd.testing.assert_frame_equal(df_crsp.reset_index(drop=True), expected.reset_index(drop=True))
@@ -0,0 +1,54 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import factor_store
+
+
+def write_factor_csvs(data_dir, mkt_rf):
+    manual_dir = data_dir / "manual"
+    manual_dir.mkdir(exist_ok=True)
+    dates = [200001, 200002, 200003, 200004]
+    pd.DataFrame({
+        'date': dates, 'Mkt-RF': mkt_rf, 'SMB': [0.1, 0.2, 0.3, 0.4], 'HML': [-0.1, -0.2, -0.3, -0.4],
+        'RMW': [0.5, 0.6, 0.7, 0.8], 'CMA': [0.0, 0.1, 0.0, 0.1], 'RF': [0.3, 0.3, 0.3, 0.3],
+    }).to_csv(manual_dir / factor_store.FF_FACTORS_FILE, index=False)
+    # Momentum starts earlier and ends later; only the common months are kept
+    pd.DataFrame({'date': [199912, *dates, 200005], 'MOM': [9.0, 1.0, 2.0, 3.0, 4.0, 9.0]}).to_csv(
+        manual_dir / factor_store.FF_MOMENTUM_FILE, index=False
+    )
+
+
+def test_load_factors(tmp_path, monkeypatch):
+    write_factor_csvs(tmp_path, [1.0, 2.0, 3.0, 4.0])
+    calls = []
+    build_factors = factor_store.build_factors
+    monkeypatch.setattr(factor_store, "build_factors", lambda data_dir: calls.append(data_dir) or build_factors(data_dir))
+
+    factors = factor_store.load_factors(tmp_path)
+    cached = factor_store.load_factors(tmp_path)
+    assert len(calls) == 1
+    assert factors["columns"].tolist() == ['Mkt-RF', 'SMB', 'HML', 'RMW', 'CMA', 'MOM']
+    for key in factors:
+        assert np.array_equal(cached[key], factors[key])
+
+    df_ff = factor_store.factor_frame(cached, 200002, 200003)
+    assert df_ff['date'].tolist() == [200002, 200003]
+    assert df_ff['Mkt-RF'].tolist() == [2.0, 3.0]
+    assert df_ff['MOM'].tolist() == [2.0, 3.0]
+    assert factor_store.factor_frame(cached, None, 200001)['date'].tolist() == [200001]
+    assert len(factor_store.factor_frame(cached, 200005, None)) == 0
+
+    # A changed CSV is parsed again
+    write_factor_csvs(tmp_path, [1.0, 2.0, 3.0, 5.0])
+    os.utime(tmp_path / "manual" / factor_store.FF_FACTORS_FILE, ns=(0, 0))
+    factors = factor_store.load_factors(tmp_path)
+    assert len(calls) == 2
+    assert factors["values"][-1, 0] == 5.0
+
+    factor_store.check_factor_coverage([200001, 200004], factors)
+    factor_store.check_factor_coverage([200001, 200005], factors, end=200004)
+    with pytest.raises(ValueError, match="200005"):
+        factor_store.check_factor_coverage([200001, 200005], factors)
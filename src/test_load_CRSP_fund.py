@@ -0,0 +1,92 @@
+import shutil
+
+import pandas as pd
+import pytest
+
+import load_CRSP_fund
+from conftest import END_DATE, START_DATE
+from parquet_tools import write_parquet
+
+
+def sorted_frame(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def test_update_matches_full_pull(tmp_path, wrds_standin):
+    (tmp_path / "pulled").mkdir()
+    load_CRSP_fund.pull_and_save_CRSP_combined_file(tmp_path, START_DATE, "2001-06-30", max_workers=1)
+    path = tmp_path / "pulled" / "CRSP_fund_combined"
+    manifest = (path / "_manifest.json").read_text()
+
+    # Returns of the overlap months are revised after the first pull
+    wrds_standin.execute(
+        "UPDATE crsp.monthly_tna_ret_nav SET mret = mret + 0.01 WHERE caldt BETWEEN '2001-04-01' AND '2001-06-30'"
+    )
+
+    # A failed slice leaves the dataset as it was
+    pull = load_CRSP_fund.pull_CRSP_combined_file
+
+    def failing_pull(start_date, end_date, wrds_username=None):
+        if start_date.startswith("2002"):
+            raise RuntimeError("connection lost")
+        return pull(start_date, end_date, wrds_username)
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(load_CRSP_fund, "pull_CRSP_combined_file", failing_pull)
+        with pytest.raises(RuntimeError):
+            load_CRSP_fund.update_CRSP_combined_file(tmp_path, END_DATE, overlap_months=3, max_workers=1)
+    assert (path / "_manifest.json").read_text() == manifest
+    assert not path.with_name(path.name + ".tmp").exists()
+
+    df_new = load_CRSP_fund.update_CRSP_combined_file(tmp_path, END_DATE, overlap_months=3, max_workers=1)
+    assert df_new["caldt"].min() == pd.Timestamp("2001-03-31")
+    assert (path / "_manifest.json").read_text() != manifest
+
+    expected = load_CRSP_fund.pull_CRSP_combined_file(START_DATE, END_DATE)
+    df = load_CRSP_fund.load_CRSP_combined_file(tmp_path, dtype_backend="numpy")
+    pd.testing.assert_frame_equal(sorted_frame(df), sorted_frame(expected[df.columns]), check_dtype=False)
+
+
+def test_sliced_pull_matches_single_query(tmp_path, wrds_standin):
+    n_rows = load_CRSP_fund.pull_and_save_CRSP_combined_file(tmp_path, START_DATE, END_DATE, max_workers=3)
+    expected = load_CRSP_fund.pull_CRSP_combined_file(START_DATE, END_DATE)
+    assert n_rows == len(expected)
+
+    path = tmp_path / "pulled" / "CRSP_fund_combined"
+    assert sorted(p.name for p in path.glob("year=*")) == ["year=2000", "year=2001", "year=2002"]
+    for year, df_year in expected.groupby(expected["caldt"].dt.year):
+        df_year = df_year.sort_values(load_CRSP_fund.CRSP_SORT_COLUMNS, kind="stable", ignore_index=True)
+        df = pd.read_parquet(path / f"year={year}" / "part-0.parquet")[df_year.columns]
+        pd.testing.assert_frame_equal(df, df_year, check_dtype=False)
+
+
+def test_legacy_single_file_fallback(pulled_tree):
+    # A monolithic file from an older pull is read when there is no dataset (rather
+    # than pulled again, which would bring back 2000)
+    df_full = load_CRSP_fund.load_CRSP_combined_file(pulled_tree, dtype_backend="numpy")
+    expected = df_full[df_full["caldt"].dt.year > 2000].reset_index(drop=True)
+    pulled = pulled_tree / "pulled"
+    write_parquet(expected, pulled / "CRSP_fund_combined.parquet")
+    shutil.rmtree(pulled / "CRSP_fund_combined")
+
+    df = load_CRSP_fund.load_CRSP_combined_file(pulled_tree, dtype_backend="numpy")
+    pd.testing.assert_frame_equal(df, expected)
+    df = load_CRSP_fund.load_CRSP_combined_file(pulled_tree, "2001-01-01", "2001-12-31", dtype_backend="numpy")
+    assert df["caldt"].dt.year.unique().tolist() == [2001]
+
+
+def test_load_pushes_down_columns_and_filters(pulled_tree):
+    columns = ["crsp_fundno", "caldt", "mret"]
+    filters = [("lipper_class_name", "not in", ["International Funds"])]
+    df_full = load_CRSP_fund.load_CRSP_combined_file(pulled_tree, dtype_backend="numpy")
+    expected = df_full[
+        df_full["caldt"].between("2001-03-01", "2001-08-31")
+        & ~df_full["lipper_class_name"].isin(["International Funds"])
+    ][columns]
+    df = load_CRSP_fund.load_CRSP_combined_file(
+        pulled_tree, "2001-03-01", "2001-08-31", columns=columns, filters=filters, dtype_backend="numpy"
+    )
+
+    assert df.columns.tolist() == columns
+    assert 0 < len(df) < df_full["caldt"].between("2001-03-01", "2001-08-31").sum()
+    pd.testing.assert_frame_equal(sorted_frame(df), sorted_frame(expected))
@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 import pytest
 
@@ -7,6 +8,47 @@ import load_fred
 DATA_DIR = config.DATA_DIR
 
 
+@pytest.fixture
+def fred_frame():
+    """Monthly CPI from 1913 and quarterly GDP from 1947, as served by FRED"""
+    dates = pd.date_range('1913-01-01', '2024-12-01', freq='MS', name='DATE')
+    quarterly = (dates.year >= 1947) & (dates.month % 3 == 1)
+    return pd.DataFrame({
+        'CPIAUCNS': np.linspace(10.0, 300.0, len(dates)),
+        'GDP': np.where(quarterly, np.linspace(200.0, 28000.0, len(dates)), np.nan),
+        'GDPC1': np.where(quarterly, np.linspace(2000.0, 23000.0, len(dates)), np.nan),
+    }, index=dates)
+
+
+def test_load_fred_offline(tmp_path, fred_frame):
+    calls = []
+    source = load_fred.frame_source(fred_frame)
+
+    def counting_source(series, start, end):
+        calls.append((tuple(series), start, end))
+        return source(series, start, end)
+
+    df = load_fred.load_fred(data_dir=tmp_path, from_cache=False, save_cache=True, source=counting_source)
+    assert list(df.columns) == ['CPIAUCNS', 'GDP', 'GDPC1']
+    assert df.index.min() == pd.Timestamp('1913-01-01')
+    assert df.index.max() == pd.Timestamp('2023-10-01')
+    assert len(calls) == 1
+
+    # Covered ranges are read from the cache, only the missing tail is fetched
+    df = load_fred.load_fred(data_dir=tmp_path, start='1950-01-01', end='1960-12-01', source=counting_source)
+    assert df.index.min() == pd.Timestamp('1950-01-01') and df.index.max() == pd.Timestamp('1960-12-01')
+    assert len(calls) == 1
+    df = load_fred.load_fred(data_dir=tmp_path, end='2024-06-01', source=counting_source)
+    assert calls[1] == (('CPIAUCNS', 'GDP', 'GDPC1'), pd.Timestamp('2023-10-02'), pd.Timestamp('2024-06-01'))
+    assert df.equals(fred_frame.loc[:'2024-06-01'])
+    load_fred.load_fred(data_dir=tmp_path, end='2024-06-01', source=counting_source)
+    assert len(calls) == 2
+
+    with pytest.raises(FileNotFoundError):
+        load_fred.load_fred(data_dir="invalid_directory", source=counting_source)
+
+
+@pytest.mark.network
 def test_load_fred_functionality():
     df = load_fred.load_fred(data_dir=DATA_DIR, from_cache=False)
     # Test if the function returns a pandas DataFrame
@@ -20,6 +62,7 @@ def test_load_fred_functionality():
     with pytest.raises(FileNotFoundError):
         load_fred.load_fred(data_dir="invalid_directory")
 
+@pytest.mark.network
 def test_load_fred_data_validity():
     df = load_fred.load_fred(data_dir=DATA_DIR, from_cache=False)
     
@@ -0,0 +1,44 @@
+import numpy as np
+import pandas as pd
+
+from load_mflink import build_mflink1_index, build_mflink2_intervals, link_crsp_wficn, resolve_s12_wficn
+
+
+def test_link_crsp_wficn():
+    df_mflink1 = pd.DataFrame({
+        'crsp_fundno': [1.0, 2.0, 2.0, 3.0, 3.0, 4.0],
+        'wficn': [10.0, 21.0, 20.0, 30.0, 30.0, np.nan],
+    })
+    crsp_fundno = pd.Series([2.0, 1.0, 3.0, 4.0, 99.0, np.nan, 2.0])
+
+    index = build_mflink1_index(df_mflink1, policy="lowest")
+    assert index['ambiguous'].tolist() == [2]
+    wficn, n_ambiguous = link_crsp_wficn(crsp_fundno, index)
+    assert np.array_equal(wficn, [20.0, 10.0, 30.0, np.nan, np.nan, np.nan, 20.0], equal_nan=True)
+    assert n_ambiguous == 2
+
+    index = build_mflink1_index(df_mflink1, policy="drop")
+    wficn, _ = link_crsp_wficn(crsp_fundno, index)
+    assert np.array_equal(wficn, [np.nan, 10.0, 30.0, np.nan, np.nan, np.nan, np.nan], equal_nan=True)
+
+
+def test_resolve_s12_wficn():
+    df_mflink2 = pd.DataFrame({
+        'fundno': [1, 1, 1, 2],
+        'fdate': pd.to_datetime(['2000-03-31', '2000-06-30', '2000-06-30', '2000-03-31']),
+        'wficn': [10.0, 12.0, 11.0, 20.0],
+    })
+    df_s12 = pd.DataFrame({
+        'fundno': [1, 1, 1, 2, 3],
+        'fdate': pd.to_datetime(['2000-12-31', '2000-01-31', '2000-05-15', '2001-03-31', '2000-03-31']),
+    })
+    intervals = build_mflink2_intervals(df_mflink2)
+
+    # 2000-05-15 is 45 days after 2000-03-31 and 46 days before 2000-06-30
+    wficn, n_outside = resolve_s12_wficn(df_s12, intervals)
+    assert np.array_equal(wficn.to_numpy(), [11.0, 10.0, 10.0, 20.0, np.nan], equal_nan=True)
+    assert n_outside == 1
+
+    wficn, n_outside = resolve_s12_wficn(df_s12, intervals, tolerance_days=90)
+    assert np.array_equal(wficn.to_numpy(), [np.nan, 10.0, 10.0, np.nan, np.nan], equal_nan=True)
+    assert n_outside == 3
@@ -0,0 +1,62 @@
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+import load_s12
+from build_main_sample import fund_year
+from conftest import END_DATE, START_DATE
+
+
+def test_s12_fund_year_matches_pandas_steps(pulled_tree):
+    # The SQL reduction against the notebook steps run on the full S12 pull
+    df_sql = load_s12.pull_s12_fund_year(START_DATE, END_DATE)
+    df_pandas = fund_year(pulled_tree, use_cache=False)
+    assert df_pandas["assets"].isna().any()
+    assert len(df_sql) > 0
+
+    df_pandas = df_pandas.sort_values(["wficn", "year"]).reset_index(drop=True)
+    pd.testing.assert_frame_equal(df_sql, df_pandas, check_dtype=False)
+
+
+def test_streamed_s12_slice(tmp_path, wrds_sqlite, monkeypatch):
+    path = tmp_path / "s12"
+    write_chunks = load_s12.write_partitioned_chunks
+    autocommit = []
+
+    def recording_write(chunks, *args, **kwargs):
+        # sqlite3 connections have no isolation level in autocommit mode
+        autocommit.append(wrds_sqlite[0].connection.connection.isolation_level is None)
+        return write_chunks(chunks, *args, **kwargs)
+
+    monkeypatch.setattr(load_s12, "write_partitioned_chunks", recording_write)
+    n_rows = load_s12._stream_s12_slice(path, "2001-01-01", "2001-12-31", None, chunksize=10)
+    assert autocommit == [False]
+    assert wrds_sqlite[0].connection.connection.isolation_level is None
+
+    expected = load_s12.pull_s12("2001-01-01", "2001-12-31")
+    assert n_rows == len(expected) > 10
+    file = path / "year=2001" / "part-0.parquet"
+    # One row group per fetched chunk
+    assert pq.ParquetFile(file).num_row_groups == -(-len(expected) // 10)
+    pd.testing.assert_frame_equal(pd.read_parquet(file), expected, check_dtype=False)
+
+    # A slice that fails midway also puts the connection back into autocommit mode
+    def failing_write(chunks, *args, **kwargs):
+        next(iter(chunks))
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(load_s12, "write_partitioned_chunks", failing_write)
+    with pytest.raises(RuntimeError):
+        load_s12._stream_s12_slice(tmp_path / "failed", "2001-01-01", "2001-12-31", None, chunksize=10)
+    assert wrds_sqlite[-1].connection.connection.isolation_level is None
+
+
+def test_sliced_s12_pull_matches_single_query(tmp_path, wrds_sqlite):
+    n_rows = load_s12.pull_and_save_s12(tmp_path, START_DATE, END_DATE, chunksize=7, max_workers=3)
+    expected = load_s12.pull_s12(START_DATE, END_DATE)
+    assert n_rows == len(expected)
+
+    # Each year partition holds the rows of its year, in the order of the query
+    for year, df_year in expected.groupby(expected["fdate"].dt.year):
+        df = pd.read_parquet(tmp_path / "pulled" / "s12" / f"year={year}" / "part-0.parquet")
+        pd.testing.assert_frame_equal(df, df_year.reset_index(drop=True), check_dtype=False)
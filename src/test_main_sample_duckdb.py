@@ -0,0 +1,15 @@
+import pandas as pd
+
+from build_main_sample import merge_sample
+from main_sample_duckdb import build_main_sample_duckdb
+
+
+def test_duckdb_main_sample_matches_pandas_stages(pulled_tree, tmp_path):
+    df_duckdb = build_main_sample_duckdb(pulled_tree, tmp_path / "output", save=False)
+    df_combo = merge_sample(pulled_tree, use_cache=False)
+    assert len(df_combo) > 0
+
+    df_duckdb, df_combo = [
+        df.sort_values(["wficn", "year"]).reset_index(drop=True)[df_combo.columns] for df in [df_duckdb, df_combo]
+    ]
+    pd.testing.assert_frame_equal(df_duckdb, df_combo)
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+
+import factor_betas_calculation
+from panel_tools import PANEL_CATEGORIES, PANEL_COLUMNS, PANEL_FACTORS, load_panel
+
+
+def test_regression_panel_round_trip(tmp_path):
+    rng = np.random.default_rng(0)
+    dates = [200001, 200002, 200003, 200004]
+    df_crsp = pd.DataFrame({
+        'date': dates * 3,
+        'wficn': np.repeat([3.0, 1.0, 2.0], 4),
+        'crsp_ret': rng.normal(0.01, 0.05, 12),
+        'crsp_tna': rng.lognormal(3, 1, 12),
+        'lipper_class_name': np.repeat(['Large-Cap Growth Funds', None, 'Mid-Cap Value Funds'], 4),
+        'index_fund_flag': np.repeat([None, 'D', None], 4),
+    })
+    df_ff = pd.DataFrame(rng.normal(size=(4, len(PANEL_FACTORS))), columns=PANEL_FACTORS)
+    df_ff.insert(0, 'date', dates)
+
+    panel_dir = tmp_path / "regression_panel"
+    df_reg = factor_betas_calculation.regression_df(df_crsp, df_ff, panel_dir=panel_dir)
+    panel = load_panel(panel_dir)
+
+    assert panel["meta"]["n_rows"] == len(df_reg)
+    for col in PANEL_COLUMNS:
+        assert isinstance(panel[col], np.memmap)
+        assert not panel[col].flags.writeable
+        assert np.array_equal(panel[col], df_reg[col].to_numpy(), equal_nan=True)
+    assert np.array_equal(panel["factors"], df_reg[PANEL_FACTORS].to_numpy())
+    for col in PANEL_CATEGORIES:
+        categories = np.array(panel["meta"]["categories"][col])
+        assert categories[panel[col]].tolist() == df_reg[col].astype(str).tolist()
+
+    # The rows of each fund, by offsets
+    offsets = panel["offsets"]
+    assert offsets.tolist() == [0, 4, 8, 12]
+    for i, (wficn, df_fund) in enumerate(df_reg.groupby('wficn')):
+        rows = slice(offsets[i], offsets[i + 1])
+        assert (panel["wficn"][rows] == wficn).all()
+        assert np.array_equal(panel["crsp_ret"][rows], df_fund['crsp_ret'].to_numpy())
+
+    # Read into memory instead of mapped
+    assert not isinstance(load_panel(panel_dir, mmap_mode=None)["crsp_ret"], np.memmap)
@@ -0,0 +1,85 @@
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+import parquet_tools
+from parquet_tools import read_partitioned, write_parquet, write_partitioned
+
+
+def fund_months(years, seed=0):
+    dates = pd.date_range(f"{years[0]}-01-31", f"{years[-1]}-12-31", freq="M")
+    return pd.DataFrame({
+        "fundno": [1, 2] * len(dates),
+        "caldt": dates.repeat(2),
+        "mret": [0.001 * (i + seed) for i in range(2 * len(dates))],
+    })
+
+
+def test_partitioned_round_trip(tmp_path):
+    path = tmp_path / "funds"
+    df = fund_months([2000, 2002])
+    write_partitioned(df, path, "caldt", sort_by=["fundno", "caldt"])
+
+    assert sorted(p.name for p in path.iterdir()) == ["year=2000", "year=2001", "year=2002"]
+    expected = df.sort_values(["caldt", "fundno"], ignore_index=True)
+    df_read = read_partitioned(path, "caldt", dtype_backend="numpy")
+    pd.testing.assert_frame_equal(
+        df_read.sort_values(["caldt", "fundno"], ignore_index=True), expected, check_dtype=False
+    )
+
+    # Rewriting a year replaces its partition and keeps the others
+    df_2001 = fund_months([2001], seed=100)
+    write_partitioned(df_2001, path, "caldt")
+    expected = pd.concat([df[df["caldt"].dt.year != 2001], df_2001]).sort_values(["caldt", "fundno"], ignore_index=True)
+    df_read = read_partitioned(path, "caldt", dtype_backend="numpy")
+    pd.testing.assert_frame_equal(
+        df_read.sort_values(["caldt", "fundno"], ignore_index=True), expected, check_dtype=False
+    )
+
+
+def test_ranged_read_opens_only_its_years(tmp_path):
+    path = tmp_path / "funds"
+    df = fund_months([2000, 2002])
+    write_partitioned(df, path, "caldt")
+    # Reading another year's file would fail
+    for part in path.glob("year=200[02]/*.parquet"):
+        part.write_bytes(b"not parquet")
+
+    df_read = read_partitioned(path, "caldt", "2001-03-01", "2001-08-31", dtype_backend="numpy")
+    expected = df[df["caldt"].between("2001-03-01", "2001-08-31")].sort_values(["caldt", "fundno"], ignore_index=True)
+    pd.testing.assert_frame_equal(
+        df_read.sort_values(["caldt", "fundno"], ignore_index=True), expected, check_dtype=False
+    )
+    with pytest.raises(pa.ArrowInvalid):
+        read_partitioned(path, "caldt", dtype_backend="numpy")
+
+
+def test_write_layout(tmp_path, monkeypatch):
+    df = fund_months([2000, 2001]).sample(frac=1, random_state=0)
+    write_parquet(df, tmp_path / "funds.parquet", sort_by=["fundno", "caldt"], row_group_size=10)
+    monkeypatch.setattr(parquet_tools, "ROW_GROUP_SIZE", 10)
+    write_partitioned(df, tmp_path / "funds", "caldt", sort_by=["fundno", "caldt"])
+
+    files = [tmp_path / "funds.parquet", *sorted((tmp_path / "funds").glob("year=*/*.parquet"))]
+    assert len(files) == 3
+    for file in files:
+        df_file = pd.read_parquet(file)
+        assert df_file.equals(df_file.sort_values(["fundno", "caldt"]))
+        metadata = pq.ParquetFile(file).metadata
+        assert metadata.num_row_groups == -(-len(df_file) // 10)
+        for i in range(metadata.num_row_groups):
+            row_group = metadata.row_group(i)
+            assert row_group.num_rows <= 10
+            for j in range(row_group.num_columns):
+                column = row_group.column(j)
+                assert column.compression == "ZSTD"
+                assert column.is_stats_set and column.statistics.has_min_max
+                assert column.has_offset_index and column.has_column_index
+        # The statistics of the sorted fund ids bound each row group
+        fundno = metadata.schema.names.index("fundno")
+        bounds = [
+            (metadata.row_group(i).column(fundno).statistics.min, metadata.row_group(i).column(fundno).statistics.max)
+            for i in range(metadata.num_row_groups)
+        ]
+        assert bounds == sorted(bounds)
@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+
+from return_tools import compound_returns
+
+
+def test_compound_returns():
+    df = pd.DataFrame({
+        'wficn': [2, 1, 1, 1, 1, 2, 2],
+        'caldt': pd.to_datetime(['2001-01-31', '2000-11-30', '2000-12-31', '2001-02-28',
+                                 '2001-12-31', '2001-03-31', '2002-01-31']),
+        'mret': [0.10, 0.02, -0.01, 0.03, 0.05, -1.0, 0.04],
+    })
+    returns = compound_returns(df)
+
+    df_year = returns['year']
+    assert df_year[['wficn', 'year']].values.tolist() == [[1, 2000], [1, 2001], [2, 2001], [2, 2002]]
+    assert np.allclose(df_year['ret'], [1.02 * 0.99 - 1, 1.03 * 1.05 - 1, -1.0, 0.04])
+    assert df_year['n_months'].tolist() == [2, 2, 2, 1]
+    assert df_year['last_month'].tolist() == [12, 12, 3, 1]
+
+    assert returns['quarter']['n_months'].tolist() == [2, 1, 1, 2, 1]
+
+    # The window ending in December 2001 starts in January 2001: November and December 2000 are out
+    df_rolling = returns['rolling_12']
+    assert np.allclose(df_rolling['ret'], [0.02, 1.02 * 0.99 - 1, 1.02 * 0.99 * 1.03 - 1, 1.03 * 1.05 - 1, 0.10, -1.0, -1.0])
+    assert df_rolling['n_months'].tolist() == [1, 2, 3, 2, 1, 2, 2]
+
+
+def test_compound_returns_missing_month():
+    # A missing return makes every period containing it missing, instead of counting as 0%
+    df = pd.DataFrame({
+        'wficn': 1,
+        'caldt': pd.to_datetime(['2001-01-31', '2001-02-28', '2001-03-31', '2001-04-30', '2002-01-31']),
+        'mret': [0.10, np.nan, 0.10, 0.05, 0.02],
+    })
+    returns = compound_returns(df)
+
+    assert np.isnan(returns['year']['ret'].iloc[0])
+    assert returns['year']['n_months'].tolist() == [4, 1]
+    assert np.isclose(returns['year']['ret'].iloc[1], 0.02)
+    assert np.isnan(returns['quarter']['ret'].iloc[0])
+    assert np.isclose(returns['quarter']['ret'].iloc[1], 0.05)
+    df_rolling = returns['rolling_12']
+    assert np.isclose(df_rolling['ret'].iloc[0], 0.10)
+    assert df_rolling['ret'].iloc[1:].isna().all()
@@ -0,0 +1,33 @@
+import wrds_tools
+from wrds_tools import close_connections, wrds_connection
+
+
+class FakeConnection:
+    def __init__(self, wrds_username=None):
+        self.connection = self
+        self.closed = False
+        self.invalidated = False
+
+    def close(self):
+        self.closed = True
+
+
+def test_wrds_connection_pool(monkeypatch):
+    monkeypatch.setattr(wrds_tools.wrds, "Connection", FakeConnection)
+    close_connections()
+
+    with wrds_connection("user") as db:
+        pass
+    with wrds_connection("user") as db_again:
+        assert db_again is db
+    assert not db.closed
+
+    # A connection returned after the pool was emptied, but before `close_connections`
+    # got to close it, is closed instead of pooled
+    with wrds_connection("user") as db:
+        wrds_tools._IDLE.clear()
+        wrds_tools._OPEN.clear()
+    assert db.closed
+    with wrds_connection("user") as db_new:
+        assert db_new is not db
+    close_connections()
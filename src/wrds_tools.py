@@ -0,0 +1,148 @@
+"""
+Functions shared by the WRDS pulls
+
+- Large pulls are split into yearly date slices that run concurrently,
+  each on its own WRDS connection, and write their own year partition.
+- Slicing on a date column that is part of every row (and of every GROUP BY)
+  returns exactly the rows of the single-query pull.
+- Connections come from a process-wide pool (`wrds_connection`). A connection
+  is only opened when no idle one is available, so consecutive pulls in one
+  process (e.g. one `doit` run) log in once, and concurrent slices open at most
+  one connection per worker. Every pooled connection is closed at exit.
+
+Author: Jonathan Cai [mcai@uchicago.edu]
+"""
+
+import atexit
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import pandas as pd
+import wrds
+
+import config
+
+WRDS_USERNAME = config.WRDS_USERNAME
+PULL_WORKERS = config.PULL_WORKERS
+
+_POOL_LOCK = threading.Lock()
+_IDLE = {}  # wrds_username -> list of idle wrds.Connection
+_OPEN = []  # every connection opened by the pool
+
+
+def _is_alive(db) -> bool:
+    """Whether a pooled connection can still run queries"""
+    conn = getattr(db, "connection", None)
+    return conn is not None and not conn.closed and not conn.invalidated
+
+
+@contextmanager
+def wrds_connection(wrds_username: str = WRDS_USERNAME):
+    """
+    Borrow a WRDS connection from the process-wide pool
+
+    An idle connection of `wrds_username` is reused if there is one, otherwise
+    a new one is opened. The connection goes back to the pool when the block
+    exits, and stays open until `close_connections` (which also runs at exit).
+    Do not close the connection inside the block.
+
+    Args:
+    - wrds_username: str, WRDS username
+
+    Yields:
+    - db: wrds.Connection
+    """
+    db = None
+    with _POOL_LOCK:
+        idle = _IDLE.setdefault(wrds_username, [])
+        while idle and db is None:
+            candidate = idle.pop()
+            if _is_alive(candidate):
+                db = candidate
+            else:
+                _OPEN.remove(candidate)
+    if db is None:
+        # wrds.Connection logs in on construction. Using it as a context
+        # manager would call connect() a second time.
+        db = wrds.Connection(wrds_username=wrds_username)
+        with _POOL_LOCK:
+            _OPEN.append(db)
+    try:
+        yield db
+    finally:
+        with _POOL_LOCK:
+            # `close_connections` may have emptied the pool while db was borrowed
+            pooled = db in _OPEN
+            if pooled and _is_alive(db):
+                _IDLE.setdefault(wrds_username, []).append(db)
+            elif pooled:
+                _OPEN.remove(db)
+        if not pooled and _is_alive(db):
+            db.close()
+
+
+def close_connections() -> None:
+    """
+    Close every connection opened by the pool
+
+    Registered with `atexit`. Connections that are still borrowed are closed
+    as well, so only call it once the pulls are done.
+    """
+    with _POOL_LOCK:
+        connections = list(_OPEN)
+        _OPEN.clear()
+        _IDLE.clear()
+    for db in connections:
+        db.close()
+
+
+atexit.register(close_connections)
+
+
+def year_slices(
+    start_date: str,
+    end_date: str,
+) -> list:
+    """
+    Split [start_date, end_date] into calendar-year slices
+
+    Args:
+    - start_date: str, start date in "YYYY-MM-DD" format
+    - end_date: str, end date in "YYYY-MM-DD" format
+
+    Returns:
+    - slices: list of (str, str), inclusive (start, end) dates of each slice
+    """
+    start, end = pd.Timestamp(start_date), pd.Timestamp(end_date)
+    slices = []
+    for year in range(start.year, end.year + 1):
+        slice_start = max(start, pd.Timestamp(year=year, month=1, day=1))
+        slice_end = min(end, pd.Timestamp(year=year, month=12, day=31))
+        slices.append((slice_start.strftime("%Y-%m-%d"), slice_end.strftime("%Y-%m-%d")))
+    return slices
+
+
+def run_sliced(
+    pull_slice,
+    slices: list,
+    max_workers: int = PULL_WORKERS,
+) -> list:
+    """
+    Run `pull_slice(start_date, end_date)` for every slice on a bounded thread pool
+
+    The database work happens on the server and in the driver, which release
+    the GIL, so threads are enough to keep `max_workers` queries in flight.
+    The first exception raised by a slice is re-raised.
+
+    Args:
+    - pull_slice: callable, pulls and saves one (start_date, end_date) slice
+    - slices: list of (str, str), e.g. from `year_slices`
+    - max_workers: int, maximum number of concurrent pulls (and pooled connections)
+
+    Returns:
+    - results: list, return values of `pull_slice`, in the order of `slices`
+    """
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(pull_slice, start, end) for start, end in slices]
+        return [future.result() for future in futures]